@@ -0,0 +1,730 @@
+import argparse
+import base64
+import hashlib
+import http.server
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import queue
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import uuid
+
+import google_crc32c
+
+# resource only exists on Unix, peak RSS is not reported elsewhere
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+logger = logging.getLogger(__name__)
+
+
+# Synthetic trees matching the directories the uploader is used on. Sizes are in bytes, files are spread
+# over directories of files_per_directory files and get the extensions of the file_types of the config file
+PROFILES = {
+    # Millions of tiny files, the scan and the per-request overhead dominate
+    'tiny': {'files': 1000000, 'min_size': 0, 'max_size': 4096, 'files_per_directory': 1000},
+    # A few huge files, the throughput of large uploads dominates
+    'huge': {'files': 4, 'min_size': 256 * 1024 * 1024, 'max_size': 1024 * 1024 * 1024, 'files_per_directory': 4},
+    # A mix of image, media and document files of every size
+    'mixed': {'files': 5000, 'min_size': 0, 'max_size': 4 * 1024 * 1024, 'files_per_directory': 500, 'size_distribution': 'log'}
+}
+
+# Files are written in chunks of this size, so huge files never have to fit in memory
+_WRITE_CHUNK = 8 * 1024 * 1024
+
+
+def generate_tree(directory, profile, extensions, files=None, seed=0):
+    '''Write the synthetic tree of the profile (a PROFILES name or a dict of the same form) into the directory.
+
+    Names, sizes and contents only depend on the profile, the extensions, files and the seed, so every run
+    benchmarks the same tree. A tree.json file describes the tree; when it already matches, the tree is
+    reused instead of being written again, as writing millions of files takes longer than uploading them.
+    Return the description: the number of files and their total size.
+    '''
+
+    settings = dict(PROFILES[profile]) if isinstance(profile, str) else dict(profile)
+    if files is not None:
+        settings['files'] = files
+    description = {'profile': profile if isinstance(profile, str) else 'custom', 'settings': settings,
+                   'extensions': sorted(extensions), 'seed': seed}
+
+    description_path = os.path.join(directory, 'tree.json')
+    if os.path.exists(description_path):
+        with open(description_path) as f:
+            existing = json.load(f)
+        if {key: existing.get(key) for key in description} == description:
+            return existing
+
+    rng = random.Random(seed)
+    extensions = sorted(extensions)
+    total_bytes = 0
+    for index in range(settings['files']):
+        subdirectory = os.path.join(directory, f"d{index // settings['files_per_directory']:05d}")
+        if index % settings['files_per_directory'] == 0:
+            os.makedirs(subdirectory, exist_ok=True)
+
+        # A log distribution gives many small files and a few large ones, like real directories
+        if settings.get('size_distribution') == 'log':
+            size = int(2 ** rng.uniform(0, (max(settings['max_size'], 1)).bit_length())) - 1
+            size = max(settings['min_size'], min(size, settings['max_size']))
+        else:
+            size = rng.randint(settings['min_size'], settings['max_size'])
+
+        file_path = os.path.join(subdirectory, f"f{index:07d}.{extensions[index % len(extensions)]}")
+        with open(file_path, 'wb') as f:
+            remaining = size
+            while remaining:
+                chunk = rng.randbytes(min(remaining, _WRITE_CHUNK))
+                f.write(chunk)
+                remaining -= len(chunk)
+        total_bytes += size
+
+    description.update({'files': settings['files'], 'bytes': total_bytes})
+    with open(description_path, 'w') as f:
+        json.dump(description, f)
+    return description
+
+
+class _Digest:
+    # MD5 and CRC32C of an object, computed as its bytes arrive
+    def __init__(self):
+        self.size = 0
+        self.md5 = hashlib.md5()
+        self.crc32c = google_crc32c.Checksum()
+
+    def update(self, data):
+        self.size += len(data)
+        self.md5.update(data)
+        self.crc32c.update(data)
+
+
+class StandInServer:
+    '''Define a class called StandInServer which answers the S3 and GCS requests of the uploaders on a local port.
+
+    It implements just enough of both APIs for S3Uploader and GCSUploader: S3 PutObject, CopyObject,
+    ListObjectsV2 and multipart uploads, the GCS JSON API multipart and resumable uploads, copies and
+    listings, the GCS XML API multipart uploads and the OAuth token endpoint of a service account. Object
+    contents are checksummed and dropped, only their size, MD5 and CRC32C are kept, so huge uploads do not
+    use memory. Every response is delayed by latency seconds, and every throttle_every-th upload request is
+    refused with 503 SlowDown (S3 and GCS XML API) or 429 (GCS JSON API) to exercise the retries.
+    '''
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, throttle_every=0):
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.objects = {}
+        self.requests = 0
+        self.throttled = 0
+        self._uploads = {}
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(_StandInHandler):
+            stand_in = server
+
+        self._server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self.url = f"http://{host}:{self._server.server_address[1]}"
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='stand-in-server', daemon=True)
+        self._thread.start()
+        return self.url
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def count_request(self, upload):
+        # Count a request and return True when it must be throttled
+        with self._lock:
+            self.requests += 1
+            if upload and self.throttle_every and self.requests % self.throttle_every == 0:
+                self.throttled += 1
+                return True
+        return False
+
+    def put_object(self, bucket, key, digest, content_type=None):
+        # Record an object and return its entry
+        entry = {'size': digest.size, 'md5': digest.md5.digest(), 'crc32c': digest.crc32c.digest(),
+                 'content_type': content_type or 'application/octet-stream'}
+        with self._lock:
+            self.objects[(bucket, key)] = entry
+        return entry
+
+    def create_upload(self, bucket, key, content_type=None):
+        upload_id = uuid.uuid4().hex
+        with self._lock:
+            self._uploads[upload_id] = {'bucket': bucket, 'key': key, 'parts': {}, 'digest': _Digest(),
+                                        'content_type': content_type}
+        return upload_id
+
+    def get_upload(self, upload_id):
+        with self._lock:
+            return self._uploads.get(upload_id)
+
+    def finish_upload(self, upload_id):
+        with self._lock:
+            return self._uploads.pop(upload_id, None)
+
+
+class _StandInHandler(http.server.BaseHTTPRequestHandler):
+    # HTTP/1.1 keeps the connections of the uploaders' pools alive between requests
+    protocol_version = 'HTTP/1.1'
+    stand_in = None
+
+    def log_message(self, format, *args):
+        logger.debug("Stand-in request: " + format, *args)
+
+    # Request helpers
+
+    def read_body(self, digest=None):
+        '''Read the body of the request, into digest when given (returning None) or into memory'''
+
+        length = int(self.headers.get('Content-Length', 0))
+        chunked = 'aws-chunked' in self.headers.get('Content-Encoding', '')
+        data = [] if digest is None else None
+        if chunked:
+            reader = self._aws_chunks(length)
+        else:
+            reader = self._chunks(length)
+        for chunk in reader:
+            if digest is not None:
+                digest.update(chunk)
+            else:
+                data.append(chunk)
+        return None if digest is not None else b''.join(data)
+
+    def _chunks(self, length):
+        while length:
+            chunk = self.rfile.read(min(length, 1024 * 1024))
+            if not chunk:
+                return
+            length -= len(chunk)
+            yield chunk
+
+    def _aws_chunks(self, length):
+        # aws-chunked bodies are a series of '<hex size>[;extensions]\r\n<data>\r\n' followed by trailers
+        consumed = 0
+        while consumed < length:
+            line = self.rfile.readline()
+            consumed += len(line)
+            size = int(line.split(b';')[0].strip() or b'0', 16)
+            if size == 0:
+                break
+            data = self.rfile.read(size)
+            consumed += len(data) + len(self.rfile.readline())
+            yield data
+        # Skip the trailers, e.g. the checksum of the content
+        if consumed < length:
+            self.rfile.read(length - consumed)
+
+    def send(self, status, body=b'', content_type='application/xml', headers=None):
+        if self.stand_in.latency:
+            time.sleep(self.stand_in.latency)
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode('utf-8')
+            content_type = 'application/json'
+        elif isinstance(body, str):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if body:
+            self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body and self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def send_xml_error(self, status, code, message):
+        self.send(status, f"<?xml version=\"1.0\" encoding=\"UTF-8\"?><Error><Code>{code}</Code><Message>{message}</Message></Error>")
+
+    def send_json_error(self, status, message):
+        self.send(status, {'error': {'code': status, 'message': message, 'errors': [{'message': message}]}})
+
+    def discard_body(self):
+        for _ in self._chunks(int(self.headers.get('Content-Length', 0))):
+            pass
+
+    # Dispatch
+
+    def do_GET(self):
+        self.dispatch()
+
+    def do_HEAD(self):
+        self.dispatch()
+
+    def do_PUT(self):
+        self.dispatch()
+
+    def do_POST(self):
+        self.dispatch()
+
+    def do_DELETE(self):
+        self.dispatch()
+
+    def dispatch(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query, keep_blank_values=True)
+        path = url.path
+        try:
+            if path == '/token':
+                self.discard_body()
+                return self.send(200, {'access_token': 'stand-in-token', 'expires_in': 3600, 'token_type': 'Bearer'})
+            if path.startswith('/upload/storage/v1/') or path.startswith('/storage/v1/'):
+                return self.gcs_json(path, query)
+            return self.xml_api(path, query)
+        except Exception as e:
+            logger.exception("Stand-in server failed on %s %s", self.command, self.path)
+            self.send_xml_error(500, 'InternalError', str(e))
+
+    # S3 API and GCS XML API, both address objects as /bucket/key
+
+    def xml_api(self, path, query):
+        bucket, _, key = path.lstrip('/').partition('/')
+        key = urllib.parse.unquote(key)
+        uploading = self.command in ('PUT', 'POST')
+        if self.stand_in.count_request(uploading):
+            self.discard_body()
+            return self.send_xml_error(503, 'SlowDown', 'Please reduce your request rate.')
+
+        if not key:
+            if self.command == 'GET':
+                return self.list_bucket_v2(bucket, query)
+            self.discard_body()
+            return self.send(200)
+
+        if self.command == 'POST' and 'uploads' in query:
+            self.discard_body()
+            upload_id = self.stand_in.create_upload(bucket, key, self.headers.get('Content-Type'))
+            return self.send(200, f"<InitiateMultipartUploadResult {_XMLNS}><Bucket>{bucket}</Bucket><Key>{_xml(key)}</Key><UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>")
+
+        if 'uploadId' in query:
+            upload = self.stand_in.get_upload(query['uploadId'][0])
+            if upload is None:
+                self.discard_body()
+                return self.send_xml_error(404, 'NoSuchUpload', 'The specified upload does not exist.')
+            if self.command == 'PUT':
+                digest = _Digest()
+                self.read_body(digest)
+                etag = digest.md5.hexdigest()
+                upload['parts'][int(query['partNumber'][0])] = (digest.size, digest.md5.digest(), etag)
+                return self.send(200, headers={'ETag': f'"{etag}"', 'x-goog-hash': _goog_hash(digest)})
+            if self.command == 'POST':
+                self.discard_body()
+                upload = self.stand_in.finish_upload(query['uploadId'][0])
+                parts = [upload['parts'][number] for number in sorted(upload['parts'])]
+                entry = self.stand_in.put_object(bucket, key, _combined_digest(parts), upload['content_type'])
+                etag = f"{hashlib.md5(b''.join(md5 for size, md5, part_etag in parts)).hexdigest()}-{len(parts)}"
+                entry['etag'] = etag
+                return self.send(200, f"<CompleteMultipartUploadResult {_XMLNS}><Bucket>{bucket}</Bucket><Key>{_xml(key)}</Key><ETag>\"{etag}\"</ETag></CompleteMultipartUploadResult>")
+            if self.command == 'DELETE':
+                self.stand_in.finish_upload(query['uploadId'][0])
+                return self.send(204)
+            parts = ''.join(f"<Part><PartNumber>{number}</PartNumber><ETag>\"{etag}\"</ETag><Size>{size}</Size></Part>"
+                            for number, (size, md5, etag) in sorted(upload['parts'].items()))
+            return self.send(200, f"<ListPartsResult {_XMLNS}><Bucket>{bucket}</Bucket><Key>{_xml(key)}</Key><UploadId>{query['uploadId'][0]}</UploadId><IsTruncated>false</IsTruncated>{parts}</ListPartsResult>")
+
+        if self.command == 'PUT':
+            source = self.headers.get('x-amz-copy-source')
+            if source:
+                self.discard_body()
+                source_bucket, _, source_key = urllib.parse.unquote(source).lstrip('/').partition('/')
+                entry = self.stand_in.objects.get((source_bucket, source_key))
+                if entry is None:
+                    return self.send_xml_error(404, 'NoSuchKey', 'The specified key does not exist.')
+                self.stand_in.objects[(bucket, key)] = dict(entry)
+                return self.send(200, f"<CopyObjectResult {_XMLNS}><ETag>\"{entry['md5'].hex()}\"</ETag></CopyObjectResult>")
+            digest = _Digest()
+            self.read_body(digest)
+            self.stand_in.put_object(bucket, key, digest, self.headers.get('Content-Type'))
+            return self.send(200, headers={'ETag': f'"{digest.md5.hexdigest()}"'})
+
+        entry = self.stand_in.objects.get((bucket, key))
+        if self.command in ('GET', 'HEAD') and entry is not None:
+            return self.send(200, headers={'ETag': f'"{entry["md5"].hex()}"'})
+        self.discard_body()
+        return self.send_xml_error(404, 'NoSuchKey', 'The specified key does not exist.')
+
+    def list_bucket_v2(self, bucket, query):
+        prefix = query.get('prefix', [''])[0]
+        contents = ''.join(f"<Contents><Key>{_xml(key)}</Key><Size>{entry['size']}</Size><ETag>\"{entry.get('etag', entry['md5'].hex())}\"</ETag></Contents>"
+                           for (object_bucket, key), entry in sorted(self.stand_in.objects.items())
+                           if object_bucket == bucket and key.startswith(prefix))
+        return self.send(200, f"<ListBucketResult {_XMLNS}><Name>{bucket}</Name><Prefix>{_xml(prefix)}</Prefix><IsTruncated>false</IsTruncated>{contents}</ListBucketResult>")
+
+    # GCS JSON API
+
+    def gcs_json(self, path, query):
+        upload_type = query.get('uploadType', [None])[0]
+        uploading = self.command in ('PUT', 'POST')
+        if self.stand_in.count_request(uploading):
+            self.discard_body()
+            return self.send_json_error(429, 'The rate of change requests to the bucket is too high.')
+
+        match = re.match(r'^/upload/storage/v1/b/([^/]+)/o$', path)
+        if match and upload_type == 'multipart':
+            return self.gcs_multipart_upload(match.group(1))
+        if match and upload_type == 'resumable':
+            if 'upload_id' in query:
+                return self.gcs_resumable_chunk(match.group(1), query['upload_id'][0])
+            metadata = json.loads(self.read_body() or b'{}')
+            upload_id = self.stand_in.create_upload(match.group(1), metadata.get('name') or query.get('name', [''])[0],
+                                                    metadata.get('contentType'))
+            location = f"http://{self.headers['Host']}/upload/storage/v1/b/{match.group(1)}/o?uploadType=resumable&upload_id={upload_id}"
+            return self.send(200, headers={'Location': location})
+
+        match = re.match(r'^/storage/v1/b/([^/]+)/o/(.+)/(?:copyTo|rewriteTo)/b/([^/]+)/o/(.+)$', path)
+        if match:
+            self.discard_body()
+            source = self.stand_in.objects.get((match.group(1), urllib.parse.unquote(match.group(2))))
+            if source is None:
+                return self.send_json_error(404, 'No such object.')
+            bucket, key = match.group(3), urllib.parse.unquote(match.group(4))
+            self.stand_in.objects[(bucket, key)] = dict(source)
+            resource = _gcs_resource(bucket, key, source)
+            if path.split('/')[-4] == 'rewriteTo':
+                resource = {'kind': 'storage#rewriteResponse', 'done': True, 'objectSize': str(source['size']),
+                            'totalBytesRewritten': str(source['size']), 'resource': resource}
+            return self.send(200, resource)
+
+        match = re.match(r'^/storage/v1/b/([^/]+)/o$', path)
+        if match and self.command == 'GET':
+            prefix = query.get('prefix', [''])[0]
+            items = [_gcs_resource(bucket, key, entry) for (bucket, key), entry in sorted(self.stand_in.objects.items())
+                     if bucket == match.group(1) and key.startswith(prefix)]
+            return self.send(200, {'kind': 'storage#objects', 'items': items})
+
+        match = re.match(r'^/storage/v1/b/([^/]+)/o/(.+)$', path)
+        if match and self.command == 'GET':
+            entry = self.stand_in.objects.get((match.group(1), urllib.parse.unquote(match.group(2))))
+            if entry is not None:
+                return self.send(200, _gcs_resource(match.group(1), urllib.parse.unquote(match.group(2)), entry))
+
+        self.discard_body()
+        return self.send_json_error(404, 'Not found.')
+
+    def gcs_multipart_upload(self, bucket):
+        # A multipart/related body: the JSON metadata of the object, then its content
+        boundary = re.search(r'boundary="?([^";]+)"?', self.headers['Content-Type']).group(1).encode('ascii')
+        body = self.read_body()
+        parts = [part for part in body.split(b'--' + boundary) if part.strip(b'\r\n') not in (b'', b'--')]
+        metadata = json.loads(parts[0].split(b'\r\n\r\n', 1)[1])
+        content = parts[1].split(b'\r\n\r\n', 1)[1]
+        if content.endswith(b'\r\n'):
+            content = content[:-2]
+        digest = _Digest()
+        digest.update(content)
+        entry = self.stand_in.put_object(bucket, metadata['name'], digest, metadata.get('contentType'))
+        return self.send(200, _gcs_resource(bucket, metadata['name'], entry))
+
+    def gcs_resumable_chunk(self, bucket, upload_id):
+        upload = self.stand_in.get_upload(upload_id)
+        if upload is None:
+            self.discard_body()
+            return self.send_json_error(404, 'No such upload.')
+        self.read_body(upload['digest'])
+
+        # Content-Range is 'bytes first-last/total', 'bytes first-last/*' or 'bytes */total' for a status query
+        content_range = self.headers.get('Content-Range', '')
+        total = content_range.rpartition('/')[2]
+        received = upload['digest'].size
+        if total != '*' and total and int(total) == received:
+            self.stand_in.finish_upload(upload_id)
+            entry = self.stand_in.put_object(bucket, upload['key'], upload['digest'], upload['content_type'])
+            return self.send(200, _gcs_resource(bucket, upload['key'], entry))
+        headers = {'Range': f"bytes=0-{received - 1}"} if received else {}
+        return self.send(308, headers=headers)
+
+
+# Namespace of the S3 XML API, which the GCS XML API answers with too
+_XMLNS = 'xmlns="http://s3.amazonaws.com/doc/2006-03-01/"'
+
+
+def _xml(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def _goog_hash(digest):
+    # The checksums of a GCS XML API part, checked by the client against its own
+    return f"crc32c={base64.b64encode(digest.crc32c.digest()).decode('ascii')},md5={base64.b64encode(digest.md5.digest()).decode('ascii')}"
+
+
+def _combined_digest(parts):
+    # The MD5 and CRC32C of a multipart object are not needed by the uploaders, only its size is exact
+    digest = _Digest()
+    digest.size = sum(size for size, md5, etag in parts)
+    return digest
+
+
+def _gcs_resource(bucket, key, entry):
+    return {'kind': 'storage#object', 'bucket': bucket, 'name': key, 'size': str(entry['size']),
+            'md5Hash': base64.b64encode(entry['md5']).decode('ascii'), 'crc32c': base64.b64encode(entry['crc32c']).decode('ascii'),
+            'contentType': entry['content_type'], 'generation': '1', 'metageneration': '1'}
+
+
+def write_credentials(directory, server_url):
+    '''Write throwaway S3 and GCS credentials files whose GCS token endpoint is the stand-in server.
+    Return their paths. The service account key is generated on the fly with the cryptography package'''
+
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    s3_path = os.path.join(directory, 'bench_s3_key.csv')
+    with open(s3_path, 'w', newline='') as f:
+        f.write("Access key ID,Secret access key\r\nBENCHMARKACCESSKEY,benchmark-secret-key\r\n")
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+    gcs_path = os.path.join(directory, 'bench_gcs_key.json')
+    with open(gcs_path, 'w') as f:
+        json.dump({'type': 'service_account', 'project_id': 'benchmark', 'private_key_id': 'benchmark',
+                   'private_key': pem.decode('ascii'), 'client_email': 'benchmark@benchmark.iam.gserviceaccount.com',
+                   'client_id': '1', 'token_uri': f"{server_url}/token"}, f)
+    return s3_path, gcs_path
+
+
+def benchmark_config(config, s3_credentials, gcs_credentials, state_directory, overrides=None):
+    '''Return a copy of the config pointing at the stand-in buckets with throwaway credentials.
+
+    Every other section is kept, so the benchmark measures the settings of the config file. The manifest,
+    checkpoints and cached listings go to state_directory, which is empty at the start of every case, and
+    overrides (section -> dict of settings) are applied last'''
+
+    config = json.loads(json.dumps(config))
+    config['cloud_services'] = {
+        's3': {'bucket_name': 'benchmark-s3', 'credentials_file': s3_credentials},
+        'gcs': {'bucket_name': 'benchmark-gcs', 'credentials_file': gcs_credentials}
+    }
+    if 'sync' in config:
+        config['sync']['manifest_file'] = os.path.join(state_directory, 'manifest.db')
+    if config.get('large_files', {}).get('checkpoint_dir'):
+        config['large_files']['checkpoint_dir'] = os.path.join(state_directory, 'checkpoints')
+    if config.get('remote_index', {}).get('cache_dir'):
+        config['remote_index']['cache_dir'] = os.path.join(state_directory, 'remote_index')
+    config['metrics'] = {'enabled': False}
+    for section, settings in (overrides or {}).items():
+        config.setdefault(section, {}).update(settings)
+    return config
+
+
+def _peak_rss():
+    # Peak resident set size of the calling process in bytes, None where the resource module is missing
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _run_case(directory, config_path, server_url, use_async, results):
+    # Upload the tree in a fresh process, so its CPU time and peak RSS only cover this case
+    os.environ['AWS_ENDPOINT_URL_S3'] = server_url
+    os.environ['AWS_DEFAULT_REGION'] = 'us-east-1'
+    os.environ['STORAGE_EMULATOR_HOST'] = server_url
+    snapshots = []
+    try:
+        # An import error is reported like any other error of the case
+        from file_uploader import AsyncFileUploader, FileUploader
+        from upload_metrics import CallbackSink, Metrics
+
+        metrics = Metrics([CallbackSink(snapshots.append)])
+        started = time.perf_counter()
+        cpu_started = time.process_time()
+        if use_async:
+            import asyncio
+            asyncio.run(AsyncFileUploader(directory, config_path, metrics=metrics).upload_files_async())
+        else:
+            FileUploader(directory, config_path, metrics=metrics).upload_files()
+        elapsed = time.perf_counter() - started
+        cpu = time.process_time() - cpu_started
+    except Exception as e:
+        results.put({'error': f"{type(e).__name__}: {e}"})
+        return
+
+    uploaded = failed = skipped = uploaded_bytes = 0
+    for counter in snapshots[-1]['counters'] if snapshots else []:
+        if counter['name'] == 'uploads_total':
+            outcome = counter['labels'].get('outcome')
+            if outcome == 'uploaded':
+                uploaded += counter['value']
+            elif outcome == 'failed':
+                failed += counter['value']
+            else:
+                skipped += counter['value']
+        elif counter['name'] == 'upload_bytes_total':
+            uploaded_bytes += counter['value']
+    results.put({'elapsed': elapsed, 'cpu_seconds': cpu, 'peak_rss': _peak_rss(),
+                 'uploaded': uploaded, 'failed': failed, 'skipped': skipped, 'bytes': uploaded_bytes})
+
+
+def _wait_for_outcome(name, process, results, poll_interval=1.0):
+    # Wait for the result of the child process, raising when it died without one (crash, OOM kill) instead of waiting forever
+    while True:
+        try:
+            return results.get(timeout=poll_interval)
+        except queue.Empty:
+            if process.is_alive():
+                continue
+        # The child may have put its result just before exiting
+        try:
+            return results.get(timeout=poll_interval)
+        except queue.Empty:
+            raise Exception(f"Benchmark case '{name}' failed: the uploading process exited with code {process.exitcode}")
+
+
+def run_case(name, directory, config, server, credentials_directory, overrides=None, use_async=False):
+    '''Upload the tree in the directory with the config against the running StandInServer, in a child process.
+    Return the result of the case: files/s, MB/s, CPU seconds and peak RSS of the uploading process'''
+
+    with tempfile.TemporaryDirectory() as state_directory:
+        s3_credentials = os.path.join(credentials_directory, 'bench_s3_key.csv')
+        gcs_credentials = os.path.join(credentials_directory, 'bench_gcs_key.json')
+        config_path = os.path.join(state_directory, 'config.json')
+        with open(config_path, 'w') as f:
+            json.dump(benchmark_config(config, s3_credentials, gcs_credentials, state_directory, overrides), f)
+
+        requests_before, throttled_before = server.requests, server.throttled
+        context = multiprocessing.get_context('spawn')
+        results = context.Queue()
+        process = context.Process(target=_run_case, args=(directory, config_path, server.url, use_async, results))
+        process.start()
+        outcome = _wait_for_outcome(name, process, results)
+        process.join()
+
+    if 'error' in outcome:
+        raise Exception(f"Benchmark case '{name}' failed: {outcome['error']}")
+    elapsed = outcome['elapsed']
+    return {
+        'name': name,
+        'async': use_async,
+        'overrides': overrides or {},
+        'elapsed': round(elapsed, 3),
+        'files_uploaded': outcome['uploaded'],
+        'files_failed': outcome['failed'],
+        'files_skipped': outcome['skipped'],
+        'bytes': outcome['bytes'],
+        'files_per_second': round(outcome['uploaded'] / elapsed, 1) if elapsed else None,
+        'mb_per_second': round(outcome['bytes'] / elapsed / 1e6, 2) if elapsed else None,
+        'cpu_seconds': round(outcome['cpu_seconds'], 3),
+        'cpu_utilization': round(outcome['cpu_seconds'] / elapsed, 3) if elapsed else None,
+        'peak_rss_mb': round(outcome['peak_rss'] / 1e6, 1) if outcome['peak_rss'] is not None else None,
+        'requests': server.requests - requests_before,
+        'throttled': server.throttled - throttled_before
+    }
+
+
+def _git_commit():
+    # The commit the benchmark ran on, so results can be compared across commits
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    '''Return the change of files/s and MB/s of every case found in both results, as {name: {metric: ratio}}'''
+
+    baseline_cases = {case['name']: case for case in baseline['cases']}
+    changes = {}
+    for case in results['cases']:
+        previous = baseline_cases.get(case['name'])
+        if previous is None:
+            continue
+        changes[case['name']] = {metric: round(case[metric] / previous[metric], 3) if previous.get(metric) else None
+                                 for metric in ('files_per_second', 'mb_per_second', 'cpu_seconds', 'peak_rss_mb')}
+    return changes
+
+
+def run_benchmarks(config_file='config.json', profiles=('mixed',), files=None, workdir=None, latency=0.0,
+                   throttle_every=0, cases=None, use_async=False, seed=0):
+    '''Generate the trees of the profiles and upload each of them with every case against a StandInServer.
+
+    cases maps a case name to config overrides, e.g. {'8 workers': {'concurrency': {'max_workers': 8}}};
+    by default the config file is benchmarked as it is. Return the results, ready to be saved as JSON.
+    '''
+
+    with open(config_file) as f:
+        config = json.load(f)
+    extensions = sorted({extension for file_types in config['file_types'].values() for extension in file_types})
+    cases = cases or {'config': None}
+
+    server = StandInServer(latency=latency, throttle_every=throttle_every)
+    server.start()
+    workdir = workdir or os.path.join(tempfile.gettempdir(), 'file_uploader_benchmark')
+    results = {'commit': _git_commit(), 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+               'platform': platform.platform(), 'cpu_count': os.cpu_count(), 'config_file': config_file,
+               'latency': latency, 'throttle_every': throttle_every, 'seed': seed, 'cases': []}
+    try:
+        with tempfile.TemporaryDirectory() as credentials_directory:
+            write_credentials(credentials_directory, server.url)
+            for profile in profiles:
+                directory = os.path.join(workdir, profile)
+                os.makedirs(directory, exist_ok=True)
+                tree = generate_tree(directory, profile, extensions, files, seed)
+                logger.info("Tree '%s': %s files, %s bytes.", profile, tree['files'], tree['bytes'])
+                for case_name, overrides in cases.items():
+                    result = run_case(f"{profile}/{case_name}", directory, config, server, credentials_directory, overrides, use_async)
+                    result.update({'tree_files': tree['files'], 'tree_bytes': tree['bytes']})
+                    logger.info("%s: %s files/s, %s MB/s, %s CPU seconds, peak RSS %s MB.", result['name'],
+                                result['files_per_second'], result['mb_per_second'], result['cpu_seconds'], result['peak_rss_mb'])
+                    results['cases'].append(result)
+    finally:
+        server.stop()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark FileUploader against local S3 and GCS stand-ins.")
+    parser.add_argument('--config', default='config.json', help="config file whose settings are benchmarked")
+    parser.add_argument('--profile', action='append', choices=sorted(PROFILES), help="tree profile, may be repeated (default: mixed)")
+    parser.add_argument('--files', type=int, help="number of files of every tree, overriding the profile")
+    parser.add_argument('--workdir', help="directory keeping the generated trees between runs")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every response of the stand-ins")
+    parser.add_argument('--throttle-every', type=int, default=0, help="throttle every N-th upload request")
+    parser.add_argument('--workers', type=int, action='append', help="benchmark with this many 'max_workers', may be repeated")
+    parser.add_argument('--async', dest='use_async', action='store_true', help="upload with AsyncFileUploader")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark_results.json', help="file the JSON results are written to")
+    parser.add_argument('--baseline', help="JSON results of an earlier run to compare with")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    # Per-file messages of the uploads would drown the results
+    logging.getLogger('file_uploader').setLevel(logging.WARNING)
+
+    cases = None
+    if args.workers:
+        cases = {f"workers={workers}": {'concurrency': {'max_workers': workers}} for workers in args.workers}
+    results = run_benchmarks(args.config, tuple(args.profile or ['mixed']), args.files, args.workdir, args.latency,
+                             args.throttle_every, cases, args.use_async, args.seed)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    logger.info("Results written to %s.", args.output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            for name, change in compare(results, json.load(f)).items():
+                logger.info("%s compared with the baseline: %s", name, ', '.join(f"{metric} x{ratio}" for metric, ratio in change.items()))
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+import logging
+import queue
+import threading
+import zlib
+
+# zstd is optional, gzip is used when the zstandard package is not installed
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+logger = logging.getLogger(__name__)
+
+
+# Extensions of formats that are already compressed, they are never compressed again
+COMPRESSED_EXTENSIONS = frozenset({
+    'jpg', 'jpeg', 'png', 'gif', 'webp', 'heic', 'avif',
+    'mp3', 'mp4', 'mpeg4', 'm4a', 'm4v', 'wmv', '3gp', 'webm', 'avi', 'mkv', 'mov', 'ogg', 'flac', 'aac',
+    'zip', 'gz', 'tgz', 'bz2', 'xz', 'zst', '7z', 'rar',
+    'docx', 'xlsx', 'pptx', 'odt', 'ods'
+})
+
+
+class Codec:
+    '''Define a class called Codec which creates streaming compressors for one Content-Encoding'''
+
+    def __init__(self, name, level=None):
+        if name == 'zstd' and zstandard is None:
+            raise ValueError("The zstd codec needs the zstandard package.")
+        if name not in ('gzip', 'zstd'):
+            raise ValueError(f"Unknown codec '{name}', expected 'gzip' or 'zstd'.")
+        self.name = name
+        self.level = level
+        # Content-Encoding values of the HTTP specification
+        self.content_encoding = name
+
+    def compressobj(self):
+        # Both compressors have compress(data) and flush() methods
+        if self.name == 'gzip':
+            # wbits=31 writes a gzip header and trailer around the deflate stream
+            return zlib.compressobj(6 if self.level is None else self.level, zlib.DEFLATED, 31)
+        return zstandard.ZstdCompressor(level=3 if self.level is None else self.level).compressobj()
+
+
+def get_codec(name, level=None):
+    '''Return the Codec called name, or the gzip Codec when zstd is asked for and zstandard is not installed'''
+
+    if name == 'zstd' and zstandard is None:
+        logger.warning("The zstandard package is not installed, using gzip instead of zstd.")
+        name = 'gzip'
+    return Codec(name, level)
+
+
+class CompressionStats:
+    '''Define a class called CompressionStats which counts the bytes read and sent by compressed uploads'''
+
+    def __init__(self):
+        self.files = 0
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self._lock = threading.Lock()
+
+    def add(self, raw_bytes, compressed_bytes):
+        with self._lock:
+            self.files += 1
+            self.raw_bytes += raw_bytes
+            self.compressed_bytes += compressed_bytes
+
+    @property
+    def saved_bytes(self):
+        return self.raw_bytes - self.compressed_bytes
+
+
+def compress_file(file_path, codec, stats=None, chunk_size=1024 * 1024):
+    '''Yield the content of the file compressed with the codec, reading it in chunks of chunk_size bytes.
+    The sizes before and after compression are added to stats once the whole file is compressed'''
+
+    compressor = codec.compressobj()
+    raw_bytes = compressed_bytes = 0
+    with open(file_path, 'rb') as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            raw_bytes += len(data)
+            output = compressor.compress(data)
+            if output:
+                compressed_bytes += len(output)
+                yield output
+    output = compressor.flush()
+    compressed_bytes += len(output)
+    if output:
+        yield output
+    if stats is not None:
+        stats.add(raw_bytes, compressed_bytes)
+
+
+def prefetch(iterable, depth=4):
+    '''Run the iterable on a background thread, at most depth items ahead of the consumer.
+
+    Used between compress_file and the uploader, the compression of the next chunks overlaps the
+    upload of the previous ones (zlib and zstandard release the GIL while compressing). Errors of
+    the iterable are raised in the consumer, and closing the generator stops the thread.
+    '''
+
+    items = queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+    done = object()
+
+    def put(entry):
+        # Wait for room in the queue, giving up when the consumer stopped iterating
+        while not stopped.is_set():
+            try:
+                items.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except Exception as e:
+            put((done, e))
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+
+    thread = threading.Thread(target=produce, name='compressor', daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stopped.set()
+        thread.join()
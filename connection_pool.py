@@ -0,0 +1,133 @@
+import threading
+from collections import namedtuple
+
+
+# Default number of pooled HTTP connections per cloud service, botocore keeps 10 by default
+DEFAULT_MAX_POOL_CONNECTIONS = 64
+
+
+class ConnectionStats(namedtuple('ConnectionStats', ['connections', 'requests'])):
+    '''Connections opened and requests sent through the HTTP connection pools of a cloud service.
+    Every request beyond the connections opened reused a kept-alive connection'''
+
+    @property
+    def reused(self):
+        return max(self.requests - self.connections, 0)
+
+    def __add__(self, other):
+        return ConnectionStats(self.connections + other.connections, self.requests + other.requests)
+
+
+def pool_manager_stats(pool_managers):
+    '''Sum the connections and requests counted by every urllib3 connection pool of the pool managers.
+    Pools evicted by a pool manager are no longer counted'''
+
+    connections = requests = 0
+    for pool_manager in pool_managers:
+        pools = pool_manager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is not None:
+                connections += pool.num_connections
+                requests += pool.num_requests
+    return ConnectionStats(connections, requests)
+
+
+def botocore_pool_managers(client):
+    # A botocore client sends its requests through the urllib3 pool managers of its endpoint's HTTP session
+    http_session = client._endpoint.http_session
+    return [http_session._manager] + list(http_session._proxy_managers.values())
+
+
+_pooled_adapter_class = None
+
+
+def pooled_adapter_class():
+    '''Return PooledHTTPAdapter, defining it on first use so requests is only imported once a GCS uploader needs it'''
+
+    global _pooled_adapter_class
+    if _pooled_adapter_class is None:
+        import requests.adapters
+
+        class PooledHTTPAdapter(requests.adapters.HTTPAdapter):
+            '''An HTTPAdapter passing the body of every request through body_filter, when set, before sending it.
+            The uploaders use it to pace request bodies with an UploadScheduler'''
+
+            body_filter = None
+
+            def send(self, request, *args, **kwargs):
+                if self.body_filter is not None:
+                    request.body = self.body_filter(request.body)
+                return super().send(request, *args, **kwargs)
+
+        _pooled_adapter_class = PooledHTTPAdapter
+    return _pooled_adapter_class
+
+
+def __getattr__(name):
+    # Keep connection_pool.PooledHTTPAdapter importable, defining it on first access
+    if name == 'PooledHTTPAdapter':
+        return pooled_adapter_class()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def mount_pooled_adapter(session, max_pool_connections):
+    '''Mount an HTTPAdapter keeping up to max_pool_connections connections per host on a requests session
+    and return it. requests keeps 10 by default, so more concurrent requests open and close extra connections'''
+
+    adapter = pooled_adapter_class()(pool_connections=4, pool_maxsize=max_pool_connections)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return adapter
+
+
+class ThreadLocalClients:
+    '''Define a class called ThreadLocalClients which gives every thread its own client, created on first use.
+
+    Clients whose HTTP session is not safe to share between threads, like the requests session of a
+    google-cloud-storage client, are created once per worker thread and then reused by all the uploads
+    of that thread, so their kept-alive connections are reused too. Every created value is also kept
+    in a list with its thread, so the connection pools of all threads can be counted. The values of
+    threads that exited are dropped from the list, after being passed to release when it is set.
+    '''
+
+    def __init__(self, factory, release=None):
+        self.factory = factory
+        self.release = release
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._values = []
+
+    def _prune(self):
+        # Drop the values of the threads that exited, called with the lock held
+        exited = [value for thread, value in self._values if not thread.is_alive()]
+        if exited:
+            self._values = [(thread, value) for thread, value in self._values if thread.is_alive()]
+            if self.release is not None:
+                for value in exited:
+                    self.release(value)
+
+    def set(self, value):
+        # Use an already created value for the calling thread
+        self._local.value = value
+        with self._lock:
+            self._prune()
+            self._values.append((threading.current_thread(), value))
+
+    def prune(self):
+        # Drop the values of the threads that exited
+        with self._lock:
+            self._prune()
+
+    def get(self):
+        value = getattr(self._local, 'value', None)
+        if value is None:
+            value = self.factory()
+            self.set(value)
+        return value
+
+    def values(self):
+        # Return the values of the threads still running
+        with self._lock:
+            self._prune()
+            return [value for thread, value in self._values]
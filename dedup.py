@@ -0,0 +1,156 @@
+import base64
+import hashlib
+import multiprocessing
+import os
+import threading
+from collections import namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor
+
+
+class FileDigest(namedtuple('FileDigest', ['size', 'md5', 'crc32c'])):
+    '''Size, MD5 and CRC32C digests of the content of a file, computed in one pass.
+    S3 takes the MD5 as ContentMD5 and the CRC32C as ChecksumCRC32C, GCS takes both as md5Hash and crc32c'''
+
+    @property
+    def md5_hex(self):
+        return self.md5.hex()
+
+    @property
+    def md5_base64(self):
+        return base64.b64encode(self.md5).decode('ascii')
+
+    @property
+    def crc32c_base64(self):
+        return base64.b64encode(self.crc32c).decode('ascii')
+
+
+def digest_file(file_path, chunk_size=1024 * 1024):
+    '''Return the FileDigest of the file, reading it once in chunks of chunk_size bytes fed to both checksums'''
+
+    # google_crc32c is imported on first use, it is only needed once deduplication is enabled
+    import google_crc32c
+
+    md5 = hashlib.md5()
+    crc32c = google_crc32c.Checksum()
+    size = 0
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+            crc32c.update(chunk)
+            size += len(chunk)
+    return FileDigest(size, md5.digest(), crc32c.digest())
+
+
+class FileHasher:
+    '''Define a class called FileHasher which computes the FileDigest of every file once per run.
+
+    Digests are cached by path, size and mtime, so a file routed to several cloud services, or
+    checked by incremental sync and then uploaded, is read once. Files of at least process_threshold
+    bytes are hashed in a pool of max_processes spawned processes, so hashing big files uses every core
+    instead of competing for the GIL with the upload threads. Smaller files are hashed on the calling thread.
+    '''
+
+    def __init__(self, process_threshold=64 * 1024 * 1024, max_processes=None):
+        self.process_threshold = process_threshold
+        self.max_processes = max_processes
+        self._executor = None
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def digest(self, file_path, size=None, mtime_ns=None):
+        '''Return the FileDigest of the file, waiting for it when another thread is already hashing the file'''
+
+        if size is None or mtime_ns is None:
+            stat = os.stat(file_path)
+            size, mtime_ns = stat.st_size, stat.st_mtime_ns
+
+        key = (file_path, size, mtime_ns)
+        compute = False
+        with self._lock:
+            future = self._cache.get(key)
+            if future is None:
+                if size >= self.process_threshold:
+                    if self._executor is None:
+                        # Spawn the processes instead of forking, so they never inherit the locks and connections of the upload threads
+                        self._executor = ProcessPoolExecutor(max_workers=self.max_processes, mp_context=multiprocessing.get_context('spawn'))
+                    future = self._executor.submit(digest_file, file_path)
+                else:
+                    future = Future()
+                    compute = True
+                self._cache[key] = future
+
+        if compute:
+            try:
+                future.set_result(digest_file(file_path))
+            except Exception as e:
+                future.set_exception(e)
+        return future.result()
+
+    def forget_finished(self):
+        # Drop the digests already computed, so a long watch does not keep one per file it ever saw.
+        # Files still being hashed stay, the threads waiting for them get their digest
+        with self._lock:
+            self._cache = {key: future for key, future in self._cache.items() if not future.done()}
+
+    def close(self):
+        # Stop the hashing processes
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+
+class DedupIndex:
+    '''Define a class called DedupIndex which makes every content go to a cloud service once per run.
+
+    The first file with a given digest claims it and is uploaded. Files with the same content claim
+    it after that and get a key holding it, waiting while that upload is in flight. Every key the
+    content is uploaded or copied to is remembered, so a duplicate under one of them is not sent at all.
+    When the upload failed, the next file with the same content uploads it instead.
+    '''
+
+    def __init__(self):
+        self._uploads = {}
+        self._lock = threading.Lock()
+
+    def claim(self, service, digest, object_key):
+        '''Return None when the caller must upload the content to the cloud service and then call release(),
+        otherwise a key holding the content already: object_key itself when the content was already sent there'''
+
+        key = (service, digest.size, digest.md5)
+        while True:
+            with self._lock:
+                upload = self._uploads.get(key)
+                if upload is None:
+                    self._uploads[key] = {'done': threading.Event(), 'keys': set()}
+                    return None
+            upload['done'].wait()
+            with self._lock:
+                if object_key in upload['keys']:
+                    return object_key
+                if upload['keys']:
+                    return next(iter(upload['keys']))
+
+    def release(self, service, digest, object_key, success):
+        # Publish the outcome of the upload, a failed upload can be claimed again
+        key = (service, digest.size, digest.md5)
+        with self._lock:
+            upload = self._uploads[key]
+            if success:
+                upload['keys'].add(object_key)
+            else:
+                del self._uploads[key]
+        upload['done'].set()
+
+    def add_copy(self, service, digest, object_key):
+        # Remember another key holding the content, e.g. after a server-side copy, unless the content was forgotten since
+        with self._lock:
+            upload = self._uploads.get((service, digest.size, digest.md5))
+            if upload is not None:
+                upload['keys'].add(object_key)
+
+    def forget_finished(self):
+        # Drop the contents whose upload finished, so a long watch does not keep one per file it ever uploaded.
+        # Uploads in flight stay, the duplicates waiting for them still get their key
+        with self._lock:
+            self._uploads = {key: upload for key, upload in self._uploads.items() if not upload['done'].is_set()}
@@ -0,0 +1,87 @@
+import logging
+import queue
+import threading
+from collections import namedtuple
+
+
+logger = logging.getLogger(__name__)
+
+
+# A file to read once and upload to several cloud services at the same time
+FanOutItem = namedtuple('FanOutItem', ['item', 'services'])
+
+# Marker put on the queue of every target once the whole file was read
+_END = object()
+
+
+def fan_out(file_path, targets, chunk_size=8 * 1024 * 1024, max_buffered=4, executors=None):
+    '''Read the file once and stream its chunks to every target in parallel. Return {name: success}.
+
+    targets maps a name to a function taking an iterable of chunks (e.g. a lambda calling
+    CloudUploader.upload_stream) and returning True or False. Every target runs on a thread of its
+    own, or of executors[name] when executors has an executor for it, so the clients cached by the
+    threads of a long-lived executor are reused from file to file. The executor must have a free
+    thread for every fan_out call running at the same time, a queued target would block the reader.
+    The targets receive the same immutable bytes objects, so the content is read and held once whatever the
+    number of targets. At most max_buffered chunks wait for each target: the file is read at the
+    pace of the slowest target still uploading, and a target that failed is dropped at once so it
+    never stalls the others.
+    '''
+
+    queues = {name: queue.Queue(maxsize=max_buffered) for name in targets}
+    finished = {name: threading.Event() for name in targets}
+    results = {}
+
+    def chunks(name):
+        while True:
+            chunk = queues[name].get()
+            if chunk is _END:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+
+    def run(name, upload):
+        try:
+            results[name] = upload(chunks(name)) is True
+        except Exception as e:
+            logger.error("Failed to upload '%s' to %s. Error: %s", file_path, name, e)
+            results[name] = False
+        finally:
+            finished[name].set()
+
+    def put(name, item):
+        # Wait for room in the queue of the target, giving up when it finished or failed
+        while not finished[name].is_set():
+            try:
+                queues[name].put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    executors = executors or {}
+    threads = [threading.Thread(target=run, args=(name, upload), name=f"fan-out-{name}", daemon=True)
+               for name, upload in targets.items() if name not in executors]
+    for thread in threads:
+        thread.start()
+    futures = [executors[name].submit(run, name, upload) for name, upload in targets.items() if name in executors]
+
+    end = _END
+    try:
+        with open(file_path, 'rb') as f:
+            while not all(event.is_set() for event in finished.values()):
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                for name in targets:
+                    put(name, chunk)
+    except Exception as e:
+        # A read error fails every target
+        end = e
+    for name in targets:
+        put(name, end)
+    for thread in threads:
+        thread.join()
+    for future in futures:
+        future.result()
+    return results
@@ -1,15 +1,99 @@
+import argparse
+import asyncio
+import base64
 import csv
+import itertools
+import logging
+import multiprocessing
 import os
 import json
+import mimetypes
+import mmap
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from dataclasses import dataclass
 from abc import ABC, abstractmethod
-import boto3
-from google.cloud import storage
-import google.api_core.exceptions
+from upload_manifest import UploadManifest, file_hash
+from remote_index import RemoteIndexCache
+from multipart_upload import MAX_PARTS, FilePart, compute_part_size, iter_parts, read_chunks
+from upload_checkpoint import CheckpointStore
+from upload_queue import LEASED, PENDING, UploadQueue, default_worker_id
+from upload_scanner import DirectoryScanner, ExtensionRouter, WorkItem, scan_directory_entries
+from compression import COMPRESSED_EXTENSIONS, CompressionStats, compress_file, get_codec, prefetch
+from connection_pool import DEFAULT_MAX_POOL_CONNECTIONS, ConnectionStats, ThreadLocalClients, botocore_pool_managers, mount_pooled_adapter, pool_manager_stats
+from dedup import DedupIndex, FileHasher
+from fanout import FanOutItem, fan_out
+from small_file_bundler import ShardBatch, ShardBatcher, TarShard
+from upload_metrics import NULL_METRICS, metrics_from_config
+from upload_retry import FATAL, AdaptiveRateLimiter, HTTPStatusError, RetryPolicy, classify_gcs_error, classify_s3_error
+from upload_scheduler import scheduler_from_config
+from upload_watcher import DirectoryWatcher
 
 
+logger = logging.getLogger(__name__)
+
+
+__version__ = '0.2'
+
+# The cloud SDKs take most of the start-up time, so they are imported by the first uploader needing them
+# with load_aws_sdk and load_gcs_sdk. Until then these module globals are None
+boto3 = None
+botocore = None
+storage = None
+transfer_manager = None
+google = None
+
+
+def load_aws_sdk():
+    '''Import boto3 and botocore on first use'''
+
+    global boto3, botocore
+    if boto3 is None:
+        import boto3.s3.transfer
+    if botocore is None:
+        import botocore.config
+        import botocore.exceptions
+
+
+def load_gcs_sdk():
+    '''Import google-cloud-storage and google-api-core on first use'''
+
+    global storage, transfer_manager, google
+    if storage is None:
+        from google.cloud import storage
+    if transfer_manager is None:
+        from google.cloud.storage import transfer_manager
+    if google is None:
+        import google.api_core.exceptions
+
+
+
+@dataclass
+class UploadResult:
+    '''Outcome of uploading one file: whether it succeeded, how many bytes were sent,
+    how many seconds the transfer took and the exception if it failed'''
+    file_path: str
+    key: str
+    success: bool
+    bytes: int = 0
+    elapsed: float = 0.0
+    error: Exception = None
+
 
 class CloudUploader(ABC):
 
+    # Retry policy and optional adaptive rate limiter applied to the requests of the uploader,
+    # FileUploader replaces them with the settings of the 'retry' section of the config file
+    retry_policy = RetryPolicy()
+    rate_limiter = None
+
+    # UploadScheduler pacing the request bodies of the uploader and the name of its cloud service there, set by set_scheduler
+    scheduler = None
+    scheduler_service = None
+
     '''Define an abstract method called __init__ which takes in the arguments bucket_name and credentials_file
     .This method will be overridden in the subclass and will be used to initialize the cloud uploader
     '''
@@ -18,32 +102,159 @@ class CloudUploader(ABC):
         pass
     
     '''Define an abstract method called upload_file which takes in the argument file_path.
-    This method will be overridden in the subclass and will be used to upload the specified file to the cloud
+    This method will be overridden in the subclass and will be used to upload the specified file to the cloud.
+    The optional FileDigest of the file is sent for the cloud service to check, so the client does not read the file to checksum it
+    '''
+
+    @abstractmethod
+    def upload_file(self, file_path, digest=None):
+        pass
+
+    '''Define a method called upload_file_async which takes in the argument file_path and an optional executor.
+    It uploads the specified file without blocking the running event loop. boto3 and google-cloud-storage have
+    no asyncio clients, so by default the blocking upload_file call runs on a thread of the given executor.
+    A subclass with a native asyncio client can override it
+    '''
+
+    async def upload_file_async(self, file_path, executor=None):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, self.upload_file, file_path)
+
+    '''Define an abstract method called list_objects which takes in the argument prefix.
+    It yields a (key, size, md5) tuple for every object in the bucket whose key starts with prefix,
+    using as few listing calls as the cloud service allows. md5 is the hex digest or None when unknown
+    '''
+
+    @abstractmethod
+    def list_objects(self, prefix=''):
+        pass
+
+    '''Define an abstract method called upload_stream which takes in the arguments key and stream.
+    It uploads everything read from stream, a file object (pipe, stdin, socket) or an iterable of bytes
+    such as a generator, to the key in the bucket without writing it to disk. Memory use is bounded
+    by the part size, whatever the length of the stream
     '''
 
     @abstractmethod
-    def upload_file(self, file_path):
+    def upload_stream(self, key, stream, part_size=None, max_workers=None, content_encoding=None, content_type=None):
         pass
+
+    '''Define a method called classify_error which tells whether an exception raised by the cloud service
+    is worth retrying: it returns 'throttled', 'retryable' or 'fatal'. Subclasses know the errors of their client
+    '''
+
+    def classify_error(self, error):
+        return FATAL
+
+    '''Define a method called set_retry_policy which replaces the retry policy and the rate limiter of the uploader
+    '''
+
+    def set_retry_policy(self, retry_policy, rate_limiter=None):
+        self.retry_policy = retry_policy
+        self.rate_limiter = rate_limiter
+
+    '''Define a method called call_with_retry which calls func(*args, **kwargs) with the retry policy,
+    backing off on retryable errors and slowing down the rate limiter when the cloud service throttles
+    '''
+
+    def call_with_retry(self, func, *args, **kwargs):
+        return self.retry_policy.call(lambda: func(*args, **kwargs), self.classify_error, self.rate_limiter)
+
+    '''Define a method called connection_stats which returns a ConnectionStats counting the connections
+    opened and the requests sent by the uploader, or None when the uploader does not track them
+    '''
+
+    def connection_stats(self):
+        return None
+
+    '''Define a method called copy_object which copies the object source_key to key inside the bucket
+    on the cloud service's side, without uploading the content again. It returns True or False
+    '''
+
+    def copy_object(self, source_key, key):
+        raise NotImplementedError(f"{type(self).__name__} does not support server-side copies.")
+
+    '''Define a method called release_idle_clients which closes the clients the uploader keeps for threads
+    that exited. Uploaders sharing one client between all threads have nothing to release
+    '''
+
+    def release_idle_clients(self):
+        pass
+
+    '''Define a method called set_scheduler which makes the uploader send its request bodies through the bandwidth
+    caps of an UploadScheduler for the given cloud service. Subclasses hook throttle_body into their HTTP client
+    '''
+
+    def set_scheduler(self, scheduler, service):
+        self.scheduler = scheduler
+        self.scheduler_service = service
+
+    '''Define a method called throttle_body which returns a request body paced by the scheduler, or the body itself
+    '''
+
+    def throttle_body(self, body):
+        if self.scheduler is None:
+            return body
+        return self.scheduler.throttle(self.scheduler_service, body)
     
     
     
 
+class _TransferTimer:
+    '''Subscriber for s3transfer futures that records when the bytes of a transfer start flowing and when it is done'''
+
+    def __init__(self):
+        self.started = None
+        self.finished = None
+
+    def on_queued(self, future, **kwargs):
+        pass
+
+    def on_progress(self, future, bytes_transferred, **kwargs):
+        if self.started is None:
+            self.started = time.monotonic()
+
+    def on_done(self, future, **kwargs):
+        self.finished = time.monotonic()
+
+    @property
+    def elapsed(self):
+        if self.started is None or self.finished is None:
+            return 0.0
+        return self.finished - self.started
+
+
 class S3Uploader(CloudUploader):
     '''Define a subclass of CloudUploader called S3Uploader'''
 
+    # Transfer settings of the shared TransferManager used for batch uploads: files up to the threshold
+    # are sent with a single PUT, larger files in parts of MULTIPART_CHUNKSIZE bytes
+    MULTIPART_THRESHOLD = 16 * 1024 * 1024
+    MULTIPART_CHUNKSIZE = 16 * 1024 * 1024
+    MAX_CONCURRENCY = 10
+
     
-    def __init__(self, bucket_name, credentials_file):
+    def __init__(self, bucket_name, credentials_file, max_pool_connections=DEFAULT_MAX_POOL_CONNECTIONS):
         '''Define the constructor method which takes in the arguments bucket_name and credentials_file'''
         
-        # Initialize the instance variables bucket_name and s3
+        # Initialize the instance variables bucket_name and s3. botocore clients are thread-safe, so every
+        # worker thread shares this client and its pool of max_pool_connections kept-alive connections.
+        # botocore sends every request once, the RetryPolicy of the uploader is the only one retrying them
+        load_aws_sdk()
         self.bucket_name = bucket_name
         self.access_key_id, self.secret_access_key = self.read_credentials(credentials_file)
         self.s3 = boto3.client(
             's3',
             aws_access_key_id=self.access_key_id,
-            aws_secret_access_key=self.secret_access_key
+            aws_secret_access_key=self.secret_access_key,
+            config=botocore.config.Config(max_pool_connections=max_pool_connections, tcp_keepalive=True,
+                                          retries={'total_max_attempts': 1})
         )
 
+        # The TransferManager for batch uploads is created on first use and then shared by all batches
+        self._transfer_manager = None
+        self._transfer_manager_lock = threading.Lock()
+
     
     def read_credentials(self, credentials_file):
         '''Define a method called read_credentials which takes in the argument credentials_file'''
@@ -70,7 +281,7 @@ class S3Uploader(CloudUploader):
             
             
     
-    def upload_file(self, file_path):
+    def upload_file(self, file_path, digest=None):
         '''Define a method called upload_file that takes in the argument file_path 
         and uploads the specified file to AWS S3 bucket'''
 
@@ -78,74 +289,425 @@ class S3Uploader(CloudUploader):
         s3_key = os.path.basename(file_path)
 
         try:
-            # Use the AWS S3 client to upload the file to the specified bucket with the given s3_key
-            self.s3.upload_file(file_path, self.bucket_name, s3_key)
-            print(f"File '{s3_key}' uploaded successfully to S3 bucket: {self.bucket_name}")
+            # Use the AWS S3 client to upload the file to the specified bucket with the given s3_key,
+            # retrying throttling (SlowDown) and transient errors with backoff
+            if digest is not None and digest.size <= self.MULTIPART_THRESHOLD:
+                # Send the known digests with a single PUT, S3 checks them and botocore does not read the file to checksum it
+                with open(file_path, 'rb') as body:
+                    def put():
+                        body.seek(0)
+                        return self.s3.put_object(Bucket=self.bucket_name, Key=s3_key, Body=body,
+                                                  ContentMD5=digest.md5_base64, ChecksumCRC32C=digest.crc32c_base64)
+                    self.call_with_retry(put)
+            else:
+                self.call_with_retry(self.s3.upload_file, file_path, self.bucket_name, s3_key)
+            logger.info("File '%s' uploaded successfully to S3 bucket: %s", s3_key, self.bucket_name)
+            return True
 
+        # Log an error if the file fails to upload after the retries, or with a fatal
+        # error such as a missing bucket or invalid credentials (S3UploadFailedError or ClientError)
         except Exception as e:
-            # Print error message to console if file fails to upload
-            print(f"Failed to upload '{s3_key}' to S3 bucket: {self.bucket_name}. Error: {e}")
+            logger.error("Failed to upload '%s' to S3 bucket: %s. Error: %s", s3_key, self.bucket_name, e)
+            return False
 
 
-        # Catch the boto3 S3UploadFailedError exception if it occurs
-        except boto3.exceptions.S3UploadFailedError as e:
-            '''if bucket error, credentials errors, raise an exception'''
-            pass
-        
-        
-    def upload_files_single_call(self, file_path_list):
-        '''still in progress, not to be used'''
+    def classify_error(self, error):
+        return classify_s3_error(error)
+
+
+    def copy_object(self, source_key, key):
+        '''Copy the object source_key to key with CopyObject, S3 copies the bytes without them being sent again'''
 
         try:
-            objects = []
-            # iterate through the list of file paths to upload and create a dictionary with the 'Key' and 'SourceFile' values
-            for file_path in file_path_list:
-                s3_key = file_path.split('/')[-1]
-                objects.append({'Key': s3_key, 'SourceFile': file_path})
-
-            # upload each file to the S3 bucket
-            for obj in objects:
-                self.s3.upload_file(
-                    obj['SourceFile'], # file path to upload
-                    self.bucket_name, # bucket name to upload to
-                    obj['Key'], # key (name) of the uploaded file in the bucket
-                    Config=boto3.s3.transfer.TransferConfig(multipart_threshold=1024 * 25, max_concurrency=10,
-                                                             multipart_chunksize=1024 * 25, use_threads=True)
-                )
+            self.call_with_retry(self.s3.copy_object, Bucket=self.bucket_name, Key=key,
+                                 CopySource={'Bucket': self.bucket_name, 'Key': source_key})
+            logger.info("File '%s' copied from '%s' in S3 bucket: %s", key, source_key, self.bucket_name)
+            return True
+        except Exception as e:
+            logger.error("Failed to copy '%s' to '%s' in S3 bucket: %s. Error: %s", source_key, key, self.bucket_name, e)
+            return False
+
+
+    def list_objects(self, prefix=''):
+        '''List the bucket with list_objects_v2, which returns up to 1000 keys per call'''
+
+        paginator = self.s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                # The ETag is the MD5 of the content except for multipart uploads, whose ETag contains a '-'
+                etag = obj.get('ETag', '').strip('"')
+                yield obj['Key'], obj['Size'], etag if etag and '-' not in etag else None
 
-            # print success message with the number of files uploaded and the name of the bucket
-            print(f"{len(objects)} files uploaded successfully to S3 bucket:", self.bucket_name)
 
-        # handle any exceptions that occur during the file upload process
+    def upload_large_file(self, file_path, part_size=None, max_workers=None, checkpoints=None):
+        '''Upload a large file to the S3 bucket with a multipart upload whose parts are uploaded
+        concurrently. Each part is read from a memory mapping of the file without copying it up front.
+
+        With a CheckpointStore the upload ID and the ETag of every completed part are saved as the upload
+        progresses, and an interrupted upload of the same file is resumed from its completed parts.
+        Without one, the multipart upload is aborted when a part fails, so no orphaned parts are left behind'''
+
+        s3_key = os.path.basename(file_path)
+        stat = os.stat(file_path)
+        file_size = stat.st_size
+        if file_size == 0:
+            return self.upload_file(file_path)
+
+        upload_id = None
+        checkpoint = None
+        try:
+            if checkpoints is not None:
+                checkpoint = self._resume_checkpoint(checkpoints, s3_key, stat)
+
+            if checkpoint is not None:
+                # Continue the interrupted upload with the part size it was started with
+                upload_id, part_size, completed = checkpoint.upload_id, checkpoint.part_size, checkpoint.parts
+                logger.info("Resuming upload of '%s' with %s parts already uploaded.", s3_key, len(completed))
+            else:
+                part_size = compute_part_size(file_size, part_size or self.MULTIPART_CHUNKSIZE)
+                upload_id = self.call_with_retry(self.s3.create_multipart_upload, Bucket=self.bucket_name, Key=s3_key)['UploadId']
+                completed = {}
+                if checkpoints is not None:
+                    checkpoint = checkpoints.create('s3', self.bucket_name, s3_key, upload_id, part_size, file_size, stat.st_mtime_ns)
+
+            with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+                view = memoryview(mapping)
+                try:
+                    parts = self._upload_parts(s3_key, upload_id, view, file_size, part_size,
+                                               max_workers or self.MAX_CONCURRENCY, completed, checkpoint)
+                finally:
+                    view.release()
+
+            self.call_with_retry(
+                self.s3.complete_multipart_upload,
+                Bucket=self.bucket_name,
+                Key=s3_key,
+                UploadId=upload_id,
+                MultipartUpload={'Parts': parts}
+            )
+            if checkpoint is not None:
+                checkpoints.delete(checkpoint)
+            logger.info("File '%s' uploaded successfully to S3 bucket: %s", s3_key, self.bucket_name)
+            return True
+
         except Exception as e:
-            print("Failed to upload files to S3 bucket:", self.bucket_name, "Error:", e)
+            if checkpoint is not None:
+                # Keep the multipart upload and its checkpoint so the next run resumes it
+                logger.info("Upload of '%s' interrupted, the next run resumes it from its checkpoint.", s3_key)
+            elif upload_id is not None:
+                # Abort the multipart upload so S3 does not keep (and bill) the parts already uploaded
+                self._abort_multipart_upload(s3_key, upload_id)
+            logger.error("Failed to upload large file '%s' to S3 bucket: %s. Error: %s", s3_key, self.bucket_name, e)
+            return False
 
 
+    def upload_stream(self, key, stream, part_size=None, max_workers=None, content_encoding=None, content_type=None):
+        '''Upload a stream of unknown length to the S3 bucket. The stream is cut into parts of part_size
+        bytes uploaded concurrently, with at most max_workers parts in memory and in flight. A stream
+        that fits in one part is sent with a single PUT. content_encoding and content_type set the
+        Content-Encoding and Content-Type of the object'''
+
+        part_size = part_size or self.MULTIPART_CHUNKSIZE
+        max_workers = max_workers or self.MAX_CONCURRENCY
+        chunks = read_chunks(stream, part_size)
+        upload_id = None
+        headers = {}
+        if content_encoding:
+            headers['ContentEncoding'] = content_encoding
+        if content_type:
+            headers['ContentType'] = content_type
+
+        try:
+            # Look at the first two chunks to decide between a single PUT and a multipart upload
+            first = next(chunks, bytearray())
+            second = next(chunks, None)
+            if second is None:
+                self.call_with_retry(self.s3.put_object, Bucket=self.bucket_name, Key=key, Body=first, **headers)
+                logger.info("Stream '%s' uploaded successfully to S3 bucket: %s", key, self.bucket_name)
+                return True
+
+            upload_id = self.call_with_retry(self.s3.create_multipart_upload, Bucket=self.bucket_name, Key=key, **headers)['UploadId']
+            # Hand the first two chunks over to the parts, so they are freed as soon as they are uploaded
+            chunks = itertools.chain([first, second], chunks)
+            del first, second
+            parts = self._upload_stream_parts(key, upload_id, chunks, max_workers)
+            self.call_with_retry(
+                self.s3.complete_multipart_upload,
+                Bucket=self.bucket_name,
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload={'Parts': parts}
+            )
+            logger.info("Stream '%s' uploaded successfully to S3 bucket: %s", key, self.bucket_name)
+            return True
+
+        except Exception as e:
+            if upload_id is not None:
+                self._abort_multipart_upload(key, upload_id)
+            logger.error("Failed to upload stream '%s' to S3 bucket: %s. Error: %s", key, self.bucket_name, e)
+            return False
+
+
+    def _upload_stream_parts(self, key, upload_id, chunks, max_workers):
+        # Upload the chunks as parts on a pool of threads. A slot is taken before the next chunk is read
+        # from the stream, so at most max_workers chunks are in memory. botocore sends the chunk as is, without a copy
+        slots = threading.BoundedSemaphore(max_workers)
+        errors = []
+
+        def upload_part(part_number, chunk):
+            try:
+                response = self.call_with_retry(self.s3.upload_part, Body=chunk, Bucket=self.bucket_name, Key=key,
+                                                PartNumber=part_number, UploadId=upload_id)
+                return {'ETag': response['ETag'], 'PartNumber': part_number}
+            except Exception as e:
+                errors.append(e)
+                raise
+            finally:
+                slots.release()
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = []
+            part_number = 0
+            while True:
+                slots.acquire()
+                # Stop reading the stream as soon as a part failed
+                chunk = None if errors else next(chunks, None)
+                if chunk is None:
+                    slots.release()
+                    break
+                part_number += 1
+                if part_number > MAX_PARTS:
+                    slots.release()
+                    raise Exception(f"Stream needs more than {MAX_PARTS} parts, use a larger part size.")
+                futures.append(executor.submit(upload_part, part_number, chunk))
+                del chunk
+
+        if errors:
+            raise errors[0]
+        return [future.result() for future in futures]
+
+
+    def _abort_multipart_upload(self, s3_key, upload_id):
+        try:
+            self.s3.abort_multipart_upload(Bucket=self.bucket_name, Key=s3_key, UploadId=upload_id)
+        except Exception as e:
+            logger.error("Failed to abort multipart upload of '%s'. Error: %s", s3_key, e)
+
+
+    def _resume_checkpoint(self, checkpoints, s3_key, stat):
+        # Return the checkpoint of an interrupted upload of this exact file, with its completed parts
+        # confirmed by list_parts, or None when there is none or it is stale
+        checkpoint = checkpoints.load('s3', self.bucket_name, s3_key)
+        if checkpoint is None:
+            return None
+
+        if not checkpoint.matches(stat.st_size, stat.st_mtime_ns):
+            # The file changed since the upload started, its parts are useless
+            self._abort_multipart_upload(s3_key, checkpoint.upload_id)
+            checkpoints.delete(checkpoint)
+            return None
+
+        try:
+            uploaded = {}
+            paginator = self.s3.get_paginator('list_parts')
+            for page in paginator.paginate(Bucket=self.bucket_name, Key=s3_key, UploadId=checkpoint.upload_id):
+                for part in page.get('Parts', []):
+                    uploaded[part['PartNumber']] = part['ETag']
+        except botocore.exceptions.ClientError as e:
+            # The multipart upload was completed, aborted or expired
+            if e.response.get('Error', {}).get('Code') == 'NoSuchUpload':
+                checkpoints.delete(checkpoint)
+                return None
+            raise
+
+        # Only keep the parts S3 still holds with the same ETag
+        checkpoint.set_parts({number: etag for number, etag in checkpoint.parts.items() if uploaded.get(number) == etag})
+        return checkpoint
+
+
+    def _upload_parts(self, s3_key, upload_id, view, file_size, part_size, max_workers, completed=None, checkpoint=None):
+        # Upload every part not in completed on a pool of threads and return all parts sorted by part number
+        completed = completed or {}
+
+        def upload_part(part_number, start, end):
+            part = FilePart(view, start, end)
+
+            def send():
+                # Every attempt sends the part from its first byte
+                part.seek(0)
+                return self.s3.upload_part(
+                    Body=part,
+                    Bucket=self.bucket_name,
+                    Key=s3_key,
+                    PartNumber=part_number,
+                    UploadId=upload_id,
+                    ContentLength=end - start
+                )
+
+            try:
+                response = self.call_with_retry(send)
+            finally:
+                part.release()
+            if checkpoint is not None:
+                checkpoint.add_part(part_number, response['ETag'])
+            return {'ETag': response['ETag'], 'PartNumber': part_number}
+
+        parts = [{'ETag': etag, 'PartNumber': number} for number, etag in completed.items()]
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(upload_part, *part) for part in iter_parts(file_size, part_size) if part[0] not in completed]
+            # Stop at the first failed part instead of uploading the rest of the file
+            done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+            for future in done:
+                if future.exception() is not None:
+                    for pending in not_done:
+                        pending.cancel()
+                    raise future.exception()
+            parts.extend(future.result() for future in futures)
+        return sorted(parts, key=lambda part: part['PartNumber'])
+
+
+    def get_transfer_manager(self):
+        '''Return the TransferManager shared by all batch uploads, creating it on first use'''
+
+        with self._transfer_manager_lock:
+            if self._transfer_manager is None:
+                config = boto3.s3.transfer.TransferConfig(
+                    multipart_threshold=self.MULTIPART_THRESHOLD,
+                    multipart_chunksize=self.MULTIPART_CHUNKSIZE,
+                    max_concurrency=self.MAX_CONCURRENCY,
+                    use_threads=True
+                )
+                self._transfer_manager = boto3.s3.transfer.create_transfer_manager(self.s3, config)
+            return self._transfer_manager
+
+
+    def upload_files_single_call(self, file_path_list):
+        '''Upload a batch of files to the S3 bucket through the shared TransferManager and return
+        an UploadResult for every file, in the order of file_path_list'''
+
+        manager = self.get_transfer_manager()
+
+        # Submit the whole batch at once, the TransferManager uploads the files on its own threads
+        # and blocks the submission while its queue is full
+        transfers = []
+        for file_path in file_path_list:
+            s3_key = os.path.basename(file_path)
+            timer = _TransferTimer()
+            try:
+                future = manager.upload(file_path, self.bucket_name, s3_key, subscribers=[timer])
+            except Exception as e:
+                future = e
+            transfers.append((file_path, s3_key, timer, future))
+
+        # Wait for every transfer and collect its outcome
+        results = []
+        for file_path, s3_key, timer, future in transfers:
+            if isinstance(future, Exception):
+                results.append(UploadResult(file_path, s3_key, False, error=future))
+                continue
+            try:
+                future.result()
+                results.append(UploadResult(file_path, s3_key, True, future.meta.size or 0, timer.elapsed))
+            except Exception as e:
+                results.append(UploadResult(file_path, s3_key, False, elapsed=timer.elapsed, error=e))
+        return results
+
+
+    def connection_stats(self):
+        return pool_manager_stats(botocore_pool_managers(self.s3))
+
+
+    def set_scheduler(self, scheduler, service):
+        '''Pace the body of every request of the client, sent after it is signed, with the scheduler'''
+
+        super().set_scheduler(scheduler, service)
+        self.s3.meta.events.register('before-send.s3', self._throttle_request, unique_id='upload-scheduler')
+
+
+    def _throttle_request(self, request, **kwargs):
+        # botocore sends the request on returning None; retries reuse the paced body after seeking it back
+        request.body = self.throttle_body(request.body)
+
+
+    def close(self):
+        '''Wait for pending batch uploads and release the threads of the shared TransferManager'''
+
+        with self._transfer_manager_lock:
+            if self._transfer_manager is not None:
+                self._transfer_manager.shutdown()
+                self._transfer_manager = None
 
-        
 
 class GCSUploader(CloudUploader):
     '''Define a subclass of CloudUploader called GCSUploader'''
+
+    # Default part size and number of threads of large file uploads
+    MULTIPART_CHUNKSIZE = 16 * 1024 * 1024
+    MAX_CONCURRENCY = 8
     
     # Define the constructor method that initializes the GCSUploader object with the specified bucket_name and credentials_file
-    def __init__(self, bucket_name, credentials_file):
+    def __init__(self, bucket_name, credentials_file, max_pool_connections=DEFAULT_MAX_POOL_CONNECTIONS):
+        load_gcs_sdk()
         self.bucket_name = bucket_name
+        self.max_pool_connections = max_pool_connections
         
         # Try to read the Google Cloud Storage credentials from the given credentials_file
         try:
             self.gcs = storage.Client.from_service_account_json(credentials_file)
-            # Print success message to console
-            print("Successfully read credentials.")
+            # Log at debug level that the credentials were read
+            logger.debug("Successfully read credentials.")
             
         # If there's an error reading the credentials, raise an exception with the error message
         except Exception as e:
             raise Exception(f"Failed to read credentials file: {e}")
+
+        # The requests session of a GCS client is not safe to share between threads, so every worker thread
+        # gets its own client with the same credentials and a cached handle to the bucket. The calling thread uses self.gcs.
+        # The clients of threads that exited are closed, their connections still count in connection_stats
+        self._released_stats = ConnectionStats(0, 0)
+        self._clients = ThreadLocalClients(self._create_client, self._release_client)
+        self._clients.set(self._pooled_client(self.gcs))
+
+    # Define a method called _pooled_client which mounts a connection pool of max_pool_connections on the client's
+    # session and returns the client with its bucket handle and the adapter counting its connections
+    def _pooled_client(self, client):
+        adapter = mount_pooled_adapter(client._http, self.max_pool_connections)
+        # Request bodies go through the scheduler once set_scheduler was called
+        adapter.body_filter = self.throttle_body
+        return client, client.bucket(self.bucket_name), adapter
+
+    # Define a method called _create_client which creates the GCS client of a worker thread
+    def _create_client(self):
+        return self._pooled_client(storage.Client(project=self.gcs.project, credentials=self.gcs._credentials))
+
+    # Define a method called _release_client which closes the GCS client of a thread that exited, keeping its connection counts
+    def _release_client(self, value):
+        client, bucket, adapter = value
+        self._released_stats += pool_manager_stats([adapter.poolmanager])
+        client._http.close()
+
+    # Define a method called get_client which returns the GCS client of the calling thread
+    def get_client(self):
+        return self._clients.get()[0]
+
+    # Define a method called get_bucket which returns the cached bucket handle of the calling thread
+    def get_bucket(self):
+        return self._clients.get()[1]
+
+    # Define a method called release_idle_clients which closes the GCS clients of the threads that exited
+    def release_idle_clients(self):
+        self._clients.prune()
+
+    # Define a method called connection_stats which counts the connections of the clients of every thread
+    def connection_stats(self):
+        stats = pool_manager_stats(adapter.poolmanager for client, bucket, adapter in self._clients.values())
+        return stats + self._released_stats
             
     # Define a method called upload_file which uploads the specified file to the GCS bucket
-    def upload_file(self, file_path):
+    def upload_file(self, file_path, digest=None):
         
-        # Get the GCS bucket from the GCS client
-        bucket = self.gcs.bucket(self.bucket_name)
+        # Get the cached GCS bucket handle of this thread
+        bucket = self.get_bucket()
         
         # Get the base name of the file from the file path
         file_name=os.path.basename(file_path)
@@ -154,26 +716,258 @@ class GCSUploader(CloudUploader):
         blob = bucket.blob(file_name)
         
         try:
-            # Upload the file to GCS using the GCS blob
-            blob.upload_from_filename(file_path)
-            # Print success message to console
-            print(f"File {file_name} uploaded successfully to GCS bucket : {self.bucket_name}")
+            # Upload the file to GCS using the GCS blob, retrying throttling (429, 503) and transient errors with backoff
+            if digest is not None:
+                # Send the known digests as object metadata, GCS checks them and the client does not read the file to checksum it
+                blob.md5_hash = digest.md5_base64
+                blob.crc32c = digest.crc32c_base64
+                self.call_with_retry(blob.upload_from_filename, file_path, checksum=None)
+            else:
+                self.call_with_retry(blob.upload_from_filename, file_path)
+            # Log the successful upload
+            logger.info("File %s uploaded successfully to GCS bucket : %s", file_name, self.bucket_name)
+            return True
             
         # If the file is not found, raise an exception with an error message
         except google.api_core.exceptions.NotFound as e:
             raise Exception (f"Not found error.Stopping upload process")
             
-        # If there's an error uploading the file, print the error message to console
+        # If there's an error uploading the file, log the error message
+        except Exception as e:
+            logger.error("Failed to upload file: %s", e)
+            return False
+
+    # Define a method called upload_large_file which uploads a large file with an XML multipart upload,
+    # uploading its parts concurrently. The multipart upload is cancelled when a part fails.
+    # With a CheckpointStore the file is uploaded through a resumable upload session instead, whose
+    # session URI is saved so an interrupted upload of the same file is resumed where it stopped
+    def upload_large_file(self, file_path, part_size=None, max_workers=None, checkpoints=None):
+        file_name = os.path.basename(file_path)
+        file_size = os.path.getsize(file_path)
+
+        try:
+            blob = self.get_bucket().blob(file_name)
+            # A retried resumable upload continues from the bytes GCS already committed
+            if checkpoints is not None:
+                self.call_with_retry(self._upload_resumable, file_path, blob, part_size, checkpoints)
+            else:
+                self.call_with_retry(
+                    transfer_manager.upload_chunks_concurrently,
+                    file_path,
+                    blob,
+                    chunk_size=compute_part_size(file_size, part_size or self.MULTIPART_CHUNKSIZE),
+                    max_workers=max_workers or self.MAX_CONCURRENCY,
+                    worker_type=transfer_manager.THREAD
+                )
+            logger.info("File %s uploaded successfully to GCS bucket : %s", file_name, self.bucket_name)
+            return True
+
+        except google.api_core.exceptions.NotFound as e:
+            raise Exception(f"Not found error.Stopping upload process")
+
         except Exception as e:
-            print(f"Failed to upload file: {e}")
+            logger.error("Failed to upload large file '%s' to GCS bucket: %s. Error: %s", file_name, self.bucket_name, e)
+            return False
+
+    # Define a method called upload_stream which uploads a stream of unknown length through a resumable
+    # upload session. The BlobWriter sends one chunk of part_size bytes at a time, so memory use is bounded
+    def upload_stream(self, key, stream, part_size=None, max_workers=None, content_encoding=None, content_type=None):
+        try:
+            blob = self.get_bucket().blob(key)
+            # The metadata of the blob is sent when the resumable upload session starts
+            if content_encoding:
+                blob.content_encoding = content_encoding
+            if content_type:
+                blob.content_type = content_type
+            with blob.open('wb', chunk_size=part_size or self.MULTIPART_CHUNKSIZE) as writer:
+                for chunk in read_chunks(stream, part_size or self.MULTIPART_CHUNKSIZE):
+                    writer.write(chunk)
+            logger.info("Stream %s uploaded successfully to GCS bucket : %s", key, self.bucket_name)
+            return True
+
+        except Exception as e:
+            logger.error("Failed to upload stream '%s' to GCS bucket: %s. Error: %s", key, self.bucket_name, e)
+            return False
+
+    # Define a method called _upload_resumable which uploads the file in chunks through a resumable upload session
+    def _upload_resumable(self, file_path, blob, part_size, checkpoints):
+        stat = os.stat(file_path)
+        file_size = stat.st_size
+        transport = self.get_client()._http
+
+        # Resume the session of the checkpoint when it belongs to this exact file and is still alive
+        checkpoint = checkpoints.load('gcs', self.bucket_name, blob.name)
+        offset = None
+        if checkpoint is not None and checkpoint.matches(file_size, stat.st_mtime_ns):
+            offset = self._query_resumable_offset(transport, checkpoint.upload_id, file_size)
+        if offset is None:
+            if checkpoint is not None:
+                checkpoints.delete(checkpoint)
+            # Chunks of a resumable upload must be multiples of 256 KB, compute_part_size returns whole MB
+            chunk_size = compute_part_size(file_size, part_size or self.MULTIPART_CHUNKSIZE)
+            session_uri = blob.create_resumable_upload_session(size=file_size)
+            checkpoint = checkpoints.create('gcs', self.bucket_name, blob.name, session_uri, chunk_size, file_size, stat.st_mtime_ns)
+            offset = 0
+        else:
+            logger.info("Resuming upload of '%s' from byte %s.", blob.name, offset)
+
+        with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+            view = memoryview(mapping)
+            try:
+                while offset < file_size:
+                    end = min(offset + checkpoint.part_size, file_size)
+                    part = FilePart(view, offset, end)
+                    try:
+                        response = transport.put(checkpoint.upload_id, data=part, headers={
+                            'Content-Range': f'bytes {offset}-{end - 1}/{file_size}',
+                            'Content-Length': str(end - offset)
+                        })
+                    finally:
+                        part.release()
+
+                    if response.status_code in (200, 201):
+                        offset = file_size
+                    elif response.status_code == 308:
+                        # The server tells how many bytes it committed, continue from there
+                        offset = self._committed_offset(response)
+                        checkpoint.add_part(offset // checkpoint.part_size, None)
+                    else:
+                        raise HTTPStatusError(response.status_code, f"Resumable upload failed: {response.text}")
+            finally:
+                view.release()
+
+        checkpoints.delete(checkpoint)
+
+    @staticmethod
+    def _committed_offset(response):
+        # The Range header of a 308 response is 'bytes=0-N' when N + 1 bytes are committed
+        committed = response.headers.get('Range')
+        return int(committed.split('-')[-1]) + 1 if committed else 0
+
+    # Define a method called _query_resumable_offset which asks GCS how many bytes of the session are committed.
+    # It returns None when the session expired or is unknown
+    def _query_resumable_offset(self, transport, session_uri, file_size):
+        response = transport.put(session_uri, headers={'Content-Range': f'bytes */{file_size}', 'Content-Length': '0'})
+        if response.status_code == 308:
+            return self._committed_offset(response)
+        if response.status_code in (200, 201):
+            return file_size
+        if response.status_code in (404, 410):
+            return None
+        raise HTTPStatusError(response.status_code, f"Failed to query resumable upload: {response.text}")
+
+    # Define a method called copy_object which copies the object source_key to key with a server-side rewrite
+    def copy_object(self, source_key, key):
+        bucket = self.get_bucket()
+        try:
+            self.call_with_retry(bucket.copy_blob, bucket.blob(source_key), bucket, key)
+            logger.info("File %s copied from %s in GCS bucket : %s", key, source_key, self.bucket_name)
+            return True
+        except Exception as e:
+            logger.error("Failed to copy %s to %s in GCS bucket: %s. Error: %s", source_key, key, self.bucket_name, e)
+            return False
+
+    # Define a method called classify_error which tells whether a google-cloud-storage error is worth retrying
+    def classify_error(self, error):
+        return classify_gcs_error(error)
+
+    # Define a method called list_objects which lists the bucket with list_blobs, up to 1000 objects per call
+    def list_objects(self, prefix=''):
+        # Only ask for the fields needed by the index to keep the listing pages small
+        blobs = self.get_client().list_blobs(self.bucket_name, prefix=prefix or None, fields='items(name,size,md5Hash),nextPageToken')
+        for blob in blobs:
+            # GCS returns the MD5 base64 encoded, the index keeps hex digests
+            md5 = base64.b64decode(blob.md5_hash).hex() if blob.md5_hash else None
+            yield blob.name, blob.size, md5
             
+class UploadWorkerPool:
+    '''Upload files for one cloud service on a fixed number of worker threads.
+
+    Files (paths or WorkItems) are handed to the workers through a bounded queue, so the directory
+    walk keeps running while uploads are in flight and blocks once queue_size files are waiting.
+    upload_func returns True when the file was uploaded, False when it failed and None
+    when it was skipped. The number of files waiting in the queue is reported to metrics
+    as the queue_depth gauge of the cloud service. When a priority function is given, the
+    workers take the waiting file of the lowest priority first, in submission order otherwise.
+    '''
+
+    # Marker put on the queue once per worker to tell it to stop
+    _STOP = object()
+
+    def __init__(self, upload_func, max_workers, queue_size, metrics=NULL_METRICS, service=None, priority=None):
+        self.upload_func = upload_func
+        self.max_workers = max_workers
+        self.priority = priority
+        self.queue = queue.Queue(maxsize=queue_size) if priority is None else queue.PriorityQueue(maxsize=queue_size)
+        # Entries of the priority queue are (priority, sequence, file), so equal priorities keep their order
+        self._sequence = itertools.count()
+        self.metrics = metrics
+        self.service = service
+        self.uploaded = 0
+        self.failed = 0
+        self.skipped = 0
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        # Start the worker threads as daemons so a crashed walk never keeps the process alive
+        for i in range(self.max_workers):
+            thread = threading.Thread(target=self._worker, name=f"upload-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, file_path):
+        # Block until there is room in the queue, which bounds how far the walk runs ahead
+        if self.priority is None:
+            self.queue.put(file_path)
+        else:
+            self.queue.put((self.priority(file_path), next(self._sequence), file_path))
+        if self.metrics.enabled:
+            self.metrics.set_gauge('queue_depth', self.queue.qsize(), provider=self.service)
+
+    def join(self):
+        # Tell every worker to stop once the queue is drained and wait for them to finish
+        for _ in self._threads:
+            self.queue.put(self._STOP if self.priority is None else (float('inf'), next(self._sequence), self._STOP))
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        return self.uploaded, self.failed
+
+    def _worker(self):
+        while True:
+            file_path = self.queue.get()
+            if self.priority is not None:
+                file_path = file_path[2]
+            if file_path is self._STOP:
+                return
+            if self.metrics.enabled:
+                self.metrics.set_gauge('queue_depth', self.queue.qsize(), provider=self.service)
+
+            # Never let one failing file take the worker down with it
+            try:
+                success = self.upload_func(file_path)
+            except Exception as e:
+                logger.error("Failed to upload %s. Error: %s", file_path, e)
+                success = False
+
+            with self._lock:
+                if success is False:
+                    self.failed += 1
+                elif success is None:
+                    self.skipped += 1
+                else:
+                    self.uploaded += 1
+
+
 class FileUploader:
     
     # Define a class-level constant dictionary named UPLOAD_FILE_TYPES with some values for different cloud storage services
     UPLOAD_FILE_TYPES = {'s3': ('image', 'media'), 'gcs': ('document',)}
     
-    # Define an initializer method that takes in the directory path, config file path, and an optional argument for upload file types, and sets them as instance attributes
-    def __init__(self, directory_path, config_file, upload_file_types=UPLOAD_FILE_TYPES):
+    # Define an initializer method that takes in the directory path, config file path, and an optional argument for upload file types, and sets them as instance attributes.
+    # An optional Metrics replaces the one described by the 'metrics' section of the config file
+    def __init__(self, directory_path, config_file, upload_file_types=UPLOAD_FILE_TYPES, metrics=None):
         self.directory_path = directory_path
         self.config_file = config_file
         self.upload_file_types = upload_file_types
@@ -193,25 +987,194 @@ class FileUploader:
         except json.JSONDecodeError:
             raise Exception(f"Error: Invalid JSON format in config file '{self.config_file}'.")
 
+        # Read the optional concurrency settings, by default files are uploaded one at a time
+        concurrency = self.config.get('concurrency', {})
+        self.max_workers = concurrency.get('max_workers', 1)
+        self.queue_size = concurrency.get('queue_size', self.max_workers * 4)
+        self.scan_workers = concurrency.get('scan_workers', 4)
+        if not isinstance(self.max_workers, int) or self.max_workers < 1:
+            raise Exception(f"Error: 'max_workers' in config file '{self.config_file}' must be a positive integer.")
+        if not isinstance(self.queue_size, int) or self.queue_size < 1:
+            raise Exception(f"Error: 'queue_size' in config file '{self.config_file}' must be a positive integer.")
+
+        # Collect the metrics of the uploads when they are enabled, otherwise every measurement is a no-op
+        metrics_settings = self.config.get('metrics', {})
+        self.metrics = metrics if metrics is not None else metrics_from_config(metrics_settings)
+        # Publish the connections of the uploaders with every flush, so their reuse can be followed during a run
+        self.metrics.add_collector(self.collect_connection_stats)
+        self.metrics_interval = metrics_settings.get('interval', 10)
+
+        # Pace the uploads with bandwidth caps, concurrency budgets and priority classes when the scheduler is enabled
+        scheduler = self.config.get('scheduler', {})
+        self.scheduler = scheduler_from_config(scheduler, self.config.get('file_types', {}))
+        self.scheduler_control_file = scheduler.get('control_file')
+
+        # Read the manifest file of uploaded files when incremental sync is enabled. It is opened on first use,
+        # so a dry run never creates it
+        sync = self.config.get('sync', {})
+        self.manifest_file = sync.get('manifest_file', '.upload_manifest.db') if sync.get('enabled', False) else None
+        self._manifest = None
+        self._manifest_lock = threading.Lock()
+
+        # Read the retry settings, shared by every cloud service
+        retry = self.config.get('retry', {})
+        self.retry_policy = RetryPolicy(retry.get('max_attempts', 5), retry.get('base_delay', 0.5), retry.get('max_delay', 30.0))
+        self.adaptive_concurrency = retry.get('adaptive_concurrency', True)
+        self.max_requests = retry.get('max_requests', 32)
+
+        # Read the size of the HTTP connection pool of each cloud service, it should allow every concurrent request
+        connections = self.config.get('connections', {})
+        self.max_pool_connections = connections.get('max_pool_connections', DEFAULT_MAX_POOL_CONNECTIONS)
+        if not isinstance(self.max_pool_connections, int) or self.max_pool_connections < 1:
+            raise Exception(f"Error: 'max_pool_connections' in config file '{self.config_file}' must be a positive integer.")
+
+        # Read the large file settings, files above the threshold are uploaded in parts concurrently
+        large_files = self.config.get('large_files', {})
+        self.large_file_threshold = large_files.get('threshold', 64 * 1024 * 1024)
+        self.large_file_part_size = large_files.get('part_size')
+        self.large_file_max_workers = large_files.get('max_workers')
+        self.checkpoints = None
+        if large_files.get('checkpoint_dir'):
+            self.checkpoints = CheckpointStore(large_files['checkpoint_dir'])
+
+        # Hash every file once and upload every content once per cloud service when deduplication is enabled
+        dedup = self.config.get('dedup', {})
+        self.hasher = None
+        self.dedup_index = None
+        if dedup.get('enabled', False):
+            self.hasher = FileHasher(dedup.get('process_threshold', 64 * 1024 * 1024), dedup.get('max_processes'))
+            self.dedup_index = DedupIndex()
+
+        # Read the fan-out settings, a file routed to several cloud services is then read once for all of them
+        fanout = self.config.get('fanout', {})
+        self.fanout_enabled = fanout.get('enabled', False)
+        self.fanout_chunk_size = fanout.get('chunk_size', 8 * 1024 * 1024)
+        self.fanout_max_buffered = fanout.get('max_buffered_chunks', 4)
+        # Fanned-out files are streamed on the threads of one executor per cloud service, created on first use,
+        # so the clients cached by those threads are reused. Every worker can fan out a file at the same time
+        self.max_fanouts = self.max_workers
+        self.fanout_executors = {}
+        self._fanout_lock = threading.Lock()
+
+        # Read the compression settings, a codec per file type of 'file_types'. Formats that are already compressed,
+        # like mp4 or jpg, are never compressed whatever their file type
+        compression = self.config.get('compression', {})
+        self.codecs = {}
+        self.compression_min_size = compression.get('min_size', 1024)
+        self.compression_stats = {service: CompressionStats() for service in self.config['cloud_services']}
+        if compression.get('enabled', False):
+            codecs = {file_type: get_codec(name, compression.get('level')) for file_type, name in compression.get('codecs', {}).items()}
+            for file_type, extensions in self.config.get('file_types', {}).items():
+                if file_type in codecs:
+                    for extension in extensions:
+                        if extension.lower() not in COMPRESSED_EXTENSIONS:
+                            self.codecs[extension.lower()] = codecs[file_type]
+
+        # Read the small file bundling settings, each cloud service may override the threshold and the shard size
+        bundling = self.config.get('bundling', {})
+        self.bundling = {}
+        self.bundle_key_prefix = bundling.get('key_prefix', 'bundles/')
+        if bundling.get('enabled', False):
+            for service in self.config['cloud_services']:
+                settings = bundling.get(service, {})
+                self.bundling[service] = (
+                    settings.get('threshold', bundling.get('threshold', 16 * 1024)),
+                    settings.get('shard_size', bundling.get('shard_size', 64 * 1024 * 1024))
+                )
+
+        # Prepare the cache of bucket listings when the remote existence check is enabled
+        remote_index = self.config.get('remote_index', {})
+        self.remote_indexes = None
+        if remote_index.get('enabled', False):
+            self.remote_indexes = RemoteIndexCache(remote_index.get('ttl', 3600), remote_index.get('cache_dir'))
+            # Files are uploaded at the root of the buckets under their base name, so the whole bucket is listed
+            if remote_index.get('prefix'):
+                logger.warning("The 'prefix' of the 'remote_index' section is ignored, files are uploaded at the root of the buckets.")
+            self.remote_index_verify_md5 = remote_index.get('verify_md5', False)
+
+        # Read the cloud services of the configuration file. Their uploaders, and the SDKs behind them, are only
+        # created by get_uploader when the first file is uploaded to them
+        self.services = tuple(service for service in ('s3', 'gcs') if service in self.config['cloud_services'])
+        # Every upload to a cloud service takes one of its max_workers slots, the stream of a file fanned out from
+        # the worker pool of another cloud service as well, so no cloud service has more uploads in flight
+        self.service_slots = {service: threading.BoundedSemaphore(self.max_workers) for service in self.services}
+        self.uploaders = {}
+        self._uploaders_lock = threading.Lock()
+
         # If the configuration file contains information about the 's3' cloud service
-        if 's3' in self.config['cloud_services']:
-            # Create an instance of the S3Uploader class using information from the configuration file
-            self.s3_uploader = S3Uploader(
-                self.config['cloud_services']['s3']['bucket_name'],
-                self.config['cloud_services']['s3']['credentials_file']
-            )
+        if 's3' in self.services:
             # Get file extensions associated with the S3Uploader object
             self.s3_uploader_file_types = self.get_file_ext('s3')
 
         # If the configuration file contains information about the 'gcs' cloud service
-        if 'gcs' in self.config['cloud_services']:
-            # Create an instance of the GCSUploader class using information from the configuration file
-            self.gcs_uploader = GCSUploader(
-                self.config['cloud_services']['gcs']['bucket_name'],
-                self.config['cloud_services']['gcs']['credentials_file']
-            )
+        if 'gcs' in self.services:
             # Get file extensions associated with the GCSUploader object
             self.gcs_uploader_file_types = self.get_file_ext('gcs')
+
+        # Build the extension routing table once, only for the configured cloud services
+        self.router = ExtensionRouter({service: getattr(self, f'{service}_uploader_file_types') for service in self.services})
+
+
+    def get_uploader(self, service):
+        '''Return the uploader of the cloud service, creating it on first use with the retry policy, its own rate
+        limiter, which backs off when its cloud service throttles, and the scheduler.
+        Raise AttributeError when the cloud service is not in the configuration file'''
+
+        uploader = self.uploaders.get(service)
+        if uploader is not None:
+            return uploader
+        if service not in self.services:
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{service}_uploader'")
+
+        # Create the uploader once, even when several worker threads need it at the same time
+        with self._uploaders_lock:
+            if service not in self.uploaders:
+                uploader_class = S3Uploader if service == 's3' else GCSUploader
+                uploader = uploader_class(
+                    self.config['cloud_services'][service]['bucket_name'],
+                    self.config['cloud_services'][service]['credentials_file'],
+                    max_pool_connections=self.max_pool_connections
+                )
+                rate_limiter = AdaptiveRateLimiter(self.max_requests) if self.adaptive_concurrency else None
+                uploader.set_retry_policy(self.retry_policy, rate_limiter)
+                if self.scheduler is not None:
+                    uploader.set_scheduler(self.scheduler, service)
+                self.uploaders[service] = uploader
+            return self.uploaders[service]
+
+
+    # The uploaders of the cloud services, created on first use
+    @property
+    def s3_uploader(self):
+        return self.get_uploader('s3')
+
+    @s3_uploader.setter
+    def s3_uploader(self, uploader):
+        self.uploaders['s3'] = uploader
+
+    @property
+    def gcs_uploader(self):
+        return self.get_uploader('gcs')
+
+    @gcs_uploader.setter
+    def gcs_uploader(self, uploader):
+        self.uploaders['gcs'] = uploader
+
+
+    # The manifest of incremental sync, opened on first use. None when incremental sync is disabled
+    @property
+    def manifest(self):
+        if self.manifest_file is None or self._manifest is not None:
+            return self._manifest
+        with self._manifest_lock:
+            if self._manifest is None:
+                self._manifest = UploadManifest(self.manifest_file)
+            return self._manifest
+
+
+    def bucket_name(self, service):
+        # Return the bucket of the cloud service from the configuration file, without creating its uploader
+        return self.config['cloud_services'][service]['bucket_name']
             
 
             
@@ -227,34 +1190,998 @@ class FileUploader:
                 file_ext_list.extend(self.config["file_types"][s])
             else:
                 # If it is not defined, print an error message and skip to the next file type
-                print(f"'{s}' is not defined in 'file_types' in config file. Skipping '{s}'")
+                logger.warning("'%s' is not defined in 'file_types' in config file. Skipping '%s'", s, s)
 
         return file_ext_list
 
 
+    def check_manifest(self, service, file_path, item=None):
+        '''Compare the file with its manifest entry for the cloud service. Return None when it has not changed
+        since it was last uploaded, otherwise the (size, mtime_ns, content_hash) to record once it is uploaded.
+        The size and mtime are taken from the WorkItem of the directory scan when given'''
+
+        bucket_name = self.bucket_name(service)
+        if item is not None:
+            size, mtime_ns = item.size, item.mtime_ns
+        else:
+            stat = os.stat(file_path)
+            size, mtime_ns = stat.st_size, stat.st_mtime_ns
+        path = os.path.relpath(file_path, self.directory_path)
+        entry = self.manifest.lookup(service, bucket_name, path)
+
+        # Same size and mtime as the last upload, skip without reading the file
+        if entry is not None and entry.size == size and entry.mtime_ns == mtime_ns:
+            return None
+
+        # A file that was touched but not modified only gets its new mtime recorded
+        content_hash = self.content_hash(file_path, size, mtime_ns)
+        if entry is not None and entry.size == size and entry.content_hash == content_hash:
+            self.manifest.record(service, bucket_name, path, size, mtime_ns, content_hash)
+            return None
+
+        return size, mtime_ns, content_hash
+
+
+    def record_upload(self, service, file_path, state):
+        # Record the state of the file taken before the upload, so changes made during the upload are seen next run
+        path = os.path.relpath(file_path, self.directory_path)
+        self.manifest.record(service, self.bucket_name(service), path, *state)
+
+
+    def get_remote_index(self, service):
+        # Return the listing of the bucket of the cloud service, listing it on first use or when it expired
+        uploader = getattr(self, f'{service}_uploader')
+        return self.remote_indexes.get(service, self.bucket_name(service), '', uploader.list_objects)
+
+
+    def prepare_upload(self, service, file_path, item=None, bundled=False):
+        '''Decide whether the file must be uploaded to the cloud service. Return None when incremental sync
+        or the bucket listing shows it can be skipped, otherwise the (size, mtime_ns, content_hash) state
+        to pass to finish_upload. Fields that were not needed are None. A bundled file, headed to a shard,
+        never is an object of its own and is not deduplicated, so only incremental sync can skip it'''
+
+        state = (item.size, item.mtime_ns, None) if item is not None else (None, None, None)
+        if self.manifest is not None:
+            state = self.check_manifest(service, file_path, item)
+            if state is None:
+                return None
+
+        if self.remote_indexes is not None and not bundled:
+            size = state[0] if state[0] is not None else os.path.getsize(file_path)
+            md5 = None
+            if self.remote_index_verify_md5:
+                md5 = state[2] if state[2] is not None else self.content_hash(file_path, size, state[1])
+            if self.get_remote_index(service).matches(os.path.basename(file_path), size, md5):
+                # The bucket already holds the file, remember it so the next run skips it after a stat
+                if self.manifest is not None:
+                    self.record_upload(service, file_path, state)
+                return None
+            state = (size, state[1], state[2] if state[2] is not None else md5)
+
+        # The size decides whether the file is uploaded in parts
+        if state[0] is None and self.large_file_threshold is not None:
+            state = (os.path.getsize(file_path), state[1], state[2])
+
+        # Deduplication needs the digest of every file, it is computed once and feeds the manifest as well
+        if self.hasher is not None and state[2] is None and not bundled:
+            state = (state[0], state[1], self.content_hash(file_path, state[0], state[1]))
+
+        return state
+
+
+    def content_hash(self, file_path, size=None, mtime_ns=None):
+        # Return the hex MD5 digest of the file, from the digest cache of the FileHasher when deduplication is enabled
+        with self.metrics.time('stage_seconds', provider='all', stage='hash'):
+            if self.hasher is not None:
+                return self.hasher.digest(file_path, size, mtime_ns).md5_hex
+            return file_hash(file_path)
+
+
+    def finish_upload(self, service, file_path, state, success):
+        # Record a successful upload in the manifest and in the bucket listing
+        if success is False:
+            return
+        if self.manifest is not None:
+            self.record_upload(service, file_path, state)
+        if self.remote_indexes is not None:
+            self.get_remote_index(service).add(os.path.basename(file_path), state[0], state[2])
+
+
+    def upload_to_service(self, service, file_path, item=None):
+        '''Upload the file to the given cloud service. Return True when it was uploaded, False when it failed
+        and None when incremental sync or the bucket listing skipped it'''
+
+        state = self.prepare_upload(service, file_path, item)
+        if state is None:
+            self.metrics.inc('uploads_total', provider=service, outcome='skipped')
+            return None
+
+        started = time.monotonic()
+        if self.dedup_index is not None:
+            success = self.send_deduplicated(service, file_path, state)
+        else:
+            success = self.send_file(service, file_path, state[0])
+        self.record_metrics(service, started, state[0], success)
+        self.finish_upload(service, file_path, state, success)
+        return success
+
+
+    def record_metrics(self, service, started, size, success, files=1):
+        # Count the outcome and the bytes of an upload to the cloud service and observe its latency as the network stage
+        if not self.metrics.enabled:
+            return
+        self.metrics.observe('stage_seconds', time.monotonic() - started, provider=service, stage='network')
+        self.metrics.inc('uploads_total', files, provider=service, outcome='failed' if success is False else 'uploaded')
+        if success is not False and size:
+            self.metrics.inc('upload_bytes_total', size, provider=service)
+
+
+    def timed_scan(self, items):
+        '''Return the WorkItems of a directory scan, observing the time spent waiting for each one as the scan stage
+        and counting them when metrics are enabled'''
+
+        if not self.metrics.enabled:
+            return items
+
+        def timed():
+            iterator = iter(items)
+            while True:
+                started = time.monotonic()
+                item = next(iterator, None)
+                if item is None:
+                    return
+                self.metrics.observe('stage_seconds', time.monotonic() - started, provider='all', stage='scan')
+                self.metrics.inc('files_scanned_total')
+                yield item
+        return timed()
+
+
+    def send_deduplicated(self, service, file_path, state):
+        '''Upload the file unless a file with the same content was already uploaded to the cloud service in this run.
+        A duplicate under the same key is not sent again and a duplicate under another key is copied on the
+        cloud service's side'''
+
+        uploader = getattr(self, f'{service}_uploader')
+        digest = self.hasher.digest(file_path, state[0], state[1])
+        key = os.path.basename(file_path)
+        source_key = self.dedup_index.claim(service, digest, key)
+        if source_key is None:
+            success = False
+            try:
+                success = self.send_file(service, file_path, state[0], digest)
+            finally:
+                self.dedup_index.release(service, digest, key, success is True)
+            return success
+
+        if source_key == key:
+            logger.info("Skipping '%s', the same content was already uploaded to %s as '%s'.", file_path, service, key)
+            return True
+        success = uploader.copy_object(source_key, key)
+        if success:
+            self.dedup_index.add_copy(service, digest, key)
+        return success
+
+
+    def is_large_file(self, file_path, size=None):
+        # Return True when the file is above the large file threshold
+        if self.large_file_threshold is None:
+            return False
+        if size is None:
+            size = os.path.getsize(file_path)
+        return size > self.large_file_threshold
+
+
+    def send_file(self, service, file_path, size=None, digest=None):
+        '''Upload the file with the cloud service's uploader, in concurrent parts when it is a large file.
+        The FileDigest of the file, when known, is sent along with files uploaded with upload_file'''
+
+        uploader = getattr(self, f'{service}_uploader')
+        codec = self.select_codec(file_path, size)
+        if codec is not None:
+            return self.send_compressed(service, file_path, codec)
+        if self.is_large_file(file_path, size):
+            return uploader.upload_large_file(file_path, self.large_file_part_size, self.large_file_max_workers, self.checkpoints)
+        if digest is not None:
+            return uploader.upload_file(file_path, digest=digest)
+        return uploader.upload_file(file_path)
+
+
+    def select_codec(self, file_path, size=None):
+        # Return the Codec compressing the file, or None when its file type is not compressed or the file is too small
+        codec = self.codecs.get(file_path.rpartition('.')[2].lower())
+        if codec is None:
+            return None
+        if size is None:
+            size = os.path.getsize(file_path)
+        return codec if size >= self.compression_min_size else None
+
+
+    def send_compressed(self, service, file_path, codec):
+        '''Upload the file compressed with the codec, setting its Content-Encoding. The file is compressed
+        on a background thread while the compressed chunks already produced are uploaded'''
+
+        uploader = getattr(self, f'{service}_uploader')
+        stream = prefetch(compress_file(file_path, codec, self.compression_stats[service]))
+        try:
+            return uploader.upload_stream(os.path.basename(file_path), stream, content_encoding=codec.content_encoding,
+                                          content_type=mimetypes.guess_type(file_path)[0])
+        finally:
+            stream.close()
+
+
+    def print_compression_stats(self):
+        # Show how many bytes compression saved per cloud service
+        for service, stats in self.compression_stats.items():
+            if stats.files:
+                percent = 100 * stats.saved_bytes / stats.raw_bytes if stats.raw_bytes else 0
+                logger.info("%s: %s files compressed from %s to %s bytes, %s bytes (%.0f%%) saved.", service, stats.files, stats.raw_bytes, stats.compressed_bytes, stats.saved_bytes, percent)
+
+
+    def is_small_file(self, service, size):
+        # Return True when the file is bundled with other small files for the cloud service
+        return service in self.bundling and size < self.bundling[service][0]
+
+
+    def start_batchers(self):
+        # Start one ShardBatcher per cloud service with bundling enabled
+        return {service: ShardBatcher(shard_size, self.bundle_key_prefix)
+                for service, (threshold, shard_size) in self.bundling.items() if service in self.services}
+
+
+    def upload_shard(self, service, batch):
+        '''Upload a ShardBatch of small files as one tar shard followed by its sidecar index. Return True when
+        both were uploaded, False when one failed and None when incremental sync skipped every file'''
+
+        # Leave out the files that incremental sync skips
+        members = []
+        for name, item in batch.items:
+            state = self.prepare_upload(service, item.path, item, bundled=True)
+            if state is not None:
+                members.append((name, item, state))
+        if len(members) < len(batch.items):
+            self.metrics.inc('uploads_total', len(batch.items) - len(members), provider=service, outcome='skipped')
+        if not members:
+            return None
+
+        # Stream the shard straight from the files to the bucket, then upload the index of its members
+        uploader = getattr(self, f'{service}_uploader')
+        shard = TarShard(batch.key, [(name, item.path, item.size, item.mtime_ns) for name, item, state in members])
+        started = time.monotonic()
+        success = uploader.upload_stream(shard.key, shard.stream()) and uploader.upload_stream(shard.index_key, [shard.index_json()])
+        self.record_metrics(service, started, shard.size, success, len(members))
+        if success:
+            logger.info("Bundled %s files into '%s'.", len(members), shard.key)
+            # Bundled files are not objects of their own, so only the manifest records them
+            if self.manifest is not None:
+                for name, item, state in members:
+                    self.record_upload(service, item.path, state)
+        return success
+
+
+    def archive_name(self, file_path):
+        # Files are stored in shards under their path relative to the directory, with forward slashes
+        return os.path.relpath(file_path, self.directory_path).replace(os.sep, '/')
+
+
+    def work_priority(self, work):
+        # Return the priority class of a WorkItem, a ShardBatch (its most urgent file) or a FanOutItem
+        if isinstance(work, ShardBatch):
+            return min((self.work_priority(item) for name, item in work.items), default=0)
+        if isinstance(work, FanOutItem):
+            work = work.item
+        return self.scheduler.priority(work.path, work.size)
+
+
+    def upload_work(self, service, work):
+        # Upload a WorkItem, a ShardBatch or a FanOutItem to the cloud service, in a slot of the scheduler when enabled.
+        # The slots of the cloud services are taken first, so waiting for them never holds a slot of the scheduler
+        slot_services = self.slot_services(service, work)
+        for name in slot_services:
+            self.service_slots[name].acquire()
+        try:
+            if self.scheduler is not None:
+                with self.scheduler.slot(service, self.work_priority(work)):
+                    return self.send_work(service, work)
+            return self.send_work(service, work)
+        finally:
+            for name in slot_services:
+                self.service_slots[name].release()
+
+
+    def slot_services(self, service, work):
+        # Return the cloud services the work takes an upload slot of: every cloud service of a fanned-out file, in a
+        # fixed order so two fan-outs waiting for their slots never wait on each other
+        if isinstance(work, FanOutItem):
+            return sorted(work.services)
+        return [service]
+
+
+    def send_work(self, service, work):
+        if isinstance(work, ShardBatch):
+            return self.upload_shard(service, work)
+        if isinstance(work, FanOutItem):
+            return self.upload_fanout(work)
+        return self.upload_to_service(service, work.path, work)
+
+
+    def is_fanout(self, item, services):
+        '''Return True when the file is read once and streamed to its cloud services at the same time. Files that
+        are compressed, deduplicated or uploaded with checkpoints keep their own path to each cloud service'''
+
+        if not self.fanout_enabled or len(services) < 2 or self.dedup_index is not None:
+            return False
+        if self.select_codec(item.path, item.size) is not None:
+            return False
+        return self.checkpoints is None or not self.is_large_file(item.path, item.size)
+
+
+    def route_item(self, item, batchers):
+        '''Return the (service, work) pairs to upload for a WorkItem of the scan: small files go to the batchers
+        and only come back as a ShardBatch once one is full, files for several cloud services may be fanned out'''
+
+        work = []
+        services = []
+        for service in sorted(item.targets):
+            if service in batchers and self.is_small_file(service, item.size):
+                batch = batchers[service].add(self.archive_name(item.path), item)
+                if batch is not None:
+                    work.append((service, batch))
+            else:
+                services.append(service)
+
+        # A fanned-out file is uploaded by the worker pool of its first cloud service
+        if self.is_fanout(item, services):
+            work.append((services[0], FanOutItem(item, tuple(services))))
+        else:
+            work.extend((service, item) for service in services)
+        return work
+
+
+    def upload_fanout(self, work):
+        '''Upload a FanOutItem to all of its cloud services at the same time, reading the file once.
+        Every cloud service records its own outcome. Return True when every upload succeeded, False
+        when one failed and None when incremental sync or the bucket listings skipped the file everywhere'''
+
+        item = work.item
+        file_path = item.path
+        states = {}
+        for service in work.services:
+            state = self.prepare_upload(service, file_path, item)
+            if state is not None:
+                states[service] = state
+            else:
+                self.metrics.inc('uploads_total', provider=service, outcome='skipped')
+        if not states:
+            return None
+
+        # A file needed by one cloud service only is uploaded as usual
+        started = time.monotonic()
+        if len(states) == 1:
+            service, state = next(iter(states.items()))
+            success = self.send_file(service, file_path, state[0])
+            self.record_metrics(service, started, state[0], success)
+            self.finish_upload(service, file_path, state, success)
+            return success
+
+        key = os.path.basename(file_path)
+        part_size = compute_part_size(item.size, self.fanout_chunk_size)
+        targets = {}
+        for service in states:
+            uploader = getattr(self, f'{service}_uploader')
+            targets[service] = lambda chunks, uploader=uploader: uploader.upload_stream(key, chunks, part_size)
+        executors = {service: self.get_fanout_executor(service) for service in states}
+        results = fan_out(file_path, targets, part_size, self.fanout_max_buffered, executors)
+
+        for service, success in results.items():
+            self.record_metrics(service, started, item.size, success)
+            self.finish_upload(service, file_path, states[service], success)
+        return all(results.values())
+
+
+    def get_fanout_executor(self, service):
+        # Return the executor streaming fanned-out files to the cloud service, with a thread for every fan-out running at once
+        with self._fanout_lock:
+            if service not in self.fanout_executors:
+                self.fanout_executors[service] = ThreadPoolExecutor(max_workers=self.max_fanouts, thread_name_prefix=f"fan-out-{service}")
+            return self.fanout_executors[service]
+
+
+    def close_fanout_executors(self):
+        # Stop the threads of the fan-out executors at the end of a run
+        with self._fanout_lock:
+            executors, self.fanout_executors = self.fanout_executors, {}
+        for executor in executors.values():
+            executor.shutdown()
+
+
+    def print_connection_stats(self):
+        # Show how many requests of each cloud service reused a kept-alive connection, for the uploaders that were created
+        for service, uploader in list(self.uploaders.items()):
+            stats = uploader.connection_stats()
+            if isinstance(stats, ConnectionStats) and stats.requests:
+                logger.info("%s: %s requests over %s connections, %s reused.", service, stats.requests, stats.connections, stats.reused)
+
+
+    def collect_connection_stats(self):
+        # Set the 'connections', 'requests' and 'connections_reused' gauges of every uploader created, called by every metrics flush
+        for service, uploader in list(self.uploaders.items()):
+            stats = uploader.connection_stats()
+            if isinstance(stats, ConnectionStats):
+                self.metrics.set_gauge('connections', stats.connections, provider=service)
+                self.metrics.set_gauge('requests', stats.requests, provider=service)
+                self.metrics.set_gauge('connections_reused', stats.reused, provider=service)
+
+
+    def watch_scheduler(self):
+        # Apply the limits of the control file of the scheduler while the uploads are running
+        if self.scheduler is not None and self.scheduler_control_file:
+            self.scheduler.watch(self.scheduler_control_file)
+
+
+    def start_worker_pools(self):
+        # Start one worker pool per configured cloud service, so each service has at most max_workers uploads in flight
+        pools = {}
+        for service in self.services:
+            upload_func = lambda work, service=service: self.upload_work(service, work)
+            priority = self.work_priority if self.scheduler is not None else None
+            pools[service] = UploadWorkerPool(upload_func, self.max_workers, self.queue_size, self.metrics, service, priority)
+        for pool in pools.values():
+            pool.start()
+        return pools
+
+
     def upload_files(self):
+        '''Upload every file of the directory tree to the cloud services its extension is routed to.
+        Return the number of uploaded and failed files per cloud service, like upload_batches'''
+
         # Check if the directory exists
         if not os.path.isdir(self.directory_path):
-            print(f"Error: Directory {self.directory_path} does not exist.")
-            return
+            logger.error("Error: Directory %s does not exist.", self.directory_path)
+            return {}
+
+        # Scan the directory tree and upload every file to the cloud services its extension is routed to
+        scanner = DirectoryScanner(self.directory_path, self.router, self.scan_workers, self.queue_size)
+        return self.upload_batches([self.timed_scan(scanner.scan())])
+
+
+    def dry_run(self):
+        '''Scan the directory tree like upload_files without uploading anything. Return the relative paths of the files
+        each cloud service would get, sorted. Files whose size and mtime match the manifest are left out. No uploader
+        is created, so the cloud SDKs are not imported'''
+
+        # Check if the directory exists
+        if not os.path.isdir(self.directory_path):
+            logger.error("Error: Directory %s does not exist.", self.directory_path)
+            return {}
+
+        # Only read the manifest, a dry run never creates or records anything. Without a manifest file every file is new
+        manifest = self._manifest
+        if manifest is None and self.manifest_file is not None and os.path.exists(self.manifest_file):
+            manifest = UploadManifest(self.manifest_file, read_only=True)
+
+        planned = {service: [] for service in self.services}
+        scanner = DirectoryScanner(self.directory_path, self.router, self.scan_workers, self.queue_size)
+        try:
+            for item in scanner.scan():
+                path = os.path.relpath(item.path, self.directory_path)
+                for service in item.targets:
+                    entry = manifest.lookup(service, self.bucket_name(service), path) if manifest is not None else None
+                    if entry is None or (entry.size, entry.mtime_ns) != (item.size, item.mtime_ns):
+                        planned[service].append(path)
+        finally:
+            if manifest is not None and manifest is not self._manifest:
+                manifest.close()
+        return {service: sorted(paths) for service, paths in planned.items()}
+
+
+    def watch(self, stop_event=None):
+        '''Upload every file of the directory like upload_files, then keep uploading the files written to it
+        until stop_event (a threading.Event) is set or the process is interrupted. New files are detected
+        with inotify, or by polling when it is not available, and uploaded in batches once they are stable.
+        The directory tree is only scanned once, at startup. Return the number of uploaded and failed files per
+        cloud service, empty when the process was interrupted during an upload'''
+
+        # Check if the directory exists
+        if not os.path.isdir(self.directory_path):
+            logger.error("Error: Directory %s does not exist.", self.directory_path)
+            return {}
+
+        # Start watching before the startup scan, so the files written during the scan are not missed
+        settings = self.config.get('watch', {})
+        watcher = DirectoryWatcher(self.directory_path, self.router, settings.get('settle_seconds', 2.0),
+                                   settings.get('batch_size', 256), settings.get('batch_interval', 1.0),
+                                   settings.get('poll_interval', 5.0), settings.get('backend', 'auto'))
+        # Files written once the watcher started can be found by the scan and reported by the watcher as well.
+        # The scan remembers their size and mtime, with a margin for coarse file system timestamps
+        scanned = {}
+        watch_started_ns = time.time_ns() - 2 * 1000 * 1000 * 1000
+        watcher.start()
+        try:
+            scanner = DirectoryScanner(self.directory_path, self.router, self.scan_workers, self.queue_size)
+            startup = self.remember_scanned(scanner.scan(), scanned, watch_started_ns)
+            batches = itertools.chain([self.timed_scan(startup)], self.watched_batches(watcher, stop_event, scanned))
+            return self.upload_batches(batches, forget_caches=True)
+        except KeyboardInterrupt:
+            logger.info("Stopped watching %s.", self.directory_path)
+            return {}
+        finally:
+            watcher.close()
+
+
+    def remember_scanned(self, items, scanned, since_ns):
+        # Yield the WorkItems of the startup scan, remembering in scanned the size and mtime of the files modified since since_ns
+        for item in items:
+            if item.mtime_ns >= since_ns:
+                scanned[item.path] = (item.size, item.mtime_ns)
+            yield item
+
 
-        # For each file in the directory, check if it is a file and retrieve its file type
-        for subdir, _, files in os.walk(self.directory_path):
-            for file in files:
-                file_path = os.path.join(subdir, file)
+    def watched_batches(self, watcher, stop_event=None, scanned=None):
+        # Yield the batches of new files of the watcher, counting them as scanned files. Files the startup scan already
+        # found in the same state are left out. An interruption while waiting for new files ends the batches, so the
+        # uploads of the run are still counted
+        scanned = scanned if scanned is not None else {}
+        try:
+            for batch in watcher.batches(stop_event):
+                if scanned:
+                    batch = [item for item in batch if scanned.pop(item.path, None) != (item.size, item.mtime_ns)]
+                    if not batch:
+                        continue
+                logger.info("%s new files in %s.", len(batch), self.directory_path)
+                self.metrics.inc('files_scanned_total', len(batch))
+                yield batch
+        except KeyboardInterrupt:
+            logger.info("Stopped watching %s.", self.directory_path)
+
+
+    def upload_batches(self, batches, forget_caches=False):
+        '''Upload the WorkItems of every batch to the cloud services they are routed to. Small files are uploaded in
+        shards once enough of them are batched, and the last shard of every cloud service is uploaded at the end of
+        each batch. The manifest is committed after every batch, so a long watch keeps it current. With forget_caches,
+        the caches of the run are emptied after every batch with forget_batch_caches, so a long watch does not grow them.
+        Return the number of uploaded and failed files per cloud service'''
+
+        # Upload on worker threads when more than one worker is configured, otherwise upload on the calling thread
+        pools = self.start_worker_pools() if self.max_workers > 1 else {}
+        batchers = self.start_batchers()
+        self.metrics.start(self.metrics_interval)
+        self.watch_scheduler()
+        # Outcomes of the uploads made on the calling thread: uploaded, failed and unchanged files per cloud service
+        results = {service: [0, 0, 0] for service in self.services}
+
+        def dispatch(service, work):
+            if service in pools:
+                pools[service].submit(work)
+            else:
+                success = self.upload_work(service, work)
+                results[service][1 if success is False else 2 if success is None else 0] += 1
 
-                if not os.path.isfile(file_path):
-                    # If it is not a file, print an error message and skip to the next file
-                    print(f"Skipping {file_path}: not a file.")
+        try:
+            for items in batches:
+                for item in items:
+                    for service, work in self.route_item(item, batchers):
+                        dispatch(service, work)
+
+                # Upload the last shard of every cloud service
+                for service, batcher in batchers.items():
+                    batch = batcher.flush()
+                    if batch is not None:
+                        dispatch(service, batch)
+                if self.manifest is not None:
+                    self.manifest.commit()
+                if forget_caches:
+                    self.forget_batch_caches()
+        finally:
+            # Wait for the queued uploads to finish, even if the walk was interrupted
+            for service, pool in pools.items():
+                uploaded, failed = pool.join()
+                results[service] = [uploaded, failed, pool.skipped]
+            for service, (uploaded, failed, skipped) in results.items():
+                logger.info("%s: %s files uploaded, %s files failed, %s files unchanged.", service, uploaded, failed, skipped)
+            self.close_fanout_executors()
+            self.print_connection_stats()
+            self.print_compression_stats()
+
+            # Write the files uploaded by this run to the manifest and the saved bucket listings
+            if self.manifest is not None:
+                self.manifest.commit()
+            if self.remote_indexes is not None:
+                self.remote_indexes.save()
+            if self.hasher is not None:
+                self.hasher.close()
+            if self.scheduler is not None:
+                self.scheduler.stop()
+            self.metrics.stop()
+        return {service: (uploaded, failed) for service, (uploaded, failed, skipped) in results.items()}
+
+
+    def forget_batch_caches(self):
+        '''Empty the caches that otherwise live as long as the run: the digests of the FileHasher, the contents of
+        the DedupIndex and the expired bucket listings, keeping what the uploads in flight need, and close the GCS
+        clients of the threads that exited. Duplicates are then only found within a batch and the ones in flight'''
+
+        if self.hasher is not None:
+            self.hasher.forget_finished()
+        if self.dedup_index is not None:
+            self.dedup_index.forget_finished()
+        if self.remote_indexes is not None:
+            self.remote_indexes.forget_expired()
+        for uploader in list(self.uploaders.values()):
+            uploader.release_idle_clients()
+
+
+    def open_queue(self):
+        # Open the upload queue described by the 'queue' section of the config file
+        settings = self.config.get('queue', {})
+        return UploadQueue(settings.get('queue_file', 'upload_queue.db'), settings.get('lease_seconds', 300),
+                           settings.get('max_attempts', 3), settings.get('journal_mode', 'WAL'))
+
+
+    def enqueue_files(self, upload_queue):
+        '''Scan the directory tree and add a job to the upload queue for every file and cloud service it is routed to.
+        Return the number of jobs added, files already queued with the same size and mtime are not added again'''
+
+        # Check if the directory exists
+        if not os.path.isdir(self.directory_path):
+            logger.error("Error: Directory %s does not exist.", self.directory_path)
+            return 0
+
+        added = 0
+        jobs = []
+        scanner = DirectoryScanner(self.directory_path, self.router, self.scan_workers, self.queue_size)
+        for item in self.timed_scan(scanner.scan()):
+            for service in sorted(item.targets):
+                jobs.append((service, self.bucket_name(service), os.path.basename(item.path), item.path, item.size, item.mtime_ns))
+            # Insert the jobs in batches, so a huge tree is never held in memory
+            if len(jobs) >= 1000:
+                added += upload_queue.enqueue(jobs)
+                jobs = []
+        added += upload_queue.enqueue(jobs)
+        logger.info("%s jobs added to the upload queue.", added)
+        return added
+
+
+    def run_job(self, upload_queue, worker, job):
+        '''Upload one job claimed from the upload queue and record its outcome there. Return the outcome like upload_work'''
+
+        error = None
+        if job.service not in self.services or self.bucket_name(job.service) != job.bucket:
+            success = False
+            error = f"{job.service} bucket '{job.bucket}' is not configured"
+        else:
+            try:
+                success = self.upload_work(job.service, WorkItem(job.path, job.size, job.mtime_ns, frozenset((job.service,))))
+            except Exception as e:
+                success = False
+                error = str(e)
+        if success is False:
+            logger.error("Failed to upload '%s' to %s (attempt %s). Error: %s", job.path, job.service, job.attempts, error or 'upload failed')
+        if not upload_queue.complete(worker, job, success, error or ('upload failed' if success is False else None)):
+            logger.warning("The lease of '%s' for %s expired before its upload finished.", job.path, job.service)
+        return success
+
+
+    def work_queue(self, upload_queue, worker=None, stop_event=None):
+        '''Upload the jobs of the upload queue until no job is pending or leased, or stop_event is set. Jobs are claimed
+        max_workers at a time for the worker threads of the process, and a heartbeat thread renews the leases of the
+        jobs claimed by this worker until they are done. Return the number of jobs uploaded and failed by this worker'''
+
+        worker = worker or default_worker_id()
+        poll_interval = self.config.get('queue', {}).get('poll_interval', 5)
+        claimed = set()
+        lock = threading.Lock()
+        stopped = threading.Event()
+
+        def run(job):
+            try:
+                return self.run_job(upload_queue, worker, job)
+            finally:
+                with lock:
+                    claimed.discard(job.id)
+
+        def heartbeat():
+            # Renew the leases three times per lease period, so a slow upload never loses its lease
+            while not stopped.wait(upload_queue.lease_seconds / 3):
+                with lock:
+                    job_ids = list(claimed)
+                if job_ids:
+                    upload_queue.renew(worker, job_ids)
+
+        # Other processes record their jobs in the same manifest, so every record is committed at once
+        # instead of holding the write lock of the database for a whole batch
+        if self.manifest is not None:
+            self.manifest.commit()
+            self.manifest.commit_every = 1
+
+        pool = UploadWorkerPool(run, self.max_workers, self.max_workers, self.metrics)
+        pool.start()
+        renewer = threading.Thread(target=heartbeat, name='queue-heartbeat', daemon=True)
+        renewer.start()
+        self.metrics.start(self.metrics_interval)
+        try:
+            while stop_event is None or not stop_event.is_set():
+                # The pool queue holds max_workers jobs, so submit blocks while the workers are busy
+                jobs = upload_queue.claim(worker, self.max_workers)
+                for job in jobs:
+                    with lock:
+                        claimed.add(job.id)
+                    pool.submit(job)
+                if jobs:
                     continue
 
-                file_type = file.split('.')[-1].lower()
+                # Wait for the jobs leased by the other workers, whose leases may still expire
+                counts = upload_queue.counts()
+                if not counts[PENDING] and not counts[LEASED]:
+                    break
+                if stop_event is not None:
+                    stop_event.wait(poll_interval)
+                else:
+                    time.sleep(poll_interval)
+        finally:
+            # Wait for the claimed jobs to finish, even if the loop was interrupted
+            uploaded, failed = pool.join()
+            stopped.set()
+            renewer.join()
+            if self.manifest is not None:
+                self.manifest.commit()
+            if self.hasher is not None:
+                self.hasher.close()
+            if self.scheduler is not None:
+                self.scheduler.stop()
+            self.metrics.stop()
+
+        logger.info("Worker %s: %s jobs uploaded, %s jobs failed, %s jobs unchanged.", worker, uploaded, failed, pool.skipped)
+        return uploaded, failed
+
+
+    def backfill(self, processes=None):
+        '''Enqueue every file of the directory tree in the upload queue and upload the jobs with worker processes, each
+        running work_queue with its own uploaders. Workers on other hosts can work on the same queue file at the same time.
+        Return the number of jobs in each state at the end'''
+
+        processes = processes or self.config.get('queue', {}).get('processes', os.cpu_count() or 1)
+        upload_queue = self.open_queue()
+        try:
+            self.enqueue_files(upload_queue)
+
+            # Spawn the workers instead of forking, so they never inherit the threads and connections of this process
+            context = multiprocessing.get_context('spawn')
+            workers = [context.Process(target=_work_queue_process, args=(self.directory_path, self.config_file, self.upload_file_types),
+                                       name=f"upload-queue-worker-{i}") for i in range(processes)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+                if worker.exitcode:
+                    logger.error("%s exited with code %s, its jobs are retried once their leases expire.", worker.name, worker.exitcode)
+
+            # Upload in this process what crashed workers left behind
+            if any(worker.exitcode for worker in workers):
+                self.work_queue(upload_queue)
+
+            counts = upload_queue.counts()
+            for path, service, error in upload_queue.failures():
+                logger.error("Failed to upload '%s' to %s. Error: %s", path, service, error)
+            logger.info("Upload queue: %s jobs done, %s jobs failed.", counts['done'], counts['failed'])
+            return counts
+        finally:
+            upload_queue.close()
+
+
+def _work_queue_process(directory_path, config_file, upload_file_types):
+    # Entry point of a worker process of FileUploader.backfill. Metrics sinks are not shared between processes,
+    # so the workers do not report metrics
+    file_uploader = FileUploader(directory_path, config_file, upload_file_types, metrics=NULL_METRICS)
+    upload_queue = file_uploader.open_queue()
+    try:
+        file_uploader.work_queue(upload_queue)
+    finally:
+        upload_queue.close()
+        if file_uploader.manifest is not None:
+            file_uploader.manifest.close()
+
+
+class AsyncFileUploader(FileUploader):
+    '''Define a subclass of FileUploader that uploads files from an asyncio event loop.
+
+    Files are found by an async directory scan and uploaded with CloudUploader.upload_file_async.
+    A semaphore per cloud service limits the number of uploads in flight, and the scan waits
+    while a cloud service has no free slot, so memory stays bounded on huge directories.
+    '''
+
+    def __init__(self, directory_path, config_file, upload_file_types=FileUploader.UPLOAD_FILE_TYPES, metrics=None):
+        super().__init__(directory_path, config_file, upload_file_types, metrics)
+
+        # Read the maximum number of uploads in flight per cloud service
+        self.max_async_uploads = self.config.get('concurrency', {}).get('max_async_uploads', 64)
+        if not isinstance(self.max_async_uploads, int) or self.max_async_uploads < 1:
+            raise Exception(f"Error: 'max_async_uploads' in config file '{self.config_file}' must be a positive integer.")
+        # Every upload slot of the first cloud service of a file can fan it out
+        self.max_fanouts = self.max_async_uploads
+
+
+    async def scan_directory(self, executor=None):
+        # Walk the directory tree one directory at a time, listing each directory on a worker thread,
+        # and yield a WorkItem for every file routed to a cloud service
+        loop = asyncio.get_running_loop()
+        pending = [self.directory_path]
+        while pending:
+            directory = pending.pop()
+            try:
+                with self.metrics.time('stage_seconds', provider='all', stage='scan'):
+                    subdirectories, items = await loop.run_in_executor(executor, scan_directory_entries, directory, self.router)
+            except OSError as e:
+                # Skip directories that disappeared or cannot be read
+                logger.warning("Skipping %s: %s", directory, e)
+                continue
+
+            pending.extend(subdirectories)
+            self.metrics.inc('files_scanned_total', len(items))
+            for item in items:
+                yield item
+
+
+    async def upload_files_async(self):
+        # Check if the directory exists
+        if not os.path.isdir(self.directory_path):
+            logger.error("Error: Directory %s does not exist.", self.directory_path)
+            return {}
+
+        # Collect the configured cloud services, their uploaders are created by the first upload
+        services = self.services
+
+        semaphores = {service: asyncio.Semaphore(self.max_async_uploads) for service in services}
+        results = {service: [0, 0, 0] for service in services}
+        in_flight = {service: 0 for service in services}
+        tasks = set()
+
+        async def upload(service, item, executor):
+            # Release the slot of the cloud service whatever the outcome of the upload
+            loop = asyncio.get_running_loop()
+            if isinstance(item, ShardBatch):
+                file_path = item.key
+            elif isinstance(item, FanOutItem):
+                file_path = item.item.path
+            else:
+                file_path = item.path
+            scheduled = False
+            try:
+                # Wait for the concurrency budgets of the scheduler on a worker thread, outside of the event loop
+                if self.scheduler is not None:
+                    await loop.run_in_executor(executor, self.scheduler.acquire, service, self.work_priority(item))
+                    scheduled = True
+                if isinstance(item, (ShardBatch, FanOutItem)):
+                    success = await loop.run_in_executor(executor, self.send_work, service, item)
+                    if success is None:
+                        results[service][2] += 1
+                        return
+                    results[service][1 if success is False else 0] += 1
+                    return
+                state = await loop.run_in_executor(executor, self.prepare_upload, service, file_path, item)
+                if state is None:
+                    results[service][2] += 1
+                    self.metrics.inc('uploads_total', provider=service, outcome='skipped')
+                    return
+                started = time.monotonic()
+                if self.dedup_index is not None:
+                    success = await loop.run_in_executor(executor, self.send_deduplicated, service, file_path, state)
+                elif self.is_large_file(file_path, state[0]) or self.select_codec(file_path, state[0]) is not None:
+                    success = await loop.run_in_executor(executor, self.send_file, service, file_path, state[0])
+                else:
+                    # Create the uploader on a worker thread, importing its SDK would block the event loop
+                    uploader = self.uploaders.get(service) or await loop.run_in_executor(executor, self.get_uploader, service)
+                    success = await uploader.upload_file_async(file_path, executor=executor)
+                self.record_metrics(service, started, state[0], success)
+                await loop.run_in_executor(executor, self.finish_upload, service, file_path, state, success)
+            except Exception as e:
+                logger.error("Failed to upload %s. Error: %s", file_path, e)
+                success = False
+            finally:
+                if scheduled:
+                    self.scheduler.release(service)
+                for name in self.slot_services(service, item):
+                    semaphores[name].release()
+                    in_flight[name] -= 1
+                    self.metrics.set_gauge('uploads_in_flight', in_flight[name], provider=name)
+            results[service][1 if success is False else 0] += 1
+
+        # Size the executor so every upload slot and the directory scan can run at the same time
+        with ThreadPoolExecutor(max_workers=self.max_async_uploads * max(len(services), 1) + 1) as executor:
+            async def start(service, work):
+                # Wait for a free slot before starting the upload, a fanned-out file takes one of every cloud service it streams to
+                for name in self.slot_services(service, work):
+                    await semaphores[name].acquire()
+                    in_flight[name] += 1
+                    self.metrics.set_gauge('uploads_in_flight', in_flight[name], provider=name)
+                task = asyncio.create_task(upload(service, work, executor))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+            batchers = self.start_batchers()
+            self.metrics.start(self.metrics_interval)
+            self.watch_scheduler()
+            try:
+                async for item in self.scan_directory(executor):
+                    for service, work in self.route_item(item, batchers):
+                        await start(service, work)
+
+                # Upload the last shard of every cloud service
+                for service, batcher in batchers.items():
+                    batch = batcher.flush()
+                    if batch is not None:
+                        await start(service, batch)
+            finally:
+                # Wait for the uploads that are still in flight
+                if tasks:
+                    await asyncio.gather(*tasks, return_exceptions=True)
+                self.close_fanout_executors()
+                if self.manifest is not None:
+                    self.manifest.commit()
+                if self.remote_indexes is not None:
+                    self.remote_indexes.save()
+                if self.hasher is not None:
+                    self.hasher.close()
+                if self.scheduler is not None:
+                    self.scheduler.stop()
+                self.metrics.stop()
+
+        for service, (uploaded, failed, skipped) in results.items():
+            logger.info("%s: %s files uploaded, %s files failed, %s files unchanged.", service, uploaded, failed, skipped)
+        self.print_connection_stats()
+        self.print_compression_stats()
+        return {service: (uploaded, failed) for service, (uploaded, failed, skipped) in results.items()}
+
+
+def main(argv=None):
+    '''Entry point of the file-uploader console script. Return the exit status: 0 when every file was uploaded,
+    1 when uploads failed. --version, --help and --dry-run never import the cloud SDKs'''
+
+    parser = argparse.ArgumentParser(prog='file-uploader', description="Upload the files of a directory to AWS S3 and Google Cloud Storage.")
+    parser.add_argument('--version', action='version', version=f"%(prog)s {__version__}")
+    commands = parser.add_subparsers(dest='command', required=True)
+    sync = commands.add_parser('sync', help="upload the files of a directory tree to the cloud services of the config file")
+    sync.add_argument('directory', help="directory whose files are uploaded, with its subdirectories")
+    sync.add_argument('--config', default='config.json', help="JSON config file (default: config.json)")
+    sync.add_argument('--dry-run', action='store_true', help="list the files that would be uploaded without connecting to the cloud services")
+    mode = sync.add_mutually_exclusive_group()
+    mode.add_argument('--watch', action='store_true', help="keep uploading the files written to the directory until interrupted")
+    mode.add_argument('--async', dest='use_async', action='store_true', help="upload with AsyncFileUploader")
+    mode.add_argument('--backfill', type=int, nargs='?', const=0, metavar='PROCESSES',
+                      help="upload through the job queue with worker processes (default: the 'processes' of the 'queue' section)")
+    sync.add_argument('--quiet', action='store_true', help="only log warnings and errors, not every file uploaded")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING if args.quiet else logging.INFO, format='%(message)s')
+    # A missing directory is an error, not an empty run
+    if not os.path.isdir(args.directory):
+        logger.error("Error: Directory %s does not exist.", args.directory)
+        return 1
+    try:
+        if args.dry_run:
+            # Metrics would serve or write their values, a dry run has none
+            planned = FileUploader(args.directory, args.config, metrics=NULL_METRICS).dry_run()
+            for service, paths in planned.items():
+                for path in paths:
+                    print(f"{service}\t{path}")
+                logger.info("%s: %s files would be uploaded.", service, len(paths))
+            return 0
+
+        if args.use_async:
+            results = asyncio.run(AsyncFileUploader(args.directory, args.config).upload_files_async())
+            return 1 if any(failed for uploaded, failed in results.values()) else 0
 
-                # Upload the file to S3 if the file type is supported and the S3 uploader is initialized
-                if hasattr(self, 's3_uploader') and file_type in self.s3_uploader_file_types:
-                    self.s3_uploader.upload_file(file_path)
+        uploader = FileUploader(args.directory, args.config)
+        if args.backfill is not None:
+            counts = uploader.backfill(args.backfill or None)
+            return 1 if counts['failed'] else 0
+        results = uploader.watch() if args.watch else uploader.upload_files()
+        return 1 if any(failed for uploaded, failed in results.values()) else 0
+    except KeyboardInterrupt:
+        return 130
+    except Exception as e:
+        logger.error("%s", e)
+        return 1
 
-                # Upload the file to GCS if the file type is supported and the GCS uploader is initialized
-                if hasattr(self, 'gcs_uploader') and file_type in self.gcs_uploader_file_types:
-                    self.gcs_uploader.upload_file(file_path)
 
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,115 @@
+import io
+import math
+import os
+
+
+# Limits shared by S3 multipart uploads and GCS XML multipart uploads
+MAX_PARTS = 10000
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PART_SIZE = 5 * 1024 * 1024 * 1024
+
+
+def compute_part_size(file_size, preferred_part_size=8 * 1024 * 1024, max_parts=MAX_PARTS):
+    '''Return the part size to upload a file of file_size bytes with: the preferred part size,
+    grown in whole MiB until the file fits in max_parts parts'''
+
+    mib = 1024 * 1024
+    part_size = max(preferred_part_size, MIN_PART_SIZE, math.ceil(file_size / max_parts))
+    part_size = math.ceil(part_size / mib) * mib
+    if part_size > MAX_PART_SIZE:
+        raise ValueError(f"File of {file_size} bytes is too large for a multipart upload.")
+    return part_size
+
+
+def iter_parts(file_size, part_size):
+    # Yield (part_number, start, end) for every part of the file, part numbers start at 1
+    for part_number, start in enumerate(range(0, file_size, part_size), start=1):
+        yield part_number, start, min(start + part_size, file_size)
+
+
+class FilePart(io.RawIOBase):
+    '''Define a class called FilePart, a read-only file object over one part of a memory-mapped file.
+
+    The part is a memoryview slice of the mapping, so no copy of the part is made up front;
+    bytes are only copied when the HTTP client reads them. release() must be called once the
+    part is uploaded so the mapping can be closed.
+    '''
+
+    def __init__(self, view, start, end):
+        self._view = view[start:end]
+        self._position = 0
+
+    def __len__(self):
+        return len(self._view)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            position = offset
+        elif whence == os.SEEK_CUR:
+            position = self._position + offset
+        else:
+            position = len(self._view) + offset
+        self._position = min(max(position, 0), len(self._view))
+        return self._position
+
+    def readinto(self, buffer):
+        data = self._view[self._position:self._position + len(buffer)]
+        size = len(data)
+        buffer[:size] = data
+        self._position += size
+        return size
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self._view) - self._position
+        data = bytes(self._view[self._position:self._position + size])
+        self._position += len(data)
+        return data
+
+    def release(self):
+        # Drop the slice so the memory mapping has no exported buffer left
+        self._view.release()
+        self.close()
+
+
+def read_chunks(source, chunk_size):
+    '''Yield chunks of exactly chunk_size bytes, the last one possibly shorter, from a file object
+    (e.g. a pipe or sys.stdin.buffer) or from an iterable of bytes-like objects. At most one chunk
+    is buffered at a time, whatever the length of the source'''
+
+    if hasattr(source, 'read'):
+        while True:
+            # Pipes return short reads, keep reading until the chunk is full or the source ends
+            chunk = bytearray()
+            while len(chunk) < chunk_size:
+                data = source.read(chunk_size - len(chunk))
+                if not data:
+                    break
+                chunk += data
+            if not chunk:
+                return
+            yield chunk
+            if len(chunk) < chunk_size:
+                return
+    else:
+        chunk = bytearray()
+        for data in source:
+            # A piece that is exactly one chunk is passed on as is, without copying it
+            if not chunk and len(data) == chunk_size:
+                yield data
+                continue
+            chunk += data
+            while len(chunk) >= chunk_size:
+                yield chunk[:chunk_size]
+                del chunk[:chunk_size]
+        if chunk:
+            yield chunk
@@ -0,0 +1,107 @@
+import json
+import os
+import threading
+import time
+
+
+class RemoteIndex:
+    '''Define a class called RemoteIndex which holds what a bucket already contains under a prefix.
+
+    The index maps every object key to its size and MD5 hex digest (None when the provider does
+    not expose a plain MD5, e.g. for S3 multipart uploads), so files can be checked against the
+    bucket without a request per file.
+    '''
+
+    def __init__(self, objects=None, listed_at=None):
+        self.objects = objects if objects is not None else {}
+        self.listed_at = listed_at if listed_at is not None else time.time()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_listing(cls, listing):
+        # Build the index from (key, size, md5) tuples returned by CloudUploader.list_objects
+        return cls({key: (size, md5) for key, size, md5 in listing})
+
+    def matches(self, key, size, md5=None):
+        '''Return True when the bucket holds the key with the same size, and the same MD5 when both are known'''
+
+        remote = self.objects.get(key)
+        if remote is None or remote[0] != size:
+            return False
+        return md5 is None or remote[1] is None or remote[1] == md5
+
+    def add(self, key, size, md5=None):
+        # Keep the index current with the files uploaded by this run
+        with self._lock:
+            self.objects[key] = (size, md5)
+
+    def is_expired(self, ttl):
+        return time.time() - self.listed_at > ttl
+
+
+class RemoteIndexCache:
+    '''Define a class called RemoteIndexCache which keeps the RemoteIndex of every (service, bucket, prefix).
+
+    Indexes are listed on first use and reused until they are older than ttl seconds. When a cache
+    directory is given they are also saved there as JSON, so back-to-back runs do not list again.
+    '''
+
+    def __init__(self, ttl=3600, cache_dir=None):
+        self.ttl = ttl
+        self.cache_dir = cache_dir
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+
+    def _cache_file(self, service, bucket, prefix):
+        name = f"{service}-{bucket}-{prefix}".replace('/', '_')
+        return os.path.join(self.cache_dir, f"{name}.json")
+
+
+    def get(self, service, bucket, prefix, list_objects):
+        '''Return the RemoteIndex of the bucket under the prefix, calling list_objects(prefix) when it is missing or expired'''
+
+        key = (service, bucket, prefix)
+        with self._lock:
+            index = self._indexes.get(key)
+            if index is None and self.cache_dir is not None:
+                index = self._load(service, bucket, prefix)
+            if index is None or index.is_expired(self.ttl):
+                index = RemoteIndex.from_listing(list_objects(prefix))
+            self._indexes[key] = index
+            return index
+
+
+    def forget_expired(self):
+        '''Drop the indexes older than ttl, with the files added to them since they were listed. They would be
+        listed again on their next use anyway, so a long watch keeps at most one ttl worth of added files'''
+
+        with self._lock:
+            self._indexes = {key: index for key, index in self._indexes.items() if not index.is_expired(self.ttl)}
+
+
+    def _load(self, service, bucket, prefix):
+        # Read a saved index, ignoring a missing or unreadable cache file
+        try:
+            with open(self._cache_file(service, bucket, prefix)) as f:
+                data = json.load(f)
+            return RemoteIndex({key: tuple(value) for key, value in data['objects'].items()}, data['listed_at'])
+        except (OSError, ValueError, KeyError):
+            return None
+
+
+    def save(self):
+        '''Save every index to the cache directory'''
+
+        if self.cache_dir is None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with self._lock:
+            for (service, bucket, prefix), index in self._indexes.items():
+                cache_file = self._cache_file(service, bucket, prefix)
+                with index._lock:
+                    objects = dict(index.objects)
+                # Write to a temporary file first so an interrupted save never leaves a truncated cache
+                with open(cache_file + '.tmp', 'w') as f:
+                    json.dump({'listed_at': index.listed_at, 'objects': objects}, f)
+                os.replace(cache_file + '.tmp', cache_file)
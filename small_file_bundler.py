@@ -0,0 +1,135 @@
+import json
+import tarfile
+import time
+import uuid
+from collections import namedtuple
+
+
+# Size of a tar block: headers take whole blocks and member data is padded to a whole block
+BLOCK_SIZE = tarfile.BLOCKSIZE
+
+
+# A batch of small files to bundle: the key of its shard and its (name, WorkItem) pairs
+ShardBatch = namedtuple('ShardBatch', ['key', 'items'])
+
+
+def _padding(size):
+    return -size % BLOCK_SIZE
+
+
+class TarShard:
+    '''Define a class called TarShard which streams a batch of small files as one uncompressed tar archive.
+
+    The layout of the archive is computed from the sizes of the files before anything is read,
+    so the sidecar index with the offset of every member is known up front and the archive is
+    generated chunk by chunk while it is uploaded, without being written to disk. The index lets
+    a single file be fetched from the bucket with a ranged GET of its bytes.
+    '''
+
+    def __init__(self, key, members):
+        '''members is a list of (name, file_path, size, mtime_ns) tuples, name being the path stored in the archive'''
+
+        self.key = key
+        self.index_key = key + '.index.json'
+        self.members = []
+        offset = 0
+        for name, file_path, size, mtime_ns in members:
+            header = self._header(name, size, mtime_ns)
+            offset += len(header)
+            self.members.append((name, file_path, size, mtime_ns, header, offset))
+            offset += size + _padding(size)
+        # The archive ends with two zero blocks
+        self.size = offset + 2 * BLOCK_SIZE
+
+    @staticmethod
+    def _header(name, size, mtime_ns):
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = mtime_ns // 1_000_000_000
+        info.mode = 0o644
+        # PAX headers keep long and non-ASCII names intact
+        return info.tobuf(format=tarfile.PAX_FORMAT, encoding='utf-8', errors='surrogateescape')
+
+    @staticmethod
+    def member_size(name, size):
+        # Bytes a file adds to a shard, used to keep shards under their size limit
+        return len(TarShard._header(name, size, 0)) + size + _padding(size)
+
+    def stream(self, chunk_size=1024 * 1024):
+        '''Yield the bytes of the archive, reading every file in chunks of chunk_size bytes'''
+
+        for name, file_path, size, mtime_ns, header, offset in self.members:
+            yield header
+            with open(file_path, 'rb') as f:
+                # Only the size seen by the scan is read, so the offsets of the index stay valid
+                remaining = size
+                while remaining:
+                    data = f.read(min(chunk_size, remaining))
+                    if not data:
+                        raise Exception(f"File '{file_path}' shrank while it was bundled.")
+                    remaining -= len(data)
+                    yield data
+            if _padding(size):
+                yield bytes(_padding(size))
+        yield bytes(2 * BLOCK_SIZE)
+
+    def index(self):
+        '''Return the sidecar index of the shard: the byte offset and size of every member'''
+
+        return {
+            'shard': self.key,
+            'format': 'tar',
+            'size': self.size,
+            'members': {name: {'offset': offset, 'size': size, 'mtime_ns': mtime_ns}
+                        for name, file_path, size, mtime_ns, header, offset in self.members}
+        }
+
+    def index_json(self):
+        return json.dumps(self.index(), separators=(',', ':')).encode('utf-8')
+
+
+def member_range(index, name):
+    '''Return the HTTP Range header value fetching one member of a shard from its sidecar index,
+    e.g. s3.get_object(Bucket=..., Key=index['shard'], Range=member_range(index, name))'''
+
+    member = index['members'][name]
+    if member['size'] == 0:
+        raise ValueError(f"Member '{name}' is empty, there is no byte range to fetch.")
+    return f"bytes={member['offset']}-{member['offset'] + member['size'] - 1}"
+
+
+class ShardBatcher:
+    '''Define a class called ShardBatcher which groups small files into batches of at most shard_size archive bytes.
+
+    add() returns the full batch when the next file does not fit, flush() returns the last batch.
+    Every batch gets a unique key under key_prefix, made of the run ID and a sequence number.
+    '''
+
+    def __init__(self, shard_size, key_prefix='bundles/'):
+        self.shard_size = shard_size
+        self.key_prefix = key_prefix
+        self.run_id = f"{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        self._sequence = 0
+        self._items = []
+        self._size = 2 * BLOCK_SIZE
+
+    def add(self, name, item):
+        '''Add the WorkItem of a file stored as name in the archive. Return the ShardBatch it closed, or None'''
+
+        size = TarShard.member_size(name, item.size)
+        batch = None
+        if self._items and self._size + size > self.shard_size:
+            batch = self.flush()
+        self._items.append((name, item))
+        self._size += size
+        return batch
+
+    def flush(self):
+        # Return the pending batch, or None when there is none
+        if not self._items:
+            return None
+        self._sequence += 1
+        batch = ShardBatch(f"{self.key_prefix}{self.run_id}-{self._sequence:05d}.tar", self._items)
+        self._items = []
+        self._size = 2 * BLOCK_SIZE
+        return batch
@@ -0,0 +1,76 @@
+# Import necessary libraries and modules
+import hashlib
+import json
+import multiprocessing
+import os
+import tempfile
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import pytest
+
+import benchmark
+from benchmark import PROFILES, compare, generate_tree, run_benchmarks, run_case
+
+def tree_digests(directory):
+    digests = {}
+    for root, directories, files in os.walk(directory):
+        for name in files:
+            with open(os.path.join(root, name), 'rb') as f:
+                digests[os.path.relpath(os.path.join(root, name), directory)] = hashlib.md5(f.read()).hexdigest()
+    return digests
+
+# Test generate_tree writing the same tree for the same seed and reusing a tree that matches its description
+def test_generate_tree_is_reproducible():
+    profile = {'files': 25, 'min_size': 0, 'max_size': 5000, 'files_per_directory': 10}
+    with tempfile.TemporaryDirectory() as first, tempfile.TemporaryDirectory() as second:
+        description = generate_tree(first, profile, ['jpg', 'pdf', 'mp4'], seed=7)
+        assert generate_tree(second, profile, ['pdf', 'mp4', 'jpg'], seed=7) == description
+        assert tree_digests(first) == tree_digests(second)
+        assert description['files'] == 25
+        assert description['bytes'] == sum(os.path.getsize(os.path.join(root, name)) for root, directories, files in os.walk(first)
+                                           for name in files if name != 'tree.json')
+
+        # Check if a matching tree is reused and another seed writes another tree
+        mtimes = {name: os.stat(os.path.join(first, 'd00000', name)).st_mtime_ns for name in os.listdir(os.path.join(first, 'd00000'))}
+        assert generate_tree(first, profile, ['jpg', 'pdf', 'mp4'], seed=7) == description
+        assert mtimes == {name: os.stat(os.path.join(first, 'd00000', name)).st_mtime_ns for name in os.listdir(os.path.join(first, 'd00000'))}
+        assert generate_tree(second, profile, ['jpg', 'pdf', 'mp4'], seed=8)['bytes'] != description['bytes']
+
+# Test run_benchmarks uploading small and multipart files to the S3 and GCS stand-ins while they throttle
+def test_run_benchmarks_against_stand_ins():
+    with tempfile.TemporaryDirectory() as directory:
+        config_path = os.path.join(directory, 'config.json')
+        with open(config_path, 'w') as f:
+            json.dump({'cloud_services': {}, 'file_types': {'image': ['jpg'], 'media': ['mp4'], 'document': ['pdf']},
+                       'concurrency': {'max_workers': 4},
+                       'large_files': {'threshold': 6 * 1024 * 1024, 'part_size': 5 * 1024 * 1024}}, f)
+
+        profile = {'files': 9, 'min_size': 0, 'max_size': 12 * 1024 * 1024, 'files_per_directory': 5}
+        with patch.dict(PROFILES, {'test': profile}):
+            results = run_benchmarks(config_path, ('test',), workdir=os.path.join(directory, 'trees'), throttle_every=5, seed=3)
+
+        # Check if every file reached its stand-in despite the throttled requests, and the measurements are there
+        case = results['cases'][0]
+        assert case['name'] == 'test/config'
+        assert case['files_uploaded'] == case['tree_files'] == 9 and case['files_failed'] == 0
+        assert case['bytes'] == case['tree_bytes']
+        assert case['throttled'] > 0
+        assert case['files_per_second'] > 0 and case['mb_per_second'] > 0 and case['cpu_seconds'] > 0
+        assert json.loads(json.dumps(results)) == results
+
+        # Check if a run compares with itself as unchanged
+        assert compare(results, results)['test/config']['files_per_second'] == 1.0
+
+def _exit_without_result(*args):
+    os._exit(3)
+
+# Test run_case raising instead of waiting forever when the uploading process dies without a result
+def test_run_case_child_process_dies():
+    # Fork so the child runs the replaced case function, like a child killed by a crash or the OOM killer
+    fork = multiprocessing.get_context('fork')
+    server = SimpleNamespace(url='http://127.0.0.1:1', requests=0, throttled=0)
+    with tempfile.TemporaryDirectory() as directory, patch.object(benchmark, '_run_case', _exit_without_result), \
+            patch.object(benchmark.multiprocessing, 'get_context', lambda method: fork):
+        with pytest.raises(Exception, match='exited with code 3'):
+            run_case('crash', directory, {}, server, directory)
@@ -0,0 +1,58 @@
+# Import necessary libraries and modules
+import gzip
+import os
+import tempfile
+
+import pytest
+
+import compression
+from compression import CompressionStats, compress_file, get_codec, prefetch
+
+# Test compress_file streaming a gzip file and counting the bytes saved
+def test_compress_file_gzip():
+    with tempfile.NamedTemporaryFile('wb', suffix='.csv', delete=False) as f:
+        content = b'id,name,amount\n' + b''.join(b'%d,customer,%d\n' % (i, i * 7) for i in range(20000))
+        f.write(content)
+
+    stats = CompressionStats()
+    codec = get_codec('gzip')
+    assert codec.content_encoding == 'gzip'
+    compressed = b''.join(compress_file(f.name, codec, stats, chunk_size=4096))
+
+    # Check if the output is a valid gzip stream and the stats match it
+    assert gzip.decompress(compressed) == content
+    assert (stats.files, stats.raw_bytes, stats.compressed_bytes) == (1, len(content), len(compressed))
+    assert stats.saved_bytes > len(content) // 2
+    os.remove(f.name)
+
+# Test get_codec falling back to gzip when zstandard is not installed
+def test_get_codec_zstd_fallback(monkeypatch):
+    monkeypatch.setattr(compression, 'zstandard', None)
+    assert get_codec('zstd').content_encoding == 'gzip'
+    with pytest.raises(ValueError):
+        get_codec('brotli')
+
+# Test prefetch producing items ahead on another thread, raising its errors and stopping early
+def test_prefetch():
+    assert list(prefetch(iter(range(100)), depth=2)) == list(range(100))
+
+    def failing():
+        yield b'a'
+        raise OSError('disk error')
+    stream = prefetch(failing())
+    assert next(stream) == b'a'
+    with pytest.raises(OSError):
+        next(stream)
+
+    # Check if closing the consumer closes the producer
+    closed = []
+    def endless():
+        try:
+            while True:
+                yield b'x'
+        finally:
+            closed.append(True)
+    stream = prefetch(endless(), depth=2)
+    assert next(stream) == b'x'
+    stream.close()
+    assert closed == [True]
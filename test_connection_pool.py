@@ -0,0 +1,64 @@
+# Import necessary libraries and modules
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from connection_pool import ConnectionStats, ThreadLocalClients, mount_pooled_adapter, pool_manager_stats
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, format, *args):
+        pass
+
+# Test mount_pooled_adapter and pool_manager_stats counting the requests that reused a kept-alive connection
+def test_pooled_adapter_reuses_connections():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        with requests.Session() as session:
+            adapter = mount_pooled_adapter(session, 16)
+            assert adapter._pool_maxsize == 16
+            for _ in range(5):
+                assert session.get(f'http://127.0.0.1:{server.server_port}/').text == 'ok'
+
+            # Check if the five requests went through one connection
+            stats = pool_manager_stats([adapter.poolmanager])
+            assert stats == ConnectionStats(1, 5)
+            assert stats.reused == 4
+    finally:
+        server.shutdown()
+        server.server_close()
+
+# Test ThreadLocalClients creating one client per thread, reusing it within the thread and releasing it once the thread exited
+def test_threadlocalclients():
+    released = []
+    clients = ThreadLocalClients(object, released.append)
+    main_client = clients.get()
+    assert clients.get() is main_client
+
+    created = []
+    done = threading.Event()
+    thread = threading.Thread(target=lambda: (created.extend([clients.get(), clients.get()]), done.wait()))
+    thread.start()
+    while not created:
+        time.sleep(0.01)
+
+    # Check if the other thread got its own client, and every client is listed while its thread runs
+    assert created[0] is created[1] and created[0] is not main_client
+    assert clients.values() == [main_client, created[0]]
+
+    # The client of the exited thread is released and no longer kept
+    done.set()
+    thread.join()
+    clients.prune()
+    assert released == [created[0]]
+    assert clients.values() == [main_client]
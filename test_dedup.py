@@ -0,0 +1,81 @@
+# Import necessary libraries and modules
+import base64
+import hashlib
+import os
+import tempfile
+import threading
+from unittest.mock import patch
+
+import google_crc32c
+
+import dedup
+from dedup import DedupIndex, FileHasher, digest_file
+
+# Test digest_file computing the MD5 and CRC32C of a file in one pass
+def test_digest_file():
+    with tempfile.NamedTemporaryFile('wb', delete=False) as f:
+        content = os.urandom(300000)
+        f.write(content)
+
+    digest = digest_file(f.name, chunk_size=4096)
+    assert digest.size == len(content)
+    assert digest.md5_hex == hashlib.md5(content).hexdigest()
+    assert digest.md5_base64 == base64.b64encode(hashlib.md5(content).digest()).decode()
+    assert digest.crc32c == google_crc32c.Checksum(content).digest()
+    os.remove(f.name)
+
+# Test FileHasher reading every file once, on the calling thread or in the process pool
+def test_filehasher_caches_digests():
+    with tempfile.TemporaryDirectory() as directory:
+        small, big = os.path.join(directory, 'small.csv'), os.path.join(directory, 'big.csv')
+        with open(small, 'wb') as f:
+            f.write(b'a' * 10)
+        with open(big, 'wb') as f:
+            f.write(b'b' * 2000)
+
+        hasher = FileHasher(process_threshold=1000, max_processes=2)
+        try:
+            with patch('dedup.digest_file', wraps=dedup.digest_file) as mock_digest_file:
+                assert hasher.digest(small) == hasher.digest(small)
+                assert mock_digest_file.call_count == 1
+            # Check if the big file is hashed by the process pool, whose processes are spawned
+            assert hasher.digest(big).md5_hex == hashlib.md5(b'b' * 2000).hexdigest()
+            assert hasher._executor._mp_context.get_start_method() == 'spawn'
+
+            # Check if forgotten digests are computed again
+            hasher.forget_finished()
+            assert hasher._cache == {}
+            with patch('dedup.digest_file', wraps=dedup.digest_file) as mock_digest_file:
+                hasher.digest(small)
+                assert mock_digest_file.call_count == 1
+        finally:
+            hasher.close()
+
+# Test DedupIndex letting one upload of a content through and sharing its keys
+def test_dedupindex_claim_and_release():
+    digest = dedup.FileDigest(10, b'\x01' * 16, b'\x02' * 4)
+    index = DedupIndex()
+    assert index.claim('s3', digest, 'a.csv') is None
+
+    # Check if another thread waits for the upload in flight and gets its key
+    results = []
+    thread = threading.Thread(target=lambda: results.append(index.claim('s3', digest, 'b.csv')))
+    thread.start()
+    index.release('s3', digest, 'a.csv', True)
+    thread.join()
+    assert results == ['a.csv']
+
+    # Check if a key the content was copied to is returned as is
+    index.add_copy('s3', digest, 'b.csv')
+    assert index.claim('s3', digest, 'b.csv') == 'b.csv'
+
+    # Check if contents are tracked per cloud service and a failed upload can be claimed again
+    assert index.claim('gcs', digest, 'a.csv') is None
+    index.release('gcs', digest, 'a.csv', False)
+    assert index.claim('gcs', digest, 'a.csv') is None
+
+    # Check if forgetting drops the finished uploads only, the upload in flight can still be released
+    index.forget_finished()
+    assert index.claim('s3', digest, 'b.csv') is None
+    index.add_copy('azure', digest, 'c.csv')
+    index.release('gcs', digest, 'a.csv', True)
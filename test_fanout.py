@@ -0,0 +1,48 @@
+# Import necessary libraries and modules
+import os
+import tempfile
+import threading
+
+from fanout import fan_out
+
+# Test fan_out reading a file once and streaming the same chunks to every target
+def test_fan_out_shares_chunks():
+    with tempfile.NamedTemporaryFile('wb', delete=False) as f:
+        content = os.urandom(10000)
+        f.write(content)
+
+    received = {'s3': [], 'gcs': []}
+    def target(name):
+        def upload(chunks):
+            for chunk in chunks:
+                received[name].append(chunk)
+            return True
+        return upload
+
+    assert fan_out(f.name, {'s3': target('s3'), 'gcs': target('gcs')}, chunk_size=1024, max_buffered=2) == {'s3': True, 'gcs': True}
+
+    # Check if both targets got the whole file as the very same chunk objects
+    assert b''.join(received['s3']) == content
+    assert all(a is b for a, b in zip(received['s3'], received['gcs']))
+    os.remove(f.name)
+
+# Test fan_out completing the other targets when one target fails
+def test_fan_out_failed_target_does_not_stall():
+    with tempfile.NamedTemporaryFile('wb', delete=False) as f:
+        f.write(os.urandom(100000))
+
+    def failing(chunks):
+        next(iter(chunks))
+        raise ConnectionError('connection reset')
+
+    received = []
+    def slow(chunks):
+        for chunk in chunks:
+            threading.Event().wait(0.001)
+            received.append(chunk)
+        return True
+
+    # Check if the healthy target gets the whole file while the failed one is dropped
+    assert fan_out(f.name, {'s3': failing, 'gcs': slow}, chunk_size=1000, max_buffered=1) == {'s3': False, 'gcs': True}
+    assert sum(len(chunk) for chunk in received) == 100000
+    os.remove(f.name)
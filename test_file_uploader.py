@@ -1,11 +1,27 @@
 # Import necessary libraries and modules
+import asyncio
+import gzip
+import hashlib
+import io
 import json
 import os
+import subprocess
+import sys
+import threading
 import tempfile
-from unittest.mock import MagicMock, patch
+import time
+from unittest.mock import ANY, MagicMock, patch
+import botocore.exceptions
 import pytest
 
-from file_uploader import CloudUploader, S3Uploader, GCSUploader, FileUploader
+from file_uploader import CloudUploader, S3Uploader, GCSUploader, FileUploader, UploadWorkerPool, AsyncFileUploader, main
+from connection_pool import ConnectionStats
+from dedup import digest_file
+from upload_checkpoint import CheckpointStore
+from upload_manifest import UploadManifest
+from upload_metrics import CallbackSink, Metrics
+from upload_retry import AdaptiveRateLimiter, RetryPolicy
+from upload_scanner import DirectoryScanner
 
 # Test if CloudUploader is an abstract base class
 def test_clouduploader_abstract_methods():
@@ -149,17 +165,1004 @@ def test_fileuploader_upload_files():
         f.write('{"cloud_services": {"s3": {"bucket_name": "test_s3_bucket", "credentials_file": "test_s3_credentials.csv"}, "gcs": {"bucket_name": "test_gcs_bucket", "credentials_file": "test_gcs_credentials.json"}}, "file_types": {"image": ["jpg", "png"], "media": ["mp4"], "document": ["pdf"]}}')
         f.flush()
 
-        # Mock the S3Uploader and GCSUploader classes
-        with patch('file_uploader.S3Uploader') as mock_s3_uploader, patch('file_uploader.GCSUploader') as mock_gcs_uploader, patch('file_uploader.os.walk') as mock_os_walk:
-            # Set the return value of os.walk() to mimic a directory with three files
-            mock_os_walk.return_value = [('test_directory', [], ['test_image.jpg', 'test_video.mp4', 'test_document.pdf'])]
-            # Create a FileUploader instance
-            file_uploader = FileUploader('test_directory', f.name)
-            # Call the upload_files() method and check if the upload_file() method is called for each file with the correct file paths
-            file_uploader.upload_files()
-            mock_s3_uploader.return_value.upload_file.assert_any_call('test_directory/test_image.jpg')
-            mock_s3_uploader.return_value.upload_file.assert_any_call('test_directory/test_video.mp4')
-            mock_gcs_uploader.return_value.upload_file.assert_any_call('test_directory/test_document.pdf')
+        # Create a temporary directory with three files, one per file type
+        with tempfile.TemporaryDirectory() as directory:
+            for name in ('test_image.jpg', 'test_video.mp4', 'test_document.pdf'):
+                open(os.path.join(directory, name), 'w').close()
+
+            # Mock the S3Uploader and GCSUploader classes
+            with patch('file_uploader.S3Uploader') as mock_s3_uploader, patch('file_uploader.GCSUploader') as mock_gcs_uploader:
+                # Create a FileUploader instance
+                file_uploader = FileUploader(directory, f.name)
+                # Call the upload_files() method and check if the upload_file() method is called for each file with the correct file paths
+                file_uploader.upload_files()
+                mock_s3_uploader.return_value.upload_file.assert_any_call(os.path.join(directory, 'test_image.jpg'))
+                mock_s3_uploader.return_value.upload_file.assert_any_call(os.path.join(directory, 'test_video.mp4'))
+                mock_gcs_uploader.return_value.upload_file.assert_any_call(os.path.join(directory, 'test_document.pdf'))
 
     # Clean up the temporary file
     os.remove(f.name)
+
+# Test UploadWorkerPool uploading every submitted file and counting failures
+def test_uploadworkerpool_counts_results():
+    # Fail every file whose name contains 'bad', succeed otherwise
+    upload_func = MagicMock(side_effect=lambda file_path: 'bad' not in file_path)
+    pool = UploadWorkerPool(upload_func, max_workers=3, queue_size=2)
+    pool.start()
+    for i in range(10):
+        pool.submit(f'good_{i}.jpg')
+    pool.submit('bad.jpg')
+    # Check if every file was uploaded once and the failure was counted
+    assert pool.join() == (10, 1)
+    assert upload_func.call_count == 11
+
+# Test UploadWorkerPool taking the waiting file of the lowest priority first
+def test_uploadworkerpool_priority():
+    uploaded = []
+    priorities = {'video.mp4': 2, 'photo.jpg': 1, 'report.pdf': 0, 'notes.pdf': 0}
+    pool = UploadWorkerPool(lambda file_path: uploaded.append(file_path) or True, max_workers=1, queue_size=10, priority=priorities.get)
+    # Queue every file before the worker starts
+    for file_path in ('video.mp4', 'photo.jpg', 'report.pdf', 'notes.pdf'):
+        pool.submit(file_path)
+    pool.start()
+    assert pool.join() == (4, 0)
+    # Files of the same priority keep the order they were submitted in
+    assert uploaded == ['report.pdf', 'notes.pdf', 'photo.jpg', 'video.mp4']
+
+# Test FileUploader's upload_files() method with concurrent uploads enabled
+def test_fileuploader_upload_files_concurrent():
+    with tempfile.TemporaryDirectory() as directory:
+        # Create a small directory tree with files for both cloud services
+        os.makedirs(os.path.join(directory, 'sub'))
+        for name in ('a.jpg', 'b.mp4', os.path.join('sub', 'c.png'), os.path.join('sub', 'd.pdf')):
+            open(os.path.join(directory, name), 'w').close()
+
+        # Create a configuration file with four workers per cloud service
+        config_path = os.path.join(directory, 'config.json')
+        with open(config_path, 'w') as f:
+            f.write('{"cloud_services": {"s3": {"bucket_name": "test_s3_bucket", "credentials_file": "test_s3_credentials.csv"}, "gcs": {"bucket_name": "test_gcs_bucket", "credentials_file": "test_gcs_credentials.json"}}, "file_types": {"image": ["jpg", "png"], "media": ["mp4"], "document": ["pdf"]}, "concurrency": {"max_workers": 4, "queue_size": 1}}')
+
+        with patch('file_uploader.S3Uploader') as mock_s3_uploader, patch('file_uploader.GCSUploader') as mock_gcs_uploader:
+            file_uploader = FileUploader(directory, config_path)
+            file_uploader.upload_files()
+            # Check if every file was uploaded to the right cloud service exactly once
+            s3_calls = sorted(c.args[0] for c in mock_s3_uploader.return_value.upload_file.call_args_list)
+            gcs_calls = sorted(c.args[0] for c in mock_gcs_uploader.return_value.upload_file.call_args_list)
+            assert s3_calls == sorted(os.path.join(directory, n) for n in ('a.jpg', 'b.mp4', os.path.join('sub', 'c.png')))
+            assert gcs_calls == [os.path.join(directory, 'sub', 'd.pdf')]
+
+# Test FileUploader rejecting an invalid worker count
+def test_fileuploader_invalid_max_workers():
+    with tempfile.NamedTemporaryFile('w', newline='', delete=False) as f:
+        f.write('{"cloud_services": {}, "file_types": {}, "concurrency": {"max_workers": 0}}')
+        f.flush()
+        with pytest.raises(Exception):
+            FileUploader('test_directory', f.name)
+    os.remove(f.name)
+
+# Test CloudUploader's default upload_file_async() running upload_file off the event loop thread
+def test_clouduploader_upload_file_async():
+    class DummyUploader(CloudUploader):
+        def __init__(self, bucket_name, credentials_file):
+            self.threads = []
+
+        def upload_file(self, file_path):
+            self.threads.append(threading.current_thread())
+            return True
+
+        def list_objects(self, prefix=''):
+            return iter(())
+
+        def upload_stream(self, key, stream, part_size=None, max_workers=None):
+            return True
+
+    uploader = DummyUploader('test_bucket', 'test_credentials')
+    # Check if the upload result is returned and the upload ran on another thread
+    assert asyncio.run(uploader.upload_file_async('test_file_path')) is True
+    assert uploader.threads[0] is not threading.main_thread()
+
+# Test AsyncFileUploader's upload_files_async() method respecting the per-service concurrency limit
+def test_asyncfileuploader_upload_files_async():
+    class FakeUploader:
+        def __init__(self):
+            self.in_flight = 0
+            self.max_in_flight = 0
+            self.uploaded = []
+
+        def set_retry_policy(self, retry_policy, rate_limiter=None):
+            pass
+
+        def connection_stats(self):
+            return None
+
+        async def upload_file_async(self, file_path, executor=None):
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            await asyncio.sleep(0.01)
+            self.in_flight -= 1
+            self.uploaded.append(file_path)
+            return True
+
+    with tempfile.TemporaryDirectory() as directory:
+        # Create ten images in a subdirectory and one document
+        os.makedirs(os.path.join(directory, 'sub'))
+        for i in range(10):
+            open(os.path.join(directory, 'sub', f'{i}.jpg'), 'w').close()
+        open(os.path.join(directory, 'doc.pdf'), 'w').close()
+
+        config_path = os.path.join(directory, 'config.json')
+        with open(config_path, 'w') as f:
+            f.write('{"cloud_services": {"s3": {"bucket_name": "test_s3_bucket", "credentials_file": "test_s3_credentials.csv"}, "gcs": {"bucket_name": "test_gcs_bucket", "credentials_file": "test_gcs_credentials.json"}}, "file_types": {"image": ["jpg"], "media": [], "document": ["pdf"]}, "concurrency": {"max_async_uploads": 3}}')
+
+        s3_uploader, gcs_uploader = FakeUploader(), FakeUploader()
+        with patch('file_uploader.S3Uploader', return_value=s3_uploader), patch('file_uploader.GCSUploader', return_value=gcs_uploader):
+            file_uploader = AsyncFileUploader(directory, config_path)
+            results = asyncio.run(file_uploader.upload_files_async())
+
+        # Check if every file was uploaded to the right cloud service with at most three uploads in flight
+        assert results == {'s3': (10, 0), 'gcs': (1, 0)}
+        assert len(s3_uploader.uploaded) == 10
+        assert gcs_uploader.uploaded == [os.path.join(directory, 'doc.pdf')]
+        assert 1 < s3_uploader.max_in_flight <= 3
+
+# Test S3Uploader's upload_files_single_call() submitting the batch to one shared TransferManager
+def test_s3uploader_upload_files_single_call():
+    with patch('file_uploader.boto3') as mock_boto3, patch.object(S3Uploader, 'read_credentials', return_value=('key', 'secret')):
+        s3_uploader = S3Uploader('test_bucket', 'test_credentials.csv')
+        manager = mock_boto3.s3.transfer.create_transfer_manager.return_value
+
+        # Make the second file fail and report a size of 42 bytes for the others
+        ok_future, failed_future = MagicMock(), MagicMock()
+        ok_future.meta.size = 42
+        failed_future.result.side_effect = RuntimeError('upload failed')
+        manager.upload.side_effect = [ok_future, failed_future, ok_future, ok_future]
+
+        results = s3_uploader.upload_files_single_call(['dir/a.jpg', 'dir/b.jpg'])
+        results += s3_uploader.upload_files_single_call(['dir/c.jpg', 'dir/d.jpg'])
+
+        # Check if both batches reused the same TransferManager and every file got a result in order
+        mock_boto3.s3.transfer.create_transfer_manager.assert_called_once()
+        manager.upload.assert_any_call('dir/a.jpg', 'test_bucket', 'a.jpg', subscribers=[ANY])
+        assert [r.key for r in results] == ['a.jpg', 'b.jpg', 'c.jpg', 'd.jpg']
+        assert [r.success for r in results] == [True, False, True, True]
+        assert results[0].bytes == 42
+        assert isinstance(results[1].error, RuntimeError)
+
+        # Check if close() shuts the TransferManager down
+        s3_uploader.close()
+        manager.shutdown.assert_called_once()
+
+# Test S3Uploader's list_objects() paginating list_objects_v2 and dropping multipart ETags
+def test_s3uploader_list_objects():
+    with patch('file_uploader.boto3') as mock_boto3, patch.object(S3Uploader, 'read_credentials', return_value=('key', 'secret')):
+        s3_uploader = S3Uploader('test_bucket', 'test_credentials.csv')
+        paginator = mock_boto3.client.return_value.get_paginator.return_value
+        paginator.paginate.return_value = [
+            {'Contents': [{'Key': 'a.jpg', 'Size': 1, 'ETag': '"0cc175b9c0f1b6a831c399e269772661"'}]},
+            {'Contents': [{'Key': 'b.mp4', 'Size': 2, 'ETag': '"9b2cf535f27731c974343645a3985328-2"'}]},
+            {}
+        ]
+        assert list(s3_uploader.list_objects('photos/')) == [('a.jpg', 1, '0cc175b9c0f1b6a831c399e269772661'), ('b.mp4', 2, None)]
+        paginator.paginate.assert_called_once_with(Bucket='test_bucket', Prefix='photos/')
+
+# Test GCSUploader's list_objects() converting the base64 MD5 of every blob to hex
+def test_gcsuploader_list_objects():
+    with patch('file_uploader.storage') as mock_storage:
+        gcs_uploader = GCSUploader('test_bucket', 'test_credentials.json')
+        blob = MagicMock()
+        blob.name, blob.size, blob.md5_hash = 'a.pdf', 1, 'DMF1ucDxtqgxw5niaXcmYQ=='
+        gcs_uploader.gcs.list_blobs.return_value = iter([blob])
+        assert list(gcs_uploader.list_objects()) == [('a.pdf', 1, '0cc175b9c0f1b6a831c399e269772661')]
+
+# Test FileUploader skipping files the bucket listing shows are already uploaded
+def test_fileuploader_remote_index(caplog):
+    with tempfile.TemporaryDirectory() as directory:
+        data = os.path.join(directory, 'data')
+        os.makedirs(data)
+        for name, content in (('a.jpg', 'a'), ('b.jpg', 'bb'), ('c.jpg', 'c')):
+            with open(os.path.join(data, name), 'w') as f:
+                f.write(content)
+
+        config_path = os.path.join(directory, 'config.json')
+        with open(config_path, 'w') as f:
+            json.dump({"cloud_services": {"s3": {"bucket_name": "test_s3_bucket", "credentials_file": "test_s3_credentials.csv"}},
+                       "file_types": {"image": ["jpg"], "media": []},
+                       "remote_index": {"enabled": True, "ttl": 600, "cache_dir": os.path.join(directory, 'cache'), "prefix": "photos/"}}, f)
+
+        with patch('file_uploader.S3Uploader') as mock_s3_uploader:
+            mock_s3_uploader.return_value.bucket_name = 'test_s3_bucket'
+            list_objects = mock_s3_uploader.return_value.list_objects
+            upload_file = mock_s3_uploader.return_value.upload_file
+            # The bucket holds a.jpg with the same size and b.jpg with another size
+            list_objects.return_value = iter([('a.jpg', 1, None), ('b.jpg', 5, None)])
+
+            FileUploader(data, config_path).upload_files()
+            # Check if the whole bucket is listed, where the files are uploaded, whatever the prefix
+            list_objects.assert_called_once_with('')
+            assert "'prefix' of the 'remote_index' section is ignored" in caplog.text
+            assert sorted(c.args[0] for c in upload_file.call_args_list) == [os.path.join(data, 'b.jpg'), os.path.join(data, 'c.jpg')]
+
+            # A second run within the TTL reuses the saved listing, which now includes the uploaded files
+            list_objects.reset_mock()
+            upload_file.reset_mock()
+            FileUploader(data, config_path).upload_files()
+            list_objects.assert_not_called()
+            upload_file.assert_not_called()
+
+# Test S3Uploader's upload_large_file() uploading every part and completing the multipart upload
+def test_s3uploader_upload_large_file():
+    with tempfile.NamedTemporaryFile('wb', delete=False) as f:
+        content = os.urandom(12 * 1024 * 1024)
+        f.write(content)
+
+    with patch('file_uploader.boto3') as mock_boto3, patch.object(S3Uploader, 'read_credentials', return_value=('key', 'secret')):
+        s3_uploader = S3Uploader('test_bucket', 'test_credentials.csv')
+        client = mock_boto3.client.return_value
+        client.create_multipart_upload.return_value = {'UploadId': 'upload-1'}
+
+        # Keep the bytes of every uploaded part
+        received = {}
+        def upload_part(Body, PartNumber, **kwargs):
+            received[PartNumber] = Body.read()
+            return {'ETag': f'etag-{PartNumber}'}
+        client.upload_part.side_effect = upload_part
+
+        assert s3_uploader.upload_large_file(f.name, part_size=5 * 1024 * 1024, max_workers=3) is True
+
+        # Check if the parts cover the file and were completed in order
+        assert b''.join(received[n] for n in sorted(received)) == content
+        client.complete_multipart_upload.assert_called_once_with(
+            Bucket='test_bucket', Key=os.path.basename(f.name), UploadId='upload-1',
+            MultipartUpload={'Parts': [{'ETag': 'etag-1', 'PartNumber': 1}, {'ETag': 'etag-2', 'PartNumber': 2}, {'ETag': 'etag-3', 'PartNumber': 3}]}
+        )
+        client.abort_multipart_upload.assert_not_called()
+
+        # Check if a failed part aborts the multipart upload
+        client.upload_part.side_effect = RuntimeError('connection reset')
+        assert s3_uploader.upload_large_file(f.name, part_size=5 * 1024 * 1024) is False
+        client.abort_multipart_upload.assert_called_once_with(Bucket='test_bucket', Key=os.path.basename(f.name), UploadId='upload-1')
+
+    os.remove(f.name)
+
+# Test GCSUploader's upload_large_file() uploading the parts concurrently with the transfer manager
+def test_gcsuploader_upload_large_file():
+    with tempfile.NamedTemporaryFile('wb', delete=False) as f:
+        f.write(b'x' * 1024)
+
+    with patch('file_uploader.storage'), patch('file_uploader.transfer_manager') as mock_transfer_manager:
+        gcs_uploader = GCSUploader('test_bucket', 'test_credentials.json')
+        assert gcs_uploader.upload_large_file(f.name, max_workers=4) is True
+        blob = gcs_uploader.gcs.bucket.return_value.blob.return_value
+        mock_transfer_manager.upload_chunks_concurrently.assert_called_once_with(
+            f.name, blob, chunk_size=16 * 1024 * 1024, max_workers=4, worker_type=mock_transfer_manager.THREAD
+        )
+
+    os.remove(f.name)
+
+# Test FileUploader routing files above the large file threshold to upload_large_file()
+def test_fileuploader_large_files():
+    with tempfile.TemporaryDirectory() as directory:
+        with open(os.path.join(directory, 'small.jpg'), 'wb') as f:
+            f.write(b'x' * 10)
+        with open(os.path.join(directory, 'large.mp4'), 'wb') as f:
+            f.write(b'x' * 100)
+
+        config_path = os.path.join(directory, 'config.json')
+        with open(config_path, 'w') as f:
+            json.dump({"cloud_services": {"s3": {"bucket_name": "test_s3_bucket", "credentials_file": "test_s3_credentials.csv"}},
+                       "file_types": {"image": ["jpg"], "media": ["mp4"]},
+                       "large_files": {"threshold": 50, "part_size": 8388608, "max_workers": 2}}, f)
+
+        with patch('file_uploader.S3Uploader') as mock_s3_uploader:
+            FileUploader(directory, config_path).upload_files()
+            mock_s3_uploader.return_value.upload_file.assert_called_once_with(os.path.join(directory, 'small.jpg'))
+            mock_s3_uploader.return_value.upload_large_file.assert_called_once_with(os.path.join(directory, 'large.mp4'), 8388608, 2, None)
+
+# Test S3Uploader's upload_large_file() resuming an interrupted upload from its checkpoint
+def test_s3uploader_upload_large_file_resume():
+    with tempfile.TemporaryDirectory() as directory:
+        file_path = os.path.join(directory, 'video.mp4')
+        with open(file_path, 'wb') as f:
+            f.write(os.urandom(12 * 1024 * 1024))
+        stat = os.stat(file_path)
+        checkpoints = CheckpointStore(os.path.join(directory, 'checkpoints'))
+
+        with patch('file_uploader.boto3') as mock_boto3, patch.object(S3Uploader, 'read_credentials', return_value=('key', 'secret')):
+            s3_uploader = S3Uploader('test_bucket', 'test_credentials.csv')
+            client = mock_boto3.client.return_value
+
+            # An earlier run uploaded parts 1 and 2, but S3 only still holds part 1 with the same ETag
+            checkpoint = checkpoints.create('s3', 'test_bucket', 'video.mp4', 'upload-1', 5 * 1024 * 1024, stat.st_size, stat.st_mtime_ns)
+            checkpoint.add_part(1, 'etag-1')
+            checkpoint.add_part(2, 'etag-2')
+            client.get_paginator.return_value.paginate.return_value = [{'Parts': [{'PartNumber': 1, 'ETag': 'etag-1'}]}]
+            client.upload_part.side_effect = lambda PartNumber, **kwargs: {'ETag': f'new-{PartNumber}'}
+
+            assert s3_uploader.upload_large_file(file_path, checkpoints=checkpoints) is True
+
+            # Check if only the missing parts were uploaded to the existing multipart upload
+            client.create_multipart_upload.assert_not_called()
+            assert sorted(c.kwargs['PartNumber'] for c in client.upload_part.call_args_list) == [2, 3]
+            assert client.complete_multipart_upload.call_args.kwargs['MultipartUpload'] == {'Parts': [
+                {'ETag': 'etag-1', 'PartNumber': 1}, {'ETag': 'new-2', 'PartNumber': 2}, {'ETag': 'new-3', 'PartNumber': 3}]}
+            assert checkpoints.load('s3', 'test_bucket', 'video.mp4') is None
+
+            # A failed upload keeps its multipart upload and checkpoint instead of aborting
+            client.create_multipart_upload.return_value = {'UploadId': 'upload-2'}
+            client.upload_part.side_effect = lambda PartNumber, **kwargs: {'ETag': 'etag'} if PartNumber == 1 else 1 / 0
+            assert s3_uploader.upload_large_file(file_path, part_size=5 * 1024 * 1024, max_workers=1, checkpoints=checkpoints) is False
+            client.abort_multipart_upload.assert_not_called()
+            assert checkpoints.load('s3', 'test_bucket', 'video.mp4').parts == {1: 'etag'}
+
+            # A checkpoint whose multipart upload no longer exists is replaced by a fresh upload
+            error = botocore.exceptions.ClientError({'Error': {'Code': 'NoSuchUpload'}}, 'ListParts')
+            client.get_paginator.return_value.paginate.side_effect = error
+            client.create_multipart_upload.return_value = {'UploadId': 'upload-3'}
+            client.upload_part.side_effect = lambda PartNumber, **kwargs: {'ETag': f'etag-{PartNumber}'}
+            assert s3_uploader.upload_large_file(file_path, checkpoints=checkpoints) is True
+            assert client.complete_multipart_upload.call_args.kwargs['UploadId'] == 'upload-3'
+
+# Test GCSUploader's upload_large_file() resuming a resumable upload session from its checkpoint
+def test_gcsuploader_upload_large_file_resume():
+    mib = 1024 * 1024
+    with tempfile.TemporaryDirectory() as directory:
+        file_path = os.path.join(directory, 'video.mp4')
+        with open(file_path, 'wb') as f:
+            f.write(b'x' * 12 * mib)
+        stat = os.stat(file_path)
+        checkpoints = CheckpointStore(os.path.join(directory, 'checkpoints'))
+        checkpoints.create('gcs', 'test_bucket', 'video.mp4', 'https://session', 5 * mib, stat.st_size, stat.st_mtime_ns)
+
+        with patch('file_uploader.storage'):
+            gcs_uploader = GCSUploader('test_bucket', 'test_credentials.json')
+            gcs_uploader.gcs.bucket.return_value.blob.return_value.name = 'video.mp4'
+
+            # GCS committed the first chunk, then accepts the second chunk and finishes with the third
+            def response(status_code, committed=None):
+                return MagicMock(status_code=status_code, headers={'Range': f'bytes=0-{committed - 1}'} if committed else {})
+            transport = gcs_uploader.gcs._http
+            transport.put.side_effect = [response(308, 5 * mib), response(308, 10 * mib), response(200)]
+
+            assert gcs_uploader.upload_large_file(file_path, checkpoints=checkpoints) is True
+
+            # Check if the session was queried and only the missing bytes were sent
+            ranges = [c.kwargs['headers']['Content-Range'] for c in transport.put.call_args_list]
+            assert ranges == [f'bytes */{12 * mib}', f'bytes {5 * mib}-{10 * mib - 1}/{12 * mib}', f'bytes {10 * mib}-{12 * mib - 1}/{12 * mib}']
+            gcs_uploader.gcs.bucket.return_value.blob.return_value.create_resumable_upload_session.assert_not_called()
+            assert checkpoints.load('gcs', 'test_bucket', 'video.mp4') is None
+
+# Test S3Uploader's upload_stream() sending a short stream with a single PUT
+def test_s3uploader_upload_stream_single_put():
+    with patch('file_uploader.boto3') as mock_boto3, patch.object(S3Uploader, 'read_credentials', return_value=('key', 'secret')):
+        s3_uploader = S3Uploader('test_bucket', 'test_credentials.csv')
+        client = mock_boto3.client.return_value
+        assert s3_uploader.upload_stream('export.csv', io.BytesIO(b'a,b\n1,2\n')) is True
+        client.put_object.assert_called_once_with(Bucket='test_bucket', Key='export.csv', Body=b'a,b\n1,2\n')
+        client.create_multipart_upload.assert_not_called()
+
+# Test S3Uploader's upload_stream() cutting a generator into parts with bounded memory
+def test_s3uploader_upload_stream_multipart():
+    with patch('file_uploader.boto3') as mock_boto3, patch.object(S3Uploader, 'read_credentials', return_value=('key', 'secret')):
+        s3_uploader = S3Uploader('test_bucket', 'test_credentials.csv')
+        client = mock_boto3.client.return_value
+        client.create_multipart_upload.return_value = {'UploadId': 'upload-1'}
+
+        # Track how many parts are in flight at once
+        lock = threading.Lock()
+        state = {'in_flight': 0, 'max_in_flight': 0, 'read': 0, 'uploaded': 0, 'max_buffered': 0}
+        received = {}
+        def upload_part(Body, PartNumber, **kwargs):
+            with lock:
+                state['in_flight'] += 1
+                state['max_in_flight'] = max(state['max_in_flight'], state['in_flight'])
+            threading.Event().wait(0.01)
+            received[PartNumber] = Body
+            with lock:
+                state['in_flight'] -= 1
+                state['uploaded'] += len(Body)
+            return {'ETag': f'etag-{PartNumber}'}
+        client.upload_part.side_effect = upload_part
+
+        # A generator of 7-byte pieces, 100 bytes in total, tracking the bytes read but not uploaded yet
+        data = bytes(range(100))
+        def pieces():
+            for i in range(0, 100, 7):
+                with lock:
+                    state['read'] += len(data[i:i + 7])
+                    state['max_buffered'] = max(state['max_buffered'], state['read'] - state['uploaded'])
+                yield data[i:i + 7]
+        assert s3_uploader.upload_stream('archive.tar', pieces(), part_size=16, max_workers=2) is True
+
+        assert b''.join(received[n] for n in sorted(received)) == data
+        assert [len(received[n]) for n in sorted(received)] == [16] * 6 + [4]
+        assert state['max_in_flight'] <= 2
+        # Check if the stream is not read ahead of the free slots: two parts in flight plus the piece being read
+        assert state['max_buffered'] <= 2 * 16 + 7
+        # Check if the chunks are sent without a copy
+        assert all(isinstance(body, bytearray) for body in received.values())
+        parts = client.complete_multipart_upload.call_args.kwargs['MultipartUpload']['Parts']
+        assert [part['PartNumber'] for part in parts] == list(range(1, 8))
+
+        # Check if a failed part aborts the multipart upload
+        client.upload_part.side_effect = RuntimeError('connection reset')
+        assert s3_uploader.upload_stream('archive.tar', iter([data]), part_size=16) is False
+        client.abort_multipart_upload.assert_called_once_with(Bucket='test_bucket', Key='archive.tar', UploadId='upload-1')
+
+# Test GCSUploader's upload_stream() writing the stream through a resumable blob writer
+def test_gcsuploader_upload_stream():
+    with patch('file_uploader.storage'):
+        gcs_uploader = GCSUploader('test_bucket', 'test_credentials.json')
+        blob = gcs_uploader.gcs.bucket.return_value.blob.return_value
+        writer = blob.open.return_value.__enter__.return_value
+
+        assert gcs_uploader.upload_stream('export.csv', iter([b'a,b\n', b'1,2\n']), part_size=256 * 1024) is True
+        gcs_uploader.gcs.bucket.return_value.blob.assert_called_with('export.csv')
+        blob.open.assert_called_once_with('wb', chunk_size=256 * 1024)
+        writer.write.assert_called_once_with(bytearray(b'a,b\n1,2\n'))
+
+# Test S3Uploader retrying throttled requests and slowing down its rate limiter
+def test_s3uploader_retries_throttling():
+    with tempfile.NamedTemporaryFile('wb', delete=False) as f:
+        f.write(os.urandom(6 * 1024 * 1024))
+
+    with patch('file_uploader.boto3') as mock_boto3, patch.object(S3Uploader, 'read_credentials', return_value=('key', 'secret')), \
+            patch('upload_retry.time.sleep'):
+        s3_uploader = S3Uploader('test_bucket', 'test_credentials.csv')
+        rate_limiter = AdaptiveRateLimiter(8)
+        s3_uploader.set_retry_policy(RetryPolicy(max_attempts=3), rate_limiter)
+        client = mock_boto3.client.return_value
+        slow_down = botocore.exceptions.ClientError({'Error': {'Code': 'SlowDown'}, 'ResponseMetadata': {'HTTPStatusCode': 503}}, 'PutObject')
+
+        # Check if upload_file succeeds after a SlowDown and halves the requests in flight
+        client.upload_file.side_effect = [slow_down, None]
+        assert s3_uploader.upload_file(f.name) is True
+        assert client.upload_file.call_count == 2
+        assert rate_limiter.limit < 8
+
+        # Check if a retried part is sent again from its first byte
+        client.create_multipart_upload.return_value = {'UploadId': 'upload-1'}
+        received = []
+        def upload_part(Body, PartNumber, **kwargs):
+            data = Body.read()
+            if not received:
+                received.append(b'')
+                raise slow_down
+            received.append(data)
+            return {'ETag': f'etag-{PartNumber}'}
+        client.upload_part.side_effect = upload_part
+        assert s3_uploader.upload_large_file(f.name, part_size=8 * 1024 * 1024) is True
+        assert len(received[1]) == 6 * 1024 * 1024
+
+        # Check if a fatal error is not retried
+        no_bucket = botocore.exceptions.ClientError({'Error': {'Code': 'NoSuchBucket'}, 'ResponseMetadata': {'HTTPStatusCode': 404}}, 'PutObject')
+        client.upload_file.reset_mock()
+        client.upload_file.side_effect = no_bucket
+        assert s3_uploader.upload_file(f.name) is False
+        assert client.upload_file.call_count == 1
+
+    os.remove(f.name)
+
+# Test the uploaders sizing their connection pools and GCSUploader giving every thread its own client and bucket handle
+def test_uploaders_connection_pools():
+    with patch('file_uploader.boto3') as mock_boto3, patch.object(S3Uploader, 'read_credentials', return_value=('key', 'secret')):
+        S3Uploader('test_bucket', 'test_credentials.csv', max_pool_connections=48)
+        config = mock_boto3.client.call_args.kwargs['config']
+        assert config.max_pool_connections == 48
+        assert config.tcp_keepalive is True
+        # Check if botocore does not retry underneath the RetryPolicy
+        assert config.retries == {'total_max_attempts': 1}
+
+    with patch('file_uploader.storage') as mock_storage:
+        mock_storage.Client.side_effect = lambda **kwargs: MagicMock()
+        gcs_uploader = GCSUploader('test_bucket', 'test_credentials.json', max_pool_connections=48)
+        main_client = mock_storage.Client.from_service_account_json.return_value
+        assert gcs_uploader.get_client() is main_client
+        assert gcs_uploader.get_bucket() is gcs_uploader.get_bucket()
+        main_client.bucket.assert_called_once_with('test_bucket')
+
+        # Check if a worker thread creates its own client with the same credentials
+        clients = []
+        thread = threading.Thread(target=lambda: clients.append(gcs_uploader.get_client()))
+        thread.start()
+        thread.join()
+        assert clients[0] is not main_client
+        mock_storage.Client.assert_called_once_with(project=main_client.project, credentials=main_client._credentials)
+        assert gcs_uploader.connection_stats().requests == 0
+
+# Test FileUploader bundling small files into tar shards with a sidecar index
+def test_fileuploader_bundles_small_files():
+    with tempfile.TemporaryDirectory() as directory:
+        for name, size in (('a.csv', 10), ('b.pdf', 20), ('c.doc', 30), ('big.pdf', 5000), ('d.jpg', 10)):
+            with open(os.path.join(directory, name), 'wb') as f:
+                f.write(b'x' * size)
+
+        # Bundle GCS files under 1 KB, S3 keeps uploading files one by one
+        config_path = os.path.join(directory, 'config.json')
+        with open(config_path, 'w') as f:
+            json.dump({'cloud_services': {'s3': {'bucket_name': 'test_s3_bucket', 'credentials_file': 'test_s3_credentials.csv'},
+                                          'gcs': {'bucket_name': 'test_gcs_bucket', 'credentials_file': 'test_gcs_credentials.json'}},
+                       'file_types': {'image': ['jpg'], 'media': [], 'document': ['csv', 'pdf', 'doc']},
+                       'bundling': {'enabled': True, 'threshold': 1024, 'shard_size': 3072, 's3': {'threshold': 0}}}, f)
+
+        with patch('file_uploader.S3Uploader') as mock_s3_uploader, patch('file_uploader.GCSUploader') as mock_gcs_uploader:
+            gcs_uploader = mock_gcs_uploader.return_value
+            streams = {}
+            def upload_stream(key, stream, part_size=None, max_workers=None):
+                streams[key] = b''.join(stream)
+                return True
+            gcs_uploader.upload_stream.side_effect = upload_stream
+
+            FileUploader(directory, config_path).upload_files()
+
+            # Check if the large file is uploaded on its own and the small files in shards with their index
+            gcs_uploader.upload_file.assert_called_once_with(os.path.join(directory, 'big.pdf'))
+            mock_s3_uploader.return_value.upload_file.assert_called_once_with(os.path.join(directory, 'd.jpg'))
+            shards = sorted(key for key in streams if key.endswith('.tar'))
+            assert len(shards) == 2
+            members = {}
+            for key in shards:
+                index = json.loads(streams[key + '.index.json'])
+                for name, member in index['members'].items():
+                    members[name] = streams[key][member['offset']:member['offset'] + member['size']]
+            assert members == {'a.csv': b'x' * 10, 'b.pdf': b'x' * 20, 'c.doc': b'x' * 30}
+
+# Test FileUploader checking bundled files neither against the bucket listing nor for duplicates
+def test_fileuploader_bundles_skip_remote_index_and_dedup():
+    with tempfile.TemporaryDirectory() as directory:
+        for name in ('a.csv', 'b.csv'):
+            with open(os.path.join(directory, name), 'wb') as f:
+                f.write(b'x' * 10)
+
+        config_path = os.path.join(directory, 'config.json')
+        with open(config_path, 'w') as f:
+            json.dump({'cloud_services': {'gcs': {'bucket_name': 'test_gcs_bucket', 'credentials_file': 'test_gcs_credentials.json'}},
+                       'file_types': {'image': [], 'media': [], 'document': ['csv']},
+                       'bundling': {'enabled': True, 'threshold': 1024},
+                       'remote_index': {'enabled': True}, 'dedup': {'enabled': True}}, f)
+
+        with patch('file_uploader.GCSUploader') as mock_gcs_uploader, patch('file_uploader.FileHasher.digest') as mock_digest:
+            gcs_uploader = mock_gcs_uploader.return_value
+            gcs_uploader.upload_stream.return_value = True
+            assert FileUploader(directory, config_path).upload_files() == {'gcs': (1, 0)}
+
+            # Check if the shard was uploaded without listing the bucket or hashing its members
+            assert gcs_uploader.upload_stream.call_count == 2
+            gcs_uploader.list_objects.assert_not_called()
+            mock_digest.assert_not_called()
+
+# Test FileUploader compressing documents with gzip and never compressing media
+def test_fileuploader_compresses_documents():
+    with tempfile.TemporaryDirectory() as directory:
+        content = b'a,b,c\n' * 1000
+        for name in ('data.csv', 'clip.mp4', 'tiny.csv'):
+            with open(os.path.join(directory, name), 'wb') as f:
+                f.write(b'x' if name == 'tiny.csv' else content)
+
+        config_path = os.path.join(directory, 'config.json')
+        with open(config_path, 'w') as f:
+            json.dump({'cloud_services': {'gcs': {'bucket_name': 'test_gcs_bucket', 'credentials_file': 'test_gcs_credentials.json'}},
+                       'file_types': {'image': [], 'media': ['mp4'], 'document': ['csv']},
+                       'compression': {'enabled': True, 'codecs': {'document': 'gzip', 'media': 'gzip'}, 'min_size': 100}}, f)
+
+        with patch('file_uploader.GCSUploader') as mock_gcs_uploader:
+            gcs_uploader = mock_gcs_uploader.return_value
+            streams = {}
+            def upload_stream(key, stream, part_size=None, max_workers=None, content_encoding=None, content_type=None):
+                streams[key] = (b''.join(stream), content_encoding, content_type)
+                return True
+            gcs_uploader.upload_stream.side_effect = upload_stream
+
+            file_uploader = FileUploader(directory, config_path, {'gcs': ('document', 'media')})
+            file_uploader.upload_files()
+
+            # Check if only the csv above min_size was compressed, with its Content-Encoding and Content-Type
+            assert list(streams) == ['data.csv']
+            data, content_encoding, content_type = streams['data.csv']
+            assert gzip.decompress(data) == content
+            assert (content_encoding, content_type) == ('gzip', 'text/csv')
+            assert sorted(c.args[0] for c in gcs_uploader.upload_file.call_args_list) == [os.path.join(directory, 'clip.mp4'), os.path.join(directory, 'tiny.csv')]
+            stats = file_uploader.compression_stats['gcs']
+            assert stats.raw_bytes == len(content) and stats.compressed_bytes == len(data)
+
+# Test FileUploader uploading every content once per cloud service, with its digest
+def test_fileuploader_deduplicates_content():
+    with tempfile.TemporaryDirectory() as directory:
+        for name, content in (('a/x.csv', b'same'), ('b/x.csv', b'same'), ('c/y.csv', b'same'), ('z.csv', b'other')):
+            os.makedirs(os.path.dirname(os.path.join(directory, name)), exist_ok=True)
+            with open(os.path.join(directory, name), 'wb') as f:
+                f.write(content)
+
+        config_path = os.path.join(directory, 'config.json')
+        with open(config_path, 'w') as f:
+            json.dump({'cloud_services': {'gcs': {'bucket_name': 'test_gcs_bucket', 'credentials_file': 'test_gcs_credentials.json'}},
+                       'file_types': {'image': [], 'media': [], 'document': ['csv']},
+                       'dedup': {'enabled': True}}, f)
+
+        with patch('file_uploader.GCSUploader') as mock_gcs_uploader:
+            gcs_uploader = mock_gcs_uploader.return_value
+            gcs_uploader.upload_file.return_value = True
+            gcs_uploader.copy_object.return_value = True
+            FileUploader(directory, config_path).upload_files()
+
+            # Check if each content was uploaded once with its digest, and 'same' copied on the server to its other key
+            uploads = {os.path.basename(c.args[0]): c.kwargs['digest'] for c in gcs_uploader.upload_file.call_args_list}
+            assert gcs_uploader.upload_file.call_count == 2
+            assert uploads['z.csv'].md5_hex == hashlib.md5(b'other').hexdigest()
+            same_key = 'x.csv' if 'x.csv' in uploads else 'y.csv'
+            assert uploads[same_key].md5_hex == hashlib.md5(b'same').hexdigest()
+            gcs_uploader.copy_object.assert_called_once_with(same_key, 'y.csv' if same_key == 'x.csv' else 'x.csv')
+
+# Test S3Uploader sending the digest of a small file with a single PUT
+def test_s3uploader_upload_file_with_digest():
+    with tempfile.NamedTemporaryFile('wb', delete=False) as f:
+        f.write(b'content')
+
+    with patch('file_uploader.boto3') as mock_boto3, patch.object(S3Uploader, 'read_credentials', return_value=('key', 'secret')):
+        s3_uploader = S3Uploader('test_bucket', 'test_credentials.csv')
+        client = mock_boto3.client.return_value
+        bodies = []
+        client.put_object.side_effect = lambda Body, **kwargs: bodies.append(Body.read())
+        digest = digest_file(f.name)
+
+        assert s3_uploader.upload_file(f.name, digest=digest) is True
+        client.upload_file.assert_not_called()
+        assert bodies == [b'content']
+        kwargs = client.put_object.call_args.kwargs
+        assert (kwargs['ContentMD5'], kwargs['ChecksumCRC32C']) == (digest.md5_base64, digest.crc32c_base64)
+
+    os.remove(f.name)
+
+# Test FileUploader reading a file once and streaming it to S3 and GCS at the same time
+def test_fileuploader_fanout():
+    with tempfile.TemporaryDirectory() as directory:
+        content = os.urandom(1000)
+        for name in ('report.pdf', 'second.pdf', 'third.pdf'):
+            with open(os.path.join(directory, name), 'wb') as f:
+                f.write(content)
+
+        config_path = os.path.join(directory, 'config.json')
+        with open(config_path, 'w') as f:
+            json.dump({'cloud_services': {'s3': {'bucket_name': 'test_s3_bucket', 'credentials_file': 'test_s3_credentials.csv'},
+                                          'gcs': {'bucket_name': 'test_gcs_bucket', 'credentials_file': 'test_gcs_credentials.json'}},
+                       'file_types': {'image': [], 'media': [], 'document': ['pdf']},
+                       'fanout': {'enabled': True}, 'sync': {'enabled': True, 'manifest_file': os.path.join(directory, 'manifest.db')}}, f)
+
+        with patch('file_uploader.S3Uploader') as mock_s3_uploader, patch('file_uploader.GCSUploader') as mock_gcs_uploader:
+            streams = {}
+            threads = {'s3': set(), 'gcs': set()}
+            def uploader(name, success):
+                def upload_stream(key, stream, part_size=None, max_workers=None):
+                    streams[name, key] = b''.join(stream)
+                    threads[name].add(threading.current_thread())
+                    return success
+                return upload_stream
+            mock_s3_uploader.return_value.bucket_name = 'test_s3_bucket'
+            mock_gcs_uploader.return_value.bucket_name = 'test_gcs_bucket'
+            mock_s3_uploader.return_value.upload_stream.side_effect = uploader('s3', True)
+            mock_gcs_uploader.return_value.upload_stream.side_effect = uploader('gcs', False)
+
+            file_uploader = FileUploader(directory, config_path, {'s3': ('document',), 'gcs': ('document',)})
+            file_uploader.upload_files()
+
+            # Check if both cloud services got the files and only the successful one recorded them
+            assert streams[('s3', 'report.pdf')] == content and streams[('gcs', 'report.pdf')] == content and len(streams) == 6
+            # Every file was streamed on the same long-lived thread of each cloud service, so its clients were reused
+            assert all(len(service_threads) == 1 for service_threads in threads.values())
+            assert all(thread.name.startswith('fan-out-') and not thread.is_alive() for service_threads in threads.values() for thread in service_threads)
+            mock_s3_uploader.return_value.upload_file.assert_not_called()
+            mock_gcs_uploader.return_value.upload_file.assert_not_called()
+            assert file_uploader.manifest.lookup('s3', 'test_s3_bucket', 'report.pdf') is not None
+            assert file_uploader.manifest.lookup('gcs', 'test_gcs_bucket', 'report.pdf') is None
+            file_uploader.manifest.close()
+
+# Test FileUploader counting the streams of fanned-out files against the max_workers uploads of every cloud service
+def test_fileuploader_fanout_concurrency():
+    with tempfile.TemporaryDirectory() as directory:
+        for i in range(6):
+            for extension in ('pdf', 'jpg', 'mp4'):
+                with open(os.path.join(directory, f'{i}.{extension}'), 'wb') as f:
+                    f.write(b'x' * 100)
+
+        config_path = os.path.join(directory, 'config.json')
+        with open(config_path, 'w') as f:
+            json.dump({'cloud_services': {'s3': {'bucket_name': 'test_s3_bucket', 'credentials_file': 'test_s3_credentials.csv'},
+                                          'gcs': {'bucket_name': 'test_gcs_bucket', 'credentials_file': 'test_gcs_credentials.json'}},
+                       'file_types': {'image': ['jpg'], 'media': ['mp4'], 'document': ['pdf']},
+                       'concurrency': {'max_workers': 2}, 'fanout': {'enabled': True}}, f)
+
+        # Track the uploads in flight per cloud service, fanned-out streams and single file uploads alike
+        lock = threading.Lock()
+        in_flight = {'s3': 0, 'gcs': 0}
+        max_in_flight = {'s3': 0, 'gcs': 0}
+        def tracked(service):
+            def upload(key_or_path, stream=None, *args, **kwargs):
+                with lock:
+                    in_flight[service] += 1
+                    max_in_flight[service] = max(max_in_flight[service], in_flight[service])
+                if stream is not None:
+                    b''.join(stream)
+                time.sleep(0.05)
+                with lock:
+                    in_flight[service] -= 1
+                return True
+            return upload
+
+        with patch('file_uploader.S3Uploader') as mock_s3_uploader, patch('file_uploader.GCSUploader') as mock_gcs_uploader:
+            for service, mock_uploader in (('s3', mock_s3_uploader), ('gcs', mock_gcs_uploader)):
+                mock_uploader.return_value.upload_stream.side_effect = tracked(service)
+                mock_uploader.return_value.upload_file.side_effect = tracked(service)
+            file_uploader = FileUploader(directory, config_path, {'s3': ('document', 'media'), 'gcs': ('document', 'image')})
+            file_uploader.upload_files()
+
+        # Check if no cloud service had more than max_workers uploads in flight, its pool's and the fanned-out streams together
+        assert mock_s3_uploader.return_value.upload_stream.call_count == 6
+        assert mock_gcs_uploader.return_value.upload_stream.call_count == 6
+        assert mock_s3_uploader.return_value.upload_file.call_count == 6
+        assert mock_gcs_uploader.return_value.upload_file.call_count == 6
+        assert max_in_flight['gcs'] <= 2 and max_in_flight['s3'] <= 2
+
+# Test FileUploader reporting the scan, hash and network stages, the outcomes and the bytes of the uploads to its metrics
+def test_fileuploader_metrics():
+    with tempfile.TemporaryDirectory() as directory:
+        for name in ('photo.jpg', 'clip.mp4'):
+            with open(os.path.join(directory, name), 'wb') as f:
+                f.write(b'x' * 100)
+
+        config_path = os.path.join(directory, 'config.json')
+        with open(config_path, 'w') as f:
+            json.dump({'cloud_services': {'s3': {'bucket_name': 'test_s3_bucket', 'credentials_file': 'test_s3_credentials.csv'}},
+                       'file_types': {'image': ['jpg'], 'media': ['mp4'], 'document': []},
+                       'sync': {'enabled': True, 'manifest_file': os.path.join(directory, 'manifest.db')}}, f)
+
+        snapshots = []
+        metrics = Metrics([CallbackSink(snapshots.append)])
+        with patch('file_uploader.S3Uploader') as mock_s3_uploader:
+            mock_s3_uploader.return_value.bucket_name = 'test_s3_bucket'
+            mock_s3_uploader.return_value.upload_file.side_effect = lambda file_path: not file_path.endswith('.mp4')
+            mock_s3_uploader.return_value.connection_stats.return_value = ConnectionStats(1, 2)
+
+            file_uploader = FileUploader(directory, config_path, metrics=metrics)
+            file_uploader.upload_files()
+            file_uploader.manifest.close()
+
+        # Check if the final flush holds the outcome of every file and the latency of every stage
+        snapshot = snapshots[-1]
+        counters = {(c['name'], c['labels'].get('outcome')): c['value'] for c in snapshot['counters']}
+        assert counters[('uploads_total', 'uploaded')] == 1
+        assert counters[('uploads_total', 'failed')] == 1
+        assert counters[('upload_bytes_total', None)] == 100
+        assert counters[('files_scanned_total', None)] == 2
+        stages = {(h['labels']['provider'], h['labels']['stage']): h['count'] for h in snapshot['histograms']}
+        assert stages == {('all', 'scan'): 2, ('all', 'hash'): 2, ('s3', 'network'): 2}
+        # Check if the connections of the uploader are published with the flush
+        gauges = {(g['name'], g['labels'].get('provider')): g['value'] for g in snapshot['gauges']}
+        assert gauges[('connections', 's3')] == 1
+        assert gauges[('requests', 's3')] == 2
+        assert gauges[('connections_reused', 's3')] == 1
+
+# Test FileUploader pacing the uploads of every cloud service with the scheduler
+def test_fileuploader_scheduler():
+    with tempfile.TemporaryDirectory() as directory:
+        for i in range(6):
+            with open(os.path.join(directory, f'{i}.jpg'), 'wb') as f:
+                f.write(b'x' * 100)
+
+        config_path = os.path.join(directory, 'config.json')
+        with open(config_path, 'w') as f:
+            json.dump({'cloud_services': {'s3': {'bucket_name': 'test_s3_bucket', 'credentials_file': 'test_s3_credentials.csv'}},
+                       'file_types': {'image': ['jpg'], 'media': [], 'document': []},
+                       'concurrency': {'max_workers': 4},
+                       'scheduler': {'enabled': True, 's3': {'concurrency': 1}, 'priorities': {'document': 0, 'image': 1}}}, f)
+
+        in_flight = []
+        max_in_flight = []
+        lock = threading.Lock()
+
+        def upload_file(file_path):
+            with lock:
+                in_flight.append(file_path)
+                max_in_flight.append(len(in_flight))
+            threading.Event().wait(0.01)
+            with lock:
+                in_flight.remove(file_path)
+            return True
+
+        with patch('file_uploader.S3Uploader') as mock_s3_uploader:
+            mock_s3_uploader.return_value.upload_file.side_effect = upload_file
+            file_uploader = FileUploader(directory, config_path)
+            file_uploader.upload_files()
+
+        # Check if the uploader got the scheduler and the budget of S3 held back three of the four workers
+        mock_s3_uploader.return_value.set_scheduler.assert_called_once_with(file_uploader.scheduler, 's3')
+        assert len(max_in_flight) == 6 and max(max_in_flight) == 1
+
+# Test FileUploader's watch() method uploading the existing files once and then the files written to the directory
+def test_fileuploader_watch():
+    with tempfile.TemporaryDirectory() as directory:
+        open(os.path.join(directory, 'existing.jpg'), 'w').close()
+        config_path = os.path.join(directory, 'config.json')
+        with open(config_path, 'w') as f:
+            json.dump({'cloud_services': {'s3': {'bucket_name': 'test_s3_bucket', 'credentials_file': 'test_s3_credentials.csv'}},
+                       'file_types': {'image': ['jpg'], 'media': [], 'document': []},
+                       'watch': {'settle_seconds': 0.05, 'batch_interval': 0.05, 'poll_interval': 0.05}}, f)
+
+        uploaded = []
+        stop_event = threading.Event()
+        with patch('file_uploader.S3Uploader') as mock_s3_uploader, \
+                patch.object(FileUploader, 'forget_batch_caches', autospec=True, side_effect=FileUploader.forget_batch_caches) as mock_forget:
+            mock_s3_uploader.return_value.upload_file.side_effect = lambda file_path: uploaded.append(file_path) or True
+            file_uploader = FileUploader(directory, config_path)
+            thread = threading.Thread(target=file_uploader.watch, args=(stop_event,))
+            thread.start()
+            try:
+                # Wait for the startup scan, then write a new file and a file of another type
+                deadline = time.monotonic() + 3.0
+                while not uploaded and time.monotonic() < deadline:
+                    time.sleep(0.01)
+                os.makedirs(os.path.join(directory, 'sub'))
+                with open(os.path.join(directory, 'sub', 'new.jpg'), 'w') as f:
+                    f.write('new')
+                open(os.path.join(directory, 'notes.txt'), 'w').close()
+                while len(uploaded) < 2 and time.monotonic() < deadline:
+                    time.sleep(0.01)
+            finally:
+                stop_event.set()
+                thread.join()
+
+        # Check if the existing file was uploaded by the startup scan and the new one by the watcher, once each
+        assert uploaded == [os.path.join(directory, 'existing.jpg'), os.path.join(directory, 'sub', 'new.jpg')]
+        # Check if the caches of the run are emptied after the startup scan and after every batch of new files
+        assert mock_forget.call_count >= 2
+        mock_s3_uploader.return_value.release_idle_clients.assert_called()
+
+# Test FileUploader's watch() method uploading a file written during the startup scan once without the manifest
+def test_fileuploader_watch_file_written_during_scan():
+    with tempfile.TemporaryDirectory() as directory:
+        config_path = os.path.join(directory, 'config.json')
+        with open(config_path, 'w') as f:
+            json.dump({'cloud_services': {'s3': {'bucket_name': 'test_s3_bucket', 'credentials_file': 'test_s3_credentials.csv'}},
+                       'file_types': {'image': ['jpg'], 'media': [], 'document': []},
+                       'watch': {'settle_seconds': 0.05, 'batch_interval': 0.05, 'poll_interval': 0.05}}, f)
+        scan = DirectoryScanner.scan
+
+        def scan_while_writing(scanner):
+            # Write a file after the watcher started, so both the scan and the watcher find it
+            with open(os.path.join(directory, 'during_scan.jpg'), 'w') as f:
+                f.write('scan')
+            return scan(scanner)
+
+        uploaded = []
+        stop_event = threading.Event()
+        with patch('file_uploader.S3Uploader') as mock_s3_uploader, \
+                patch.object(DirectoryScanner, 'scan', autospec=True, side_effect=scan_while_writing):
+            mock_s3_uploader.return_value.upload_file.side_effect = lambda file_path: uploaded.append(file_path) or True
+            file_uploader = FileUploader(directory, config_path)
+            thread = threading.Thread(target=file_uploader.watch, args=(stop_event,))
+            thread.start()
+            try:
+                # Wait for the startup scan, then write a new file once the watcher reported the first one
+                deadline = time.monotonic() + 3.0
+                while not uploaded and time.monotonic() < deadline:
+                    time.sleep(0.01)
+                time.sleep(0.3)
+                with open(os.path.join(directory, 'after_scan.jpg'), 'w') as f:
+                    f.write('watch')
+                while len(uploaded) < 2 and time.monotonic() < deadline:
+                    time.sleep(0.01)
+                time.sleep(0.2)
+            finally:
+                stop_event.set()
+                thread.join()
+
+        # Check if the file written during the scan was uploaded once by the scan and the later file by the watcher
+        assert uploaded == [os.path.join(directory, 'during_scan.jpg'), os.path.join(directory, 'after_scan.jpg')]
+
+# Test FileUploader enqueuing every file in the upload queue and two workers uploading every job once
+def test_fileuploader_upload_queue():
+    with tempfile.TemporaryDirectory() as directory:
+        data = os.path.join(directory, 'data')
+        os.makedirs(data)
+        for i in range(20):
+            open(os.path.join(data, f'{i}.jpg'), 'w').close()
+        open(os.path.join(data, 'broken.pdf'), 'w').close()
+
+        config_path = os.path.join(directory, 'config.json')
+        with open(config_path, 'w') as f:
+            json.dump({'cloud_services': {'s3': {'bucket_name': 'test_s3_bucket', 'credentials_file': 'test_s3_credentials.csv'},
+                                          'gcs': {'bucket_name': 'test_gcs_bucket', 'credentials_file': 'test_gcs_credentials.json'}},
+                       'file_types': {'image': ['jpg'], 'media': [], 'document': ['pdf']},
+                       'concurrency': {'max_workers': 2},
+                       'sync': {'enabled': True, 'manifest_file': os.path.join(directory, 'manifest.db')},
+                       'queue': {'queue_file': os.path.join(directory, 'queue.db'), 'max_attempts': 2, 'poll_interval': 0.01}}, f)
+
+        uploaded = []
+        lock = threading.Lock()
+        # Another worker process recording its uploads in the same manifest file
+        other_manifest = UploadManifest(os.path.join(directory, 'manifest.db'), commit_every=1, timeout=0.1)
+
+        def upload_file(file_path):
+            with lock:
+                uploaded.append(file_path)
+                other_manifest.record('s3', 'other_bucket', file_path, 1, 1, 'abc')
+            return not file_path.endswith('.pdf')
+
+        with patch('file_uploader.S3Uploader') as mock_s3_uploader, patch('file_uploader.GCSUploader') as mock_gcs_uploader:
+            mock_s3_uploader.return_value.upload_file.side_effect = upload_file
+            mock_gcs_uploader.return_value.upload_file.side_effect = upload_file
+            file_uploader = FileUploader(data, config_path)
+            upload_queue = file_uploader.open_queue()
+            assert file_uploader.enqueue_files(upload_queue) == 21
+            assert file_uploader.enqueue_files(upload_queue) == 0
+
+            results = {}
+            workers = [threading.Thread(target=lambda name=name: results.update({name: file_uploader.work_queue(upload_queue, name)}))
+                       for name in ('worker-a', 'worker-b')]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+
+        # Check if every image was uploaded once and the failing document was tried max_attempts times
+        assert sorted(uploaded) == sorted([os.path.join(data, f'{i}.jpg') for i in range(20)] + [os.path.join(data, 'broken.pdf')] * 2)
+        assert sum(result[0] for result in results.values()) == 20
+        assert upload_queue.counts() == {'pending': 0, 'leased': 0, 'done': 20, 'failed': 1}
+        upload_queue.close()
+
+        # Check if every upload was committed to the manifest at once, so the other process never waited for its lock
+        assert other_manifest.lookup('s3', 'test_s3_bucket', os.path.relpath(os.path.join(data, '0.jpg'), data)) is not None
+        other_manifest.close()
+        file_uploader.manifest.close()
+
+# Test importing file_uploader and running the CLI without the cloud SDKs, and FileUploader creating uploaders on first use
+def test_fileuploader_lazy_uploaders_and_cli(capsys):
+    # Importing the module and asking for the version or a dry run never imports boto3 or google-cloud-storage
+    script = ("import sys, file_uploader\n"
+              "try:\n    file_uploader.main(['--version'])\nexcept SystemExit:\n    pass\n"
+              "print(sorted({name.split('.')[0] for name in sys.modules} & {'boto3', 'botocore', 'google', 'requests'}))")
+    result = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    assert result.returncode == 0 and result.stdout.splitlines() == ['file-uploader 0.2', '[]']
+
+    with tempfile.TemporaryDirectory() as directory:
+        data = os.path.join(directory, 'data')
+        os.makedirs(os.path.join(data, 'sub'))
+        for name in ('a.jpg', os.path.join('sub', 'b.pdf'), 'notes.txt'):
+            open(os.path.join(data, name), 'w').close()
+        config_path = os.path.join(directory, 'config.json')
+        with open(config_path, 'w') as f:
+            json.dump({'cloud_services': {'s3': {'bucket_name': 'test_s3_bucket', 'credentials_file': 'test_s3_credentials.csv'},
+                                          'gcs': {'bucket_name': 'test_gcs_bucket', 'credentials_file': 'test_gcs_credentials.json'}},
+                       'file_types': {'image': ['jpg'], 'media': [], 'document': ['pdf']},
+                       'sync': {'enabled': True, 'manifest_file': os.path.join(directory, 'manifest.db')},
+                       'large_files': {'checkpoint_dir': os.path.join(directory, 'checkpoints')}}, f)
+
+        with patch('file_uploader.S3Uploader') as mock_s3_uploader, patch('file_uploader.GCSUploader') as mock_gcs_uploader:
+            # A dry run lists the routed files of every cloud service without creating any uploader, manifest or checkpoint
+            assert main(['sync', data, '--config', config_path, '--dry-run']) == 0
+            assert capsys.readouterr().out.splitlines() == ['s3\ta.jpg', f"gcs\t{os.path.join('sub', 'b.pdf')}"]
+            assert sorted(os.listdir(directory)) == ['config.json', 'data']
+
+            # Only the uploader of a cloud service getting files is created, once
+            os.remove(os.path.join(data, 'sub', 'b.pdf'))
+            mock_s3_uploader.return_value.upload_file.return_value = True
+            file_uploader = FileUploader(data, config_path, upload_file_types={'s3': ('image',), 'gcs': ('document',)})
+            assert file_uploader.uploaders == {}
+            assert file_uploader.upload_files() == {'s3': (1, 0), 'gcs': (0, 0)}
+            mock_s3_uploader.assert_called_once()
+            mock_s3_uploader.return_value.set_retry_policy.assert_called_once()
+            mock_gcs_uploader.assert_not_called()
+            assert set(file_uploader.uploaders) == {'s3'}
+            assert file_uploader.s3_uploader is mock_s3_uploader.return_value
+            file_uploader.manifest.close()
+
+            # A dry run reads the manifest without writing next to it, the uploaded file is left out
+            assert main(['sync', data, '--config', config_path, '--dry-run']) == 0
+            assert capsys.readouterr().out == ''
+            assert sorted(os.listdir(directory)) == ['config.json', 'data', 'manifest.db']
+
+            # The exit status of the CLI is 1 when an upload failed or the directory does not exist
+            assert main(['sync', data, '--config', config_path, '--quiet']) == 0
+            with open(os.path.join(data, 'a.jpg'), 'w') as f:
+                f.write('changed')
+            mock_s3_uploader.return_value.upload_file.return_value = False
+            assert main(['sync', data, '--config', config_path, '--quiet']) == 1
+            assert main(['sync', os.path.join(directory, 'missing'), '--config', config_path, '--quiet']) == 1
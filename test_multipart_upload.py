@@ -0,0 +1,63 @@
+# Import necessary libraries and modules
+import io
+import os
+
+import pytest
+
+from multipart_upload import MAX_PARTS, FilePart, compute_part_size, iter_parts, read_chunks
+
+MIB = 1024 * 1024
+
+# Test compute_part_size() keeping every file within the part limit
+def test_compute_part_size():
+    # Small files use the preferred part size, but never less than 5 MiB
+    assert compute_part_size(100 * MIB) == 8 * MIB
+    assert compute_part_size(100 * MIB, preferred_part_size=MIB) == 5 * MIB
+    # Huge files get larger parts, rounded up to whole MiB
+    file_size = 100 * 1024 * MIB
+    part_size = compute_part_size(file_size)
+    assert part_size % MIB == 0
+    assert file_size / part_size <= MAX_PARTS
+    # Files beyond the multipart limits are rejected
+    with pytest.raises(ValueError):
+        compute_part_size(10 ** 15)
+
+# Test iter_parts() covering the file with numbered parts
+def test_iter_parts():
+    assert list(iter_parts(25, 10)) == [(1, 0, 10), (2, 10, 20), (3, 20, 25)]
+
+# Test FilePart reading and seeking within its slice
+def test_filepart_read_and_seek():
+    view = memoryview(b'0123456789')
+    part = FilePart(view, 2, 8)
+    assert len(part) == 6
+    assert part.read(4) == b'2345'
+    assert part.read() == b'67'
+    assert part.read() == b''
+    part.seek(0)
+    buffer = bytearray(3)
+    assert part.readinto(buffer) == 3 and buffer == b'234'
+    assert part.seek(-1, os.SEEK_END) == 5
+    assert part.read() == b'7'
+    part.release()
+    view.release()
+
+# Test read_chunks() cutting file objects and iterables into chunks of the same size
+def test_read_chunks():
+    class Pipe:
+        # A file object returning at most 3 bytes per read, like a pipe
+        def __init__(self, data):
+            self.stream = io.BytesIO(data)
+
+        def read(self, size):
+            return self.stream.read(min(size, 3))
+
+    assert [bytes(c) for c in read_chunks(Pipe(b'0123456789'), 4)] == [b'0123', b'4567', b'89']
+    assert [bytes(c) for c in read_chunks(Pipe(b'01234567'), 4)] == [b'0123', b'4567']
+    assert [bytes(c) for c in read_chunks(iter([b'01', b'2345', b'6']), 4)] == [b'0123', b'456']
+    assert list(read_chunks(io.BytesIO(b''), 4)) == []
+
+    # Check if pieces of exactly one chunk are passed on without a copy
+    piece = b'abcd'
+    chunks = list(read_chunks(iter([piece, b'ef']), 4))
+    assert chunks[0] is piece and bytes(chunks[1]) == b'ef'
@@ -0,0 +1,45 @@
+# Import necessary libraries and modules
+import tempfile
+from unittest.mock import MagicMock
+
+from remote_index import RemoteIndex, RemoteIndexCache
+
+# Test RemoteIndex matching keys by size and by MD5 when both sides know it
+def test_remoteindex_matches():
+    index = RemoteIndex.from_listing([('a.jpg', 3, 'abc'), ('b.mp4', 5, None)])
+    assert index.matches('a.jpg', 3)
+    assert index.matches('a.jpg', 3, 'abc')
+    assert not index.matches('a.jpg', 3, 'def')
+    assert not index.matches('a.jpg', 4)
+    assert index.matches('b.mp4', 5, 'def')
+    assert not index.matches('c.pdf', 1)
+
+    # Check if added keys are matched too
+    index.add('c.pdf', 1)
+    assert index.matches('c.pdf', 1)
+
+# Test RemoteIndexCache listing once per TTL and reloading saved listings
+def test_remoteindexcache_ttl_and_save():
+    with tempfile.TemporaryDirectory() as directory:
+        list_objects = MagicMock(return_value=[('a.jpg', 3, None)])
+        cache = RemoteIndexCache(ttl=600, cache_dir=directory)
+        assert cache.get('s3', 'bucket', 'photos/', list_objects).matches('a.jpg', 3)
+        assert cache.get('s3', 'bucket', 'photos/', list_objects).matches('a.jpg', 3)
+        list_objects.assert_called_once_with('photos/')
+        cache.save()
+
+        # A new cache reads the saved listing instead of listing again
+        list_objects.reset_mock()
+        assert RemoteIndexCache(ttl=600, cache_dir=directory).get('s3', 'bucket', 'photos/', list_objects).matches('a.jpg', 3)
+        list_objects.assert_not_called()
+
+        # An expired listing is listed again
+        assert not RemoteIndexCache(ttl=-1, cache_dir=directory).get('s3', 'bucket', 'photos/', MagicMock(return_value=[])).matches('a.jpg', 3)
+
+        # Check if only the expired listings are forgotten, with the files added to them
+        cache.get('s3', 'bucket', 'photos/', list_objects).add('b.jpg', 1)
+        cache.forget_expired()
+        assert cache.get('s3', 'bucket', 'photos/', list_objects).matches('b.jpg', 1)
+        cache.ttl = -1
+        cache.forget_expired()
+        assert cache._indexes == {}
@@ -0,0 +1,59 @@
+# Import necessary libraries and modules
+import io
+import json
+import os
+import tarfile
+import tempfile
+
+import pytest
+
+from small_file_bundler import ShardBatcher, TarShard, member_range
+from upload_scanner import WorkItem
+
+# Test TarShard streaming a valid tar archive whose index locates every member
+def test_tarshard_stream_and_index():
+    with tempfile.TemporaryDirectory() as directory:
+        contents = {'a.csv': b'a,b\n1,2\n', 'sub/b.pdf': os.urandom(1500), 'empty.doc': b''}
+        members = []
+        for name, content in contents.items():
+            path = os.path.join(directory, name.replace('/', os.sep))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(content)
+            members.append((name, path, len(content), 1_700_000_000_000_000_000))
+
+        shard = TarShard('bundles/run-00001.tar', members)
+        data = b''.join(shard.stream(chunk_size=100))
+        assert len(data) == shard.size
+
+        # Check if tarfile reads every member back
+        with tarfile.open(fileobj=io.BytesIO(data)) as archive:
+            assert {member.name: archive.extractfile(member).read() for member in archive.getmembers()} == contents
+
+        # Check if the ranges of the sidecar index select the bytes of each member
+        index = json.loads(shard.index_json())
+        assert index['shard'] == 'bundles/run-00001.tar'
+        for name, content in contents.items():
+            if content:
+                start, end = map(int, member_range(index, name)[len('bytes='):].split('-'))
+                assert data[start:end + 1] == content
+        with pytest.raises(ValueError):
+            member_range(index, 'empty.doc')
+
+# Test ShardBatcher keeping every batch within the shard size
+def test_shardbatcher_bounds_shards():
+    batcher = ShardBatcher(4096, key_prefix='bundles/')
+    batches = []
+    for i in range(10):
+        batch = batcher.add(f'file{i}.csv', WorkItem(f'/data/file{i}.csv', 1000, 0, frozenset({'gcs'})))
+        if batch is not None:
+            batches.append(batch)
+    batches.append(batcher.flush())
+    assert batcher.flush() is None
+
+    # Check if every file is in one batch, with unique keys and at most shard_size archive bytes per batch
+    assert [name for batch in batches for name, item in batch.items] == [f'file{i}.csv' for i in range(10)]
+    assert len({batch.key for batch in batches}) == len(batches) > 1
+    assert all(batch.key.startswith('bundles/') and batch.key.endswith('.tar') for batch in batches)
+    for batch in batches:
+        assert 1024 + sum(TarShard.member_size(name, item.size) for name, item in batch.items) <= 4096
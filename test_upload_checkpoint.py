@@ -0,0 +1,30 @@
+# Import necessary libraries and modules
+import os
+import tempfile
+
+from upload_checkpoint import CheckpointStore
+
+# Test CheckpointStore saving, reloading and deleting the checkpoint of an upload
+def test_checkpointstore_roundtrip():
+    with tempfile.TemporaryDirectory() as directory:
+        store = CheckpointStore(os.path.join(directory, 'checkpoints'))
+        # The directory is only created with the first checkpoint
+        assert not os.path.exists(store.checkpoint_dir)
+        checkpoint = store.create('s3', 'test_bucket', 'video.mp4', 'upload-1', 8, 100, 123)
+        checkpoint.add_part(1, 'etag-1')
+        checkpoint.add_part(2, 'etag-2')
+
+        # Check if the completed parts survive reloading the checkpoint
+        loaded = store.load('s3', 'test_bucket', 'video.mp4')
+        assert loaded.upload_id == 'upload-1'
+        assert loaded.part_size == 8
+        assert loaded.parts == {1: 'etag-1', 2: 'etag-2'}
+        assert loaded.matches(100, 123)
+        assert not loaded.matches(100, 124)
+        assert store.load('gcs', 'test_bucket', 'video.mp4') is None
+
+        # Check if the confirmed parts replace the recorded ones and deleting removes the checkpoint
+        loaded.set_parts({1: 'etag-1'})
+        assert store.load('s3', 'test_bucket', 'video.mp4').parts == {1: 'etag-1'}
+        store.delete(loaded)
+        assert store.load('s3', 'test_bucket', 'video.mp4') is None
@@ -0,0 +1,92 @@
+# Import necessary libraries and modules
+import json
+import os
+import tempfile
+from unittest.mock import patch
+
+from file_uploader import FileUploader
+from upload_manifest import UploadManifest, ManifestEntry, file_hash
+
+# Test UploadManifest keeping recorded files across reopening the manifest file
+def test_uploadmanifest_record_and_lookup():
+    with tempfile.TemporaryDirectory() as directory:
+        manifest_file = os.path.join(directory, 'manifest.db')
+        manifest = UploadManifest(manifest_file)
+        manifest.record('s3', 'test_bucket', 'sub/a.jpg', 10, 123, 'abc')
+        manifest.close()
+
+        # Check if the entry is found again for the same cloud service and bucket only
+        manifest = UploadManifest(manifest_file)
+        assert manifest.lookup('s3', 'test_bucket', 'sub/a.jpg') == ManifestEntry(10, 123, 'abc')
+        assert manifest.lookup('gcs', 'test_bucket', 'sub/a.jpg') is None
+        assert manifest.lookup('s3', 'other_bucket', 'sub/a.jpg') is None
+        manifest.close()
+
+# Test two UploadManifest connections, like two worker processes, recording files in the same manifest file
+def test_uploadmanifest_shared_file():
+    with tempfile.TemporaryDirectory() as directory:
+        manifest_file = os.path.join(directory, 'manifest.db')
+        first = UploadManifest(manifest_file, commit_every=1, timeout=1.0)
+        second = UploadManifest(manifest_file, commit_every=1, timeout=1.0)
+        for i in range(5):
+            first.record('s3', 'test_bucket', f'{i}.jpg', i, i, 'abc')
+            second.record('gcs', 'test_bucket', f'{i}.pdf', i, i, 'def')
+
+        # Check if every record is seen by the other connection at once
+        assert second.lookup('s3', 'test_bucket', '4.jpg') == ManifestEntry(4, 4, 'abc')
+        assert first.lookup('gcs', 'test_bucket', '4.pdf') == ManifestEntry(4, 4, 'def')
+        first.close()
+        second.close()
+
+# Test file_hash() returning the MD5 digest of the file content
+def test_file_hash():
+    with tempfile.NamedTemporaryFile('wb', delete=False) as f:
+        f.write(b'hello')
+    assert file_hash(f.name, chunk_size=2) == '5d41402abc4b2a76b9719d911017c592'
+    os.remove(f.name)
+
+# Test FileUploader skipping unchanged files when incremental sync is enabled
+def test_fileuploader_incremental_sync():
+    with tempfile.TemporaryDirectory() as directory:
+        data = os.path.join(directory, 'data')
+        os.makedirs(data)
+        for name in ('a.jpg', 'b.jpg'):
+            with open(os.path.join(data, name), 'w') as f:
+                f.write(name)
+
+        config_path = os.path.join(directory, 'config.json')
+        with open(config_path, 'w') as f:
+            json.dump({"cloud_services": {"s3": {"bucket_name": "test_s3_bucket", "credentials_file": "test_s3_credentials.csv"}},
+                       "file_types": {"image": ["jpg"], "media": []},
+                       "sync": {"enabled": True, "manifest_file": os.path.join(directory, 'manifest.db')}}, f)
+
+        with patch('file_uploader.S3Uploader') as mock_s3_uploader:
+            mock_s3_uploader.return_value.bucket_name = 'test_s3_bucket'
+            upload_file = mock_s3_uploader.return_value.upload_file
+            upload_file.return_value = True
+
+            # The first run uploads every file
+            FileUploader(data, config_path).upload_files()
+            assert upload_file.call_count == 2
+
+            # A second run without changes uploads nothing
+            upload_file.reset_mock()
+            FileUploader(data, config_path).upload_files()
+            upload_file.assert_not_called()
+
+            # Touching a file does not upload it again, changing its content does
+            os.utime(os.path.join(data, 'a.jpg'), ns=(1, 1))
+            with open(os.path.join(data, 'b.jpg'), 'w') as f:
+                f.write('new content')
+            FileUploader(data, config_path).upload_files()
+            upload_file.assert_called_once_with(os.path.join(data, 'b.jpg'))
+
+            # A failed upload is not recorded and is retried on the next run
+            upload_file.reset_mock()
+            with open(os.path.join(data, 'b.jpg'), 'w') as f:
+                f.write('newer content')
+            upload_file.return_value = False
+            FileUploader(data, config_path).upload_files()
+            upload_file.return_value = True
+            FileUploader(data, config_path).upload_files()
+            assert upload_file.call_count == 2
@@ -0,0 +1,86 @@
+# Import necessary libraries and modules
+import json
+import os
+import tempfile
+import urllib.request
+
+from upload_metrics import NULL_METRICS, CallbackSink, JsonLinesSink, Metrics, PrometheusFileSink, PrometheusHTTPSink, metrics_from_config
+
+# Test Metrics counting, setting gauges, filling histogram buckets and deriving the throughput of byte counters
+def test_metrics_snapshot():
+    metrics = Metrics(buckets=(0.1, 1.0))
+    metrics.inc('uploads_total', provider='s3', outcome='uploaded')
+    metrics.inc('uploads_total', 2, provider='s3', outcome='uploaded')
+    metrics.inc('upload_bytes_total', 1000, provider='s3')
+    metrics.set_gauge('queue_depth', 7, provider='gcs')
+    for value in (0.05, 0.5, 5.0):
+        metrics.observe('stage_seconds', value, provider='s3', stage='network')
+    with metrics.time('stage_seconds', provider='all', stage='hash'):
+        pass
+
+    snapshot = metrics.snapshot()
+    counters = {(c['name'], tuple(sorted(c['labels'].items()))): c['value'] for c in snapshot['counters']}
+    assert counters[('uploads_total', (('outcome', 'uploaded'), ('provider', 's3')))] == 3
+    gauges = {g['name']: g for g in snapshot['gauges']}
+    assert gauges['queue_depth']['value'] == 7
+    assert gauges['upload_bytes_per_second']['labels'] == {'provider': 's3'} and gauges['upload_bytes_per_second']['value'] > 0
+    histograms = {h['labels']['stage']: h for h in snapshot['histograms']}
+    assert histograms['network']['buckets'] == [(0.1, 1), (1.0, 2), ('+Inf', 3)]
+    assert histograms['network']['count'] == 3 and histograms['network']['sum'] == 5.55
+    assert histograms['hash']['count'] == 1
+
+    # Check if the collectors set their gauges before every flush, and a failing collector is skipped
+    snapshots = []
+    metrics.add_sink(CallbackSink(snapshots.append))
+    metrics.add_collector(lambda: 1 / 0)
+    metrics.add_collector(lambda: metrics.set_gauge('connections', 3, provider='s3'))
+    metrics.flush()
+    assert {g['name']: g['value'] for g in snapshots[-1]['gauges']}['connections'] == 3
+
+# Test the Prometheus text format written by PrometheusFileSink and served by PrometheusHTTPSink
+def test_prometheus_sinks():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'uploads.prom')
+        http_sink = PrometheusHTTPSink(0)
+        metrics = Metrics([PrometheusFileSink(path), http_sink], buckets=(1.0,))
+        metrics.inc('uploads_total', provider='s3', outcome='failed')
+        metrics.observe('stage_seconds', 0.5, provider='gcs', stage='network')
+        metrics.flush()
+
+        with open(path) as f:
+            text = f.read()
+        assert '# TYPE file_uploader_uploads_total counter' in text
+        assert 'file_uploader_uploads_total{outcome="failed",provider="s3"} 1' in text
+        assert 'file_uploader_stage_seconds_bucket{provider="gcs",stage="network",le="+Inf"} 1' in text
+        assert 'file_uploader_stage_seconds_count{provider="gcs",stage="network"} 1' in text
+
+        # Check if the HTTP endpoint serves the same exposition
+        with urllib.request.urlopen(f'http://127.0.0.1:{http_sink.port}/metrics') as response:
+            body = response.read().decode('utf-8')
+        assert response.headers['Content-Type'].startswith('text/plain')
+        assert 'file_uploader_uploads_total{outcome="failed",provider="s3"} 1' in body
+        metrics.close()
+
+# Test JsonLinesSink and CallbackSink getting every flush, and the disabled metrics from the config file
+def test_json_lines_and_callback_sinks():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'metrics.jsonl')
+        snapshots = []
+        metrics = Metrics([JsonLinesSink(path), CallbackSink(snapshots.append)])
+        metrics.inc('files_scanned_total')
+        metrics.observe('stage_seconds', 100.0, provider='all', stage='scan')
+        metrics.flush()
+        metrics.inc('files_scanned_total')
+        metrics.close()
+
+        with open(path) as f:
+            lines = [json.loads(line) for line in f]
+        assert [line['counters'][0]['value'] for line in lines] == [1, 2]
+        assert lines[0]['histograms'][0]['buckets'][-1] == ['+Inf', 1]
+        assert len(snapshots) == 2
+
+    # Check if disabled metrics are a shared no-op
+    assert metrics_from_config({}) is NULL_METRICS
+    with NULL_METRICS.time('stage_seconds', stage='scan'):
+        NULL_METRICS.inc('files_scanned_total')
+    assert not NULL_METRICS.enabled
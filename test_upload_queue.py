@@ -0,0 +1,103 @@
+# Import necessary libraries and modules
+import multiprocessing
+import os
+import tempfile
+import time
+
+from upload_queue import DONE, FAILED, LEASED, PENDING, UploadQueue
+
+# Test UploadQueue queuing jobs once, leasing them in order and recording their outcome across reopening the queue
+def test_uploadqueue_claim_and_complete():
+    with tempfile.TemporaryDirectory() as directory:
+        queue_file = os.path.join(directory, 'queue.db')
+        upload_queue = UploadQueue(queue_file, max_attempts=2)
+        jobs = [('s3', 'bucket', f'{i}.jpg', f'/data/{i}.jpg', 10, 100) for i in range(3)]
+        assert upload_queue.enqueue(jobs) == 3
+        # The same files are not queued again, a file whose size changed is
+        assert upload_queue.enqueue(jobs) == 0
+        assert upload_queue.enqueue([('s3', 'bucket', '0.jpg', '/data/0.jpg', 11, 100)]) == 1
+
+        claimed = upload_queue.claim('worker-a', 2)
+        assert [job.key for job in claimed] == ['0.jpg', '1.jpg'] and claimed[0].size == 11 and claimed[0].attempts == 1
+        assert upload_queue.complete('worker-a', claimed[0], True)
+        assert upload_queue.complete('worker-a', claimed[1], False, 'SlowDown')
+        upload_queue.close()
+
+        # A failed job is pending again until it used up its attempts
+        upload_queue = UploadQueue(queue_file, max_attempts=2)
+        assert upload_queue.counts() == {PENDING: 2, LEASED: 0, DONE: 1, FAILED: 0}
+        retried = upload_queue.claim('worker-b', 5)
+        assert [(job.key, job.attempts) for job in retried] == [('1.jpg', 2), ('2.jpg', 1)]
+        assert upload_queue.complete('worker-b', retried[0], False, 'SlowDown')
+        assert upload_queue.complete('worker-b', retried[1], None)
+        assert upload_queue.counts() == {PENDING: 0, LEASED: 0, DONE: 2, FAILED: 1}
+        assert upload_queue.failures() == [('/data/1.jpg', 's3', 'SlowDown')]
+
+        # Failed jobs can be retried with all of their attempts
+        assert upload_queue.retry_failed() == 1
+        assert upload_queue.claim('worker-b')[0].attempts == 1
+        upload_queue.close()
+
+# Test UploadQueue handing the job of a worker whose lease expired to another worker, unless the lease was renewed
+def test_uploadqueue_expired_leases():
+    with tempfile.TemporaryDirectory() as directory:
+        upload_queue = UploadQueue(os.path.join(directory, 'queue.db'), lease_seconds=0.4, max_attempts=2)
+        upload_queue.enqueue([('gcs', 'bucket', 'a.pdf', '/data/a.pdf', 1, 1), ('gcs', 'bucket', 'b.pdf', '/data/b.pdf', 1, 1)])
+        first, second = upload_queue.claim('crashed', 2)
+
+        # Renew the lease of the first job only, the second one expires and goes to the next worker
+        time.sleep(0.3)
+        assert upload_queue.renew('crashed', [first.id]) == 1
+        time.sleep(0.2)
+        assert upload_queue.counts()[PENDING] == 1
+        reclaimed = upload_queue.claim('worker', 2)
+        assert [job.key for job in reclaimed] == ['b.pdf'] and reclaimed[0].attempts == 2
+
+        # The outcome recorded by the worker that lost the lease is ignored
+        assert not upload_queue.complete('crashed', second, True)
+        assert upload_queue.complete('worker', reclaimed[0], True)
+
+        # A job whose lease expired after its last attempt is failed
+        time.sleep(0.3)
+        last = upload_queue.claim('worker')
+        assert [(job.key, job.attempts) for job in last] == [('a.pdf', 2)]
+        time.sleep(0.5)
+        assert upload_queue.claim('worker') == []
+        assert upload_queue.counts() == {PENDING: 0, LEASED: 0, DONE: 1, FAILED: 1}
+        assert upload_queue.failures() == [('/data/a.pdf', 'gcs', 'lease expired')]
+        upload_queue.close()
+
+
+def _claim_all(queue_file, results):
+    # Claim jobs one at a time from another process until none is left
+    upload_queue = UploadQueue(queue_file)
+    keys = []
+    while True:
+        jobs = upload_queue.claim(f'worker-{os.getpid()}')
+        if not jobs:
+            break
+        keys.append(jobs[0].key)
+        upload_queue.complete(f'worker-{os.getpid()}', jobs[0], True)
+    upload_queue.close()
+    results.put(keys)
+
+# Test UploadQueue never leasing the same job to two processes claiming at the same time
+def test_uploadqueue_multiple_processes():
+    with tempfile.TemporaryDirectory() as directory:
+        queue_file = os.path.join(directory, 'queue.db')
+        upload_queue = UploadQueue(queue_file)
+        upload_queue.enqueue([('s3', 'bucket', f'{i}.jpg', f'/data/{i}.jpg', 1, 1) for i in range(200)])
+
+        context = multiprocessing.get_context('spawn')
+        results = context.Queue()
+        processes = [context.Process(target=_claim_all, args=(queue_file, results)) for _ in range(3)]
+        for process in processes:
+            process.start()
+        keys = [key for _ in processes for key in results.get(timeout=60)]
+        for process in processes:
+            process.join()
+
+        # Check if every job was claimed by exactly one process
+        assert sorted(keys) == sorted(f'{i}.jpg' for i in range(200))
+        assert upload_queue.counts()[DONE] == 200
+        upload_queue.close()
@@ -0,0 +1,96 @@
+# Import necessary libraries and modules
+import botocore.exceptions
+import google.api_core.exceptions
+import pytest
+from boto3.exceptions import S3UploadFailedError
+
+from upload_retry import FATAL, RETRYABLE, THROTTLED, AdaptiveRateLimiter, HTTPStatusError, RetryPolicy, classify_gcs_error, classify_s3_error
+
+def client_error(code, status_code):
+    return botocore.exceptions.ClientError({'Error': {'Code': code}, 'ResponseMetadata': {'HTTPStatusCode': status_code}}, 'PutObject')
+
+# Test classify_s3_error and classify_gcs_error telling throttling, transient and fatal errors apart
+def test_classify_errors():
+    assert classify_s3_error(client_error('SlowDown', 503)) == THROTTLED
+    assert classify_s3_error(client_error('InternalError', 500)) == RETRYABLE
+    assert classify_s3_error(client_error('NoSuchBucket', 404)) == FATAL
+    assert classify_s3_error(client_error('AccessDenied', 403)) == FATAL
+    assert classify_s3_error(S3UploadFailedError('Failed to upload a.txt: An error occurred (SlowDown) when calling the PutObject operation')) == THROTTLED
+    assert classify_s3_error(botocore.exceptions.EndpointConnectionError(endpoint_url='https://s3')) == RETRYABLE
+    assert classify_s3_error(ValueError('bad argument')) == FATAL
+
+    assert classify_gcs_error(google.api_core.exceptions.TooManyRequests('slow down')) == THROTTLED
+    assert classify_gcs_error(google.api_core.exceptions.InternalServerError('oops')) == RETRYABLE
+    assert classify_gcs_error(google.api_core.exceptions.NotFound('no bucket')) == FATAL
+    assert classify_gcs_error(HTTPStatusError(503, 'unavailable')) == THROTTLED
+    assert classify_gcs_error(HTTPStatusError(400, 'bad request')) == FATAL
+
+# Test classify_s3_error looking at the error an S3UploadFailedError was raised from
+def test_classify_chained_s3_errors():
+    def upload_failed(cause):
+        try:
+            raise cause
+        except Exception:
+            try:
+                raise S3UploadFailedError('Failed to upload a.txt to bucket/a.txt: Connection was closed')
+            except S3UploadFailedError as e:
+                return e
+
+    assert classify_s3_error(upload_failed(botocore.exceptions.ReadTimeoutError(endpoint_url='https://s3'))) == RETRYABLE
+    assert classify_s3_error(upload_failed(botocore.exceptions.EndpointConnectionError(endpoint_url='https://s3'))) == RETRYABLE
+    assert classify_s3_error(upload_failed(client_error('SlowDown', 503))) == THROTTLED
+    assert classify_s3_error(upload_failed(client_error('NoSuchBucket', 404))) == FATAL
+
+# Test RetryPolicy retrying transient errors with bounded backoff and giving up on fatal errors
+def test_retrypolicy_call(monkeypatch):
+    delays = []
+    monkeypatch.setattr('upload_retry.time.sleep', delays.append)
+    policy = RetryPolicy(max_attempts=4, base_delay=0.5, max_delay=1.0)
+
+    # Check if the call succeeds after two throttled attempts, waiting within the backoff bounds
+    attempts = []
+    def flaky():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise HTTPStatusError(429, 'slow down')
+        return 'done'
+    assert policy.call(flaky, classify_gcs_error) == 'done'
+    assert len(delays) == 2 and 0 <= delays[0] <= 0.5 and 0 <= delays[1] <= 1.0
+
+    # Check if a fatal error is raised at once and a transient error after max_attempts
+    attempts.clear()
+    def fatal():
+        attempts.append(1)
+        raise HTTPStatusError(404, 'not found')
+    with pytest.raises(HTTPStatusError):
+        policy.call(fatal, classify_gcs_error)
+    assert len(attempts) == 1
+
+    attempts.clear()
+    def down():
+        attempts.append(1)
+        raise HTTPStatusError(500, 'internal error')
+    with pytest.raises(HTTPStatusError):
+        policy.call(down, classify_gcs_error)
+    assert len(attempts) == 4
+    assert all(delay <= 1.0 for delay in delays)
+
+# Test AdaptiveRateLimiter halving its limit on throttling and growing it back on success
+def test_adaptiveratelimiter():
+    limiter = AdaptiveRateLimiter(8, cooldown=60)
+    limiter.on_throttle()
+    assert limiter.limit == 4
+
+    # Check if a burst of throttled requests within the cooldown only counts once
+    limiter.on_throttle()
+    assert limiter.limit == 4
+
+    for _ in range(40):
+        limiter.on_success()
+    assert limiter.limit == 8
+
+    # Check if requests in flight are counted
+    limiter.acquire()
+    assert limiter.in_flight == 1
+    limiter.release()
+    assert limiter.in_flight == 0
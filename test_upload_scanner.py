@@ -0,0 +1,52 @@
+# Import necessary libraries and modules
+import os
+import tempfile
+
+from upload_scanner import DirectoryScanner, ExtensionRouter, WorkItem, scan_directory_entries
+
+# Test ExtensionRouter routing files by extension, case-insensitively
+def test_extensionrouter_route():
+    router = ExtensionRouter({'s3': ['jpg', 'PDF'], 'gcs': ['pdf', 'csv']})
+    assert router.route('photo.JPG') == frozenset({'s3'})
+    assert router.route('report.v2.pdf') == frozenset({'s3', 'gcs'})
+    assert router.route('notes.txt') == frozenset()
+    assert router.route('README') == frozenset()
+
+# Test scan_directory_entries() listing subdirectories and routed files with their size
+def test_scan_directory_entries():
+    with tempfile.TemporaryDirectory() as directory:
+        os.makedirs(os.path.join(directory, 'sub'))
+        with open(os.path.join(directory, 'a.jpg'), 'wb') as f:
+            f.write(b'abc')
+        open(os.path.join(directory, 'b.txt'), 'w').close()
+
+        subdirectories, items = scan_directory_entries(directory, ExtensionRouter({'s3': ['jpg']}))
+        assert subdirectories == [os.path.join(directory, 'sub')]
+        assert len(items) == 1
+        assert isinstance(items[0], WorkItem)
+        assert items[0].path == os.path.join(directory, 'a.jpg')
+        assert items[0].size == 3
+        assert items[0].targets == frozenset({'s3'})
+
+# Test DirectoryScanner finding every routed file of a deep tree with several threads
+def test_directoryscanner_scan():
+    with tempfile.TemporaryDirectory() as directory:
+        expected = set()
+        for i in range(5):
+            for j in range(4):
+                subdirectory = os.path.join(directory, f'd{i}', f'e{j}')
+                os.makedirs(subdirectory)
+                for k in range(3):
+                    path = os.path.join(subdirectory, f'{k}.pdf')
+                    open(path, 'w').close()
+                    expected.add(path)
+                open(os.path.join(subdirectory, 'skip.tmp'), 'w').close()
+
+        # A small queue makes the workers wait for the consumer
+        scanner = DirectoryScanner(directory, ExtensionRouter({'gcs': ['pdf']}), max_workers=4, queue_size=2)
+        assert {item.path for item in scanner.scan()} == expected
+
+        # Stopping the iteration early stops the workers
+        scan = scanner.scan()
+        next(scan)
+        scan.close()
@@ -0,0 +1,131 @@
+# Import necessary libraries and modules
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+
+from upload_scheduler import BLOCK_SIZE, ConcurrencyBudget, ThrottledBody, TokenBucket, UploadScheduler, scheduler_from_config
+
+# Test TokenBucket capping the rate, letting better priorities go first and changing the rate at runtime
+def test_token_bucket():
+    bucket = TokenBucket(rate=1000, burst=100)
+    # The first consumer goes into debt at once and the next ones wait for it to be paid back,
+    # so three times 100 bytes at 1000 bytes/s take about 0.2 seconds
+    started = time.monotonic()
+    for _ in range(3):
+        bucket.consume(100)
+    assert 0.15 <= time.monotonic() - started < 1.0
+
+    # While a consumer of priority 0 waits for tokens, a consumer of priority 1 waits behind it
+    order = []
+    bucket.consume(100)
+    worse = threading.Thread(target=lambda: (bucket.consume(10, priority=1), order.append(1)))
+    better = threading.Thread(target=lambda: (bucket.consume(10, priority=0), order.append(0)))
+    better.start()
+    time.sleep(0.02)
+    worse.start()
+    better.join()
+    worse.join()
+    assert order == [0, 1]
+
+    # Removing the rate releases the waiting consumers at once
+    bucket.consume(10000)
+    waiting = threading.Thread(target=bucket.consume, args=(10,))
+    waiting.start()
+    bucket.set_rate(None)
+    waiting.join(timeout=1.0)
+    assert not waiting.is_alive()
+
+# Test ConcurrencyBudget starting waiting uploads in priority order and raising its limit at runtime
+def test_concurrency_budget():
+    budget = ConcurrencyBudget(1)
+    budget.acquire()
+    started = []
+    threads = [threading.Thread(target=lambda priority=priority: (budget.acquire(priority), started.append(priority)))
+               for priority in (2, 0, 1)]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.02)
+    assert started == []
+
+    # Release the running upload and the next ones one at a time
+    for _ in range(2):
+        budget.release()
+        time.sleep(0.05)
+    assert started == [0, 1]
+
+    # A higher limit starts the last upload without waiting for a release
+    budget.set_limit(3)
+    for thread in threads:
+        thread.join(timeout=1.0)
+    assert started == [0, 1, 2] and budget.running == 2
+
+# Test UploadScheduler throttling request bodies, classifying files and applying the control file
+def test_upload_scheduler():
+    scheduler = scheduler_from_config({'enabled': True, 'gcs': {'bandwidth': 10 * BLOCK_SIZE}, 'priorities': {'document': 0, 'media': 2},
+                                       'small_file_size': 1024}, {'document': ['pdf'], 'media': ['mp4']})
+    assert scheduler_from_config({'enabled': False}, {}) is None
+
+    # Small files go first whatever their type, unknown types get the worst priority
+    assert scheduler.priority('film.MP4', 10 * 1024 * 1024) == 2
+    assert scheduler.priority('film.mp4', 10) == 0
+    assert scheduler.priority('report.pdf', 10 * 1024 * 1024) == 0
+    assert scheduler.priority('archive.zip', 10 * 1024 * 1024) == 2
+
+    # Bodies of uncapped cloud services are not wrapped, capped bodies are read in blocks
+    assert scheduler.throttle('s3', b'data') == b'data'
+    body = scheduler.throttle('gcs', b'x' * (BLOCK_SIZE + 10))
+    assert isinstance(body, ThrottledBody)
+    assert len(body.read(10 * BLOCK_SIZE)) == BLOCK_SIZE
+    assert body.read() == b'x' * 10
+    body.seek(0)
+    assert isinstance(io.BufferedReader(body).read(), bytes)
+
+    # Limits written to the control file are applied while it is watched
+    with tempfile.TemporaryDirectory() as directory:
+        control_file = os.path.join(directory, 'control.json')
+        scheduler.watch(control_file, interval=0.01)
+        try:
+            with open(control_file, 'w') as f:
+                json.dump({'bandwidth': 5000, 'gcs': {'bandwidth': 0, 'concurrency': 2}}, f)
+            deadline = time.monotonic() + 2.0
+            while scheduler.service_concurrency['gcs'].limit != 2 and time.monotonic() < deadline:
+                time.sleep(0.01)
+        finally:
+            scheduler.stop()
+    assert scheduler.bandwidth.rate == 5000
+    assert scheduler.service_bandwidth['gcs'].rate is None
+    assert scheduler.service_concurrency['gcs'].limit == 2
+
+    # A slot holds both concurrency budgets until the block ends
+    with scheduler.slot('gcs', 0):
+        assert scheduler.concurrency.running == 1 and scheduler.service_concurrency['gcs'].running == 1
+    assert scheduler.service_concurrency['gcs'].running == 0
+
+# Test UploadScheduler sharing the global concurrency budget fairly when one cloud service is saturated
+def test_upload_scheduler_saturated_service():
+    scheduler = UploadScheduler(concurrency=2, services={'s3': {'concurrency': 1}, 'gcs': {}})
+    scheduler.acquire('s3')
+
+    # A second S3 upload waits for the S3 budget without taking a global slot
+    acquired = threading.Event()
+    def second_upload():
+        scheduler.acquire('s3')
+        acquired.set()
+    thread = threading.Thread(target=second_upload, daemon=True)
+    thread.start()
+    assert not acquired.wait(0.05)
+    assert scheduler.concurrency.running == 1
+
+    # Check if GCS still gets the free global slot, and the waiting S3 upload starts once both are released
+    gcs_started = threading.Event()
+    threading.Thread(target=lambda: (scheduler.acquire('gcs'), gcs_started.set()), daemon=True).start()
+    assert gcs_started.wait(1.0)
+    scheduler.release('gcs')
+    scheduler.release('s3')
+    assert acquired.wait(1.0)
+    thread.join()
+    scheduler.release('s3')
+    assert scheduler.concurrency.running == 0 and scheduler.service_concurrency['s3'].running == 0
@@ -0,0 +1,101 @@
+# Import necessary libraries and modules
+import os
+import tempfile
+import threading
+import time
+
+import pytest
+
+from upload_scanner import ExtensionRouter
+from upload_watcher import Debouncer, DirectoryWatcher, InotifyWatcher, PollingWatcher
+
+# Test Debouncer holding back a file until its size and mtime stop changing
+def test_debouncer_waits_for_stable_files():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'growing.pdf')
+        with open(path, 'wb') as f:
+            f.write(b'x')
+        debouncer = Debouncer(settle=1.0)
+        debouncer.add(path, now=0.0)
+        assert debouncer.ready(now=0.5) == []
+
+        # The file grew before it settled, so it is checked again one settle period later
+        with open(path, 'ab') as f:
+            f.write(b'y')
+        assert debouncer.ready(now=1.0) == []
+        assert debouncer.next_deadline() == 2.0
+        stat = os.stat(path)
+        assert debouncer.ready(now=2.0) == [(path, 2, stat.st_mtime_ns)]
+        assert len(debouncer) == 0
+
+        # A file removed before it settled is dropped
+        debouncer.add(path, now=3.0)
+        os.remove(path)
+        assert debouncer.ready(now=4.0) == [] and len(debouncer) == 0
+
+# Test the inotify and polling watchers reporting new files, also in new subdirectories
+@pytest.mark.parametrize('backend', ['inotify', 'polling'])
+def test_watchers_report_new_files(backend):
+    with tempfile.TemporaryDirectory() as directory:
+        open(os.path.join(directory, 'old.pdf'), 'w').close()
+        if backend == 'inotify':
+            try:
+                watcher = InotifyWatcher(directory)
+            except OSError as e:
+                pytest.skip(f"inotify is not available: {e}")
+        else:
+            watcher = PollingWatcher(directory, interval=0.05)
+        try:
+            # Write a file, move another one in and create a subdirectory holding a file
+            with open(os.path.join(directory, 'new.pdf'), 'w') as f:
+                f.write('new')
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(directory), delete=False) as f:
+                f.write(b'moved')
+            os.rename(f.name, os.path.join(directory, 'moved.jpg'))
+            os.makedirs(os.path.join(directory, 'sub', 'deeper'))
+            with open(os.path.join(directory, 'sub', 'deeper', 'nested.mp4'), 'w') as f:
+                f.write('nested')
+
+            paths = set()
+            deadline = time.monotonic() + 2.0
+            while time.monotonic() < deadline and len(paths) < 3:
+                paths.update(watcher.read(0.1))
+        finally:
+            watcher.close()
+
+        # Check if the new files were reported and the file present at startup was not
+        assert paths == {os.path.join(directory, 'new.pdf'), os.path.join(directory, 'moved.jpg'),
+                         os.path.join(directory, 'sub', 'deeper', 'nested.mp4')}
+
+# Test DirectoryWatcher batching the stable new files routed to a cloud service until it is stopped
+def test_directory_watcher_batches():
+    with tempfile.TemporaryDirectory() as directory:
+        router = ExtensionRouter({'s3': ['jpg'], 'gcs': ['pdf']})
+        watcher = DirectoryWatcher(directory, router, settle=0.05, batch_size=2, batch_interval=0.1, poll_interval=0.05, backend='polling')
+        watcher.start()
+        stop_event = threading.Event()
+        batches = []
+
+        def consume():
+            for batch in watcher.batches(stop_event):
+                batches.append(batch)
+
+        thread = threading.Thread(target=consume)
+        thread.start()
+        try:
+            for name in ('a.jpg', 'b.pdf', 'c.jpg', 'ignored.txt'):
+                with open(os.path.join(directory, name), 'w') as f:
+                    f.write(name)
+            deadline = time.monotonic() + 3.0
+            while time.monotonic() < deadline and sum(len(batch) for batch in batches) < 3:
+                time.sleep(0.02)
+        finally:
+            stop_event.set()
+            thread.join()
+            watcher.close()
+
+        # Check if every routed file came once with its cloud services, in batches of at most two files
+        items = {os.path.basename(item.path): item for batch in batches for item in batch}
+        assert set(items) == {'a.jpg', 'b.pdf', 'c.jpg'}
+        assert items['b.pdf'].targets == {'gcs'} and items['a.jpg'].size == 5
+        assert all(1 <= len(batch) <= 2 for batch in batches)
@@ -0,0 +1,110 @@
+import hashlib
+import json
+import os
+import threading
+
+
+class UploadCheckpoint:
+    '''Define a class called UploadCheckpoint which records the progress of one large file upload.
+
+    It holds the upload ID (S3 multipart upload) or session URI (GCS resumable upload), the part size,
+    the size and mtime of the file when the upload started and the completed parts. Every change is
+    written to the checkpoint file at once, through a temporary file, so it survives a crash.
+    '''
+
+    def __init__(self, checkpoint_file, data):
+        self.checkpoint_file = checkpoint_file
+        self.data = data
+        self._lock = threading.Lock()
+
+    @property
+    def upload_id(self):
+        return self.data['upload_id']
+
+    @property
+    def part_size(self):
+        return self.data['part_size']
+
+    @property
+    def parts(self):
+        # Completed parts as {part_number: etag}
+        return {int(number): etag for number, etag in self.data['parts'].items()}
+
+    def matches(self, file_size, mtime_ns):
+        # A checkpoint only applies to the exact file it was created for
+        return self.data['file_size'] == file_size and self.data['mtime_ns'] == mtime_ns
+
+    def add_part(self, part_number, etag):
+        '''Record a completed part and save the checkpoint'''
+
+        with self._lock:
+            self.data['parts'][str(part_number)] = etag
+            self._save()
+
+    def set_parts(self, parts):
+        '''Replace the completed parts, e.g. with the parts confirmed by the cloud service, and save the checkpoint'''
+
+        with self._lock:
+            self.data['parts'] = {str(number): etag for number, etag in parts.items()}
+            self._save()
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        temporary_file = self.checkpoint_file + '.tmp'
+        with open(temporary_file, 'w') as f:
+            json.dump(self.data, f)
+        os.replace(temporary_file, self.checkpoint_file)
+
+
+class CheckpointStore:
+    '''Define a class called CheckpointStore which keeps one UploadCheckpoint file per cloud service, bucket and key'''
+
+    def __init__(self, checkpoint_dir):
+        # The directory is created by the first checkpoint, so a run without large files leaves nothing behind
+        self.checkpoint_dir = checkpoint_dir
+
+
+    def _checkpoint_file(self, service, bucket, key):
+        name = hashlib.sha1(f"{service}/{bucket}/{key}".encode('utf-8')).hexdigest()
+        return os.path.join(self.checkpoint_dir, f"{name}.json")
+
+
+    def load(self, service, bucket, key):
+        '''Return the UploadCheckpoint of the key, or None when there is none or it cannot be read'''
+
+        checkpoint_file = self._checkpoint_file(service, bucket, key)
+        try:
+            with open(checkpoint_file) as f:
+                return UploadCheckpoint(checkpoint_file, json.load(f))
+        except (OSError, ValueError):
+            return None
+
+
+    def create(self, service, bucket, key, upload_id, part_size, file_size, mtime_ns):
+        '''Create and save the checkpoint of a new upload'''
+
+        checkpoint = UploadCheckpoint(self._checkpoint_file(service, bucket, key), {
+            'service': service,
+            'bucket': bucket,
+            'key': key,
+            'upload_id': upload_id,
+            'part_size': part_size,
+            'file_size': file_size,
+            'mtime_ns': mtime_ns,
+            'parts': {}
+        })
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        checkpoint.save()
+        return checkpoint
+
+
+    def delete(self, checkpoint):
+        '''Remove the checkpoint once its upload is complete or abandoned'''
+
+        try:
+            os.remove(checkpoint.checkpoint_file)
+        except FileNotFoundError:
+            pass
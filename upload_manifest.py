@@ -0,0 +1,111 @@
+import hashlib
+import os
+import pathlib
+import sqlite3
+import threading
+from collections import namedtuple
+
+
+# One manifest row: what was uploaded for a file the last time it was uploaded
+ManifestEntry = namedtuple('ManifestEntry', ['size', 'mtime_ns', 'content_hash'])
+
+
+def file_hash(file_path, chunk_size=1024 * 1024):
+    '''Return the hex MD5 digest of the content of the file, reading it in chunks'''
+
+    digest = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class UploadManifest:
+    '''Define a class called UploadManifest which keeps an on-disk index of uploaded files.
+
+    The index is a SQLite database keyed by cloud service, bucket and path relative to the synced
+    directory, storing the size, mtime and content hash of every file at the time it was uploaded.
+    Lookups go through the primary key, so the manifest opens instantly whatever its size.
+    A file is recorded only after its upload succeeded and rows are committed in batches, so an
+    interrupted run can at worst upload the files of the last uncommitted batch again.
+
+    A batch holds the write lock of the database until it is committed. Processes sharing the manifest
+    file must use commit_every=1, a writer then waits up to timeout seconds for the lock of another one.
+
+    With read_only=True an existing manifest is only looked up: no file is created or changed and
+    record raises an exception.
+    '''
+
+    def __init__(self, manifest_file, commit_every=500, timeout=30.0, read_only=False):
+        self.manifest_file = manifest_file
+        self.commit_every = commit_every
+        self._pending = 0
+        self._lock = threading.Lock()
+
+        if read_only:
+            # A manifest with a WAL file is read through it, as another process may be writing. Otherwise it is opened
+            # as immutable, so SQLite does not create the WAL index next to it
+            mode = 'ro' if os.path.exists(manifest_file + '-wal') else 'ro&immutable=1'
+            try:
+                self.db = sqlite3.connect(f"{pathlib.Path(manifest_file).absolute().as_uri()}?mode={mode}", uri=True,
+                                          timeout=timeout, check_same_thread=False)
+                self.db.execute('SELECT 1 FROM files LIMIT 1')
+            except sqlite3.Error as e:
+                raise Exception(f"Failed to open manifest file '{manifest_file}': {e}")
+            return
+
+        try:
+            # The connection is shared by the worker threads, access is serialized with the lock
+            self.db = sqlite3.connect(manifest_file, timeout=timeout, check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS files ('
+                'service TEXT NOT NULL, bucket TEXT NOT NULL, path TEXT NOT NULL, '
+                'size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, content_hash TEXT NOT NULL, '
+                'PRIMARY KEY (service, bucket, path)) WITHOUT ROWID'
+            )
+            self.db.commit()
+        except sqlite3.Error as e:
+            raise Exception(f"Failed to open manifest file '{manifest_file}': {e}")
+
+
+    def lookup(self, service, bucket, path):
+        '''Return the ManifestEntry recorded for the file, or None if it was never uploaded'''
+
+        with self._lock:
+            row = self.db.execute(
+                'SELECT size, mtime_ns, content_hash FROM files WHERE service = ? AND bucket = ? AND path = ?',
+                (service, bucket, path)
+            ).fetchone()
+        return ManifestEntry(*row) if row else None
+
+
+    def record(self, service, bucket, path, size, mtime_ns, content_hash):
+        '''Record that the file with the given size, mtime and content hash was uploaded'''
+
+        with self._lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO files (service, bucket, path, size, mtime_ns, content_hash) VALUES (?, ?, ?, ?, ?, ?)',
+                (service, bucket, path, size, mtime_ns, content_hash)
+            )
+            self._pending += 1
+            if self._pending >= self.commit_every:
+                self.db.commit()
+                self._pending = 0
+
+
+    def commit(self):
+        '''Write the recorded files to disk'''
+
+        with self._lock:
+            self.db.commit()
+            self._pending = 0
+
+
+    def close(self):
+        '''Write the recorded files to disk and close the database'''
+
+        self.commit()
+        with self._lock:
+            self.db.close()
@@ -0,0 +1,362 @@
+import bisect
+import contextlib
+import http.server
+import json
+import logging
+import os
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+# Upper bounds in seconds of the buckets of the latency histograms, from a small file to a large multipart upload
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def _label_key(labels):
+    # Labels are stored as a sorted tuple of pairs so they can be part of a dictionary key
+    return tuple(sorted(labels.items()))
+
+
+class Histogram:
+    '''Define a class called Histogram which counts observed values in buckets of fixed upper bounds'''
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        # One count per bucket plus one for the values above the last bound
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        # Return (upper bound, number of values at or below it) pairs, the last bound being '+Inf' as JSON has no infinity
+        pairs = []
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            pairs.append((bound, total))
+        return pairs
+
+
+class _Timer:
+    # Context manager observing the seconds spent in its block
+    __slots__ = ('metrics', 'name', 'labels', 'started')
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.name, time.monotonic() - self.started, **self.labels)
+        return False
+
+
+class Metrics:
+    '''Define a class called Metrics which collects the counters, gauges and latency histograms of the uploads.
+
+    Every value is identified by a name and labels, e.g. provider='s3' and stage='network'. The values
+    are only kept in memory: flush() hands a snapshot of them to every sink, and start() flushes on a
+    background thread every interval seconds. Collectors added with add_collector() are called by every
+    flush before the snapshot, to set gauges read from elsewhere, such as connection pools. Counters whose name ends with '_bytes_total' also get a
+    '_bytes_per_second' gauge in the snapshot, their value divided by the seconds since the Metrics was created.
+    '''
+
+    enabled = True
+
+    def __init__(self, sinks=(), buckets=LATENCY_BUCKETS):
+        self.sinks = list(sinks)
+        self.buckets = buckets
+        self.started = time.monotonic()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self.collectors = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def add_collector(self, collector):
+        # Call collector() before every flush, so it can set the gauges it reads from elsewhere
+        self.collectors.append(collector)
+
+    def inc(self, name, value=1, **labels):
+        # Add value to a counter
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        # Set a gauge to its current value, e.g. the number of files waiting in a queue
+        with self._lock:
+            self._gauges[(name, _label_key(labels))] = value
+
+    def observe(self, name, value, **labels):
+        # Add a value, e.g. a latency in seconds, to a histogram
+        key = (name, _label_key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    def time(self, name, **labels):
+        '''Return a context manager observing the seconds spent in its block in the histogram name'''
+        return _Timer(self, name, labels)
+
+    def snapshot(self):
+        '''Return the current values as a dictionary which can be written as JSON'''
+
+        elapsed = time.monotonic() - self.started
+        with self._lock:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in sorted(self._counters.items())]
+            gauges = [{'name': name, 'labels': dict(labels), 'value': value}
+                      for (name, labels), value in sorted(self._gauges.items())]
+            histograms = [{'name': name, 'labels': dict(labels), 'buckets': histogram.cumulative(),
+                           'sum': histogram.sum, 'count': histogram.count}
+                          for (name, labels), histogram in sorted(self._histograms.items())]
+
+        # Derive the throughput from the byte counters
+        for counter in counters:
+            if counter['name'].endswith('_bytes_total'):
+                gauges.append({'name': counter['name'][:-len('_total')] + '_per_second', 'labels': counter['labels'],
+                               'value': counter['value'] / elapsed if elapsed > 0 else 0.0})
+
+        return {'timestamp': time.time(), 'elapsed': elapsed, 'counters': counters, 'gauges': gauges, 'histograms': histograms}
+
+    def flush(self):
+        # Hand a snapshot to every sink, a failing sink or collector never stops the uploads
+        if not self.sinks:
+            return
+        for collector in list(self.collectors):
+            try:
+                collector()
+            except Exception as e:
+                logger.warning("Metrics collector %s failed: %s", getattr(collector, '__name__', type(collector).__name__), e)
+        snapshot = self.snapshot()
+        for sink in self.sinks:
+            try:
+                sink.emit(snapshot)
+            except Exception as e:
+                logger.warning("Metrics sink %s failed: %s", type(sink).__name__, e)
+
+    def start(self, interval):
+        # Flush every interval seconds on a background thread until close() is called
+        def run():
+            while not self._stopped.wait(interval):
+                self.flush()
+
+        self._stopped.clear()
+        self._thread = threading.Thread(target=run, name='metrics-flush', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        # Stop the background flushes and flush the final values
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def close(self):
+        # Stop the background flushes and close the sinks, e.g. the HTTP server of a PrometheusHTTPSink
+        self.stop()
+        for sink in self.sinks:
+            if hasattr(sink, 'close'):
+                sink.close()
+
+
+class NullMetrics:
+    '''Define a class called NullMetrics with the methods of Metrics doing nothing, used when metrics are disabled.
+    Callers check the enabled attribute before measuring anything that costs more than a method call'''
+
+    enabled = False
+
+    def add_sink(self, sink):
+        pass
+
+    def add_collector(self, collector):
+        pass
+
+    def inc(self, name, value=1, **labels):
+        pass
+
+    def set_gauge(self, name, value, **labels):
+        pass
+
+    def observe(self, name, value, **labels):
+        pass
+
+    def time(self, name, **labels):
+        return _NULL_TIMER
+
+    def flush(self):
+        pass
+
+    def start(self, interval):
+        pass
+
+    def stop(self):
+        pass
+
+    def close(self):
+        pass
+
+
+# A single context manager doing nothing, shared by every disabled timer
+_NULL_TIMER = contextlib.nullcontext()
+
+NULL_METRICS = NullMetrics()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels, extra=None):
+    pairs = list(labels.items()) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if isinstance(value, str):
+        return value
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def prometheus_text(snapshot, prefix='file_uploader_'):
+    '''Return a snapshot in the Prometheus text exposition format, every metric name starting with prefix'''
+
+    lines = []
+    typed = set()
+
+    def declare(name, kind):
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {name} {kind}")
+
+    for kind, samples in (('counter', snapshot['counters']), ('gauge', snapshot['gauges'])):
+        for sample in samples:
+            name = prefix + sample['name']
+            declare(name, kind)
+            lines.append(f"{name}{_format_labels(sample['labels'])} {_format_value(sample['value'])}")
+
+    for sample in snapshot['histograms']:
+        name = prefix + sample['name']
+        declare(name, 'histogram')
+        for bound, count in sample['buckets']:
+            lines.append(f"{name}_bucket{_format_labels(sample['labels'], ('le', _format_value(bound)))} {count}")
+        lines.append(f"{name}_sum{_format_labels(sample['labels'])} {_format_value(sample['sum'])}")
+        lines.append(f"{name}_count{_format_labels(sample['labels'])} {sample['count']}")
+
+    return '\n'.join(lines) + '\n'
+
+
+class PrometheusFileSink:
+    '''Define a class called PrometheusFileSink which writes every snapshot to a file in the Prometheus text format,
+    e.g. in the directory of the textfile collector of node_exporter. The file is replaced atomically, so a
+    scrape never reads half of it'''
+
+    def __init__(self, path):
+        self.path = path
+
+    def emit(self, snapshot):
+        temporary_path = f"{self.path}.tmp"
+        with open(temporary_path, 'w') as f:
+            f.write(prometheus_text(snapshot))
+        os.replace(temporary_path, self.path)
+
+
+class PrometheusHTTPSink:
+    '''Define a class called PrometheusHTTPSink which serves the last snapshot in the Prometheus text format
+    at http://host:port/metrics from a background thread. Port 0 picks a free port, read back from the port attribute'''
+
+    def __init__(self, port, host='127.0.0.1'):
+        self._text = b''
+        sink = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = sink._text
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # Scrapes are logged at debug level instead of being written to stderr
+                logger.debug("Metrics scrape: " + format, *args)
+
+        self._server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, name='metrics-http', daemon=True)
+        self._thread.start()
+
+    def emit(self, snapshot):
+        self._text = prometheus_text(snapshot).encode('utf-8')
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+
+class JsonLinesSink:
+    '''Define a class called JsonLinesSink which appends every snapshot to a file as one line of JSON'''
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def emit(self, snapshot):
+        line = json.dumps(snapshot) + '\n'
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(line)
+
+
+class CallbackSink:
+    '''Define a class called CallbackSink which calls a function with every snapshot, for in-process consumers'''
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def emit(self, snapshot):
+        self.callback(snapshot)
+
+
+def metrics_from_config(settings):
+    '''Return the Metrics described by the 'metrics' section of the config file, or NULL_METRICS when it is disabled'''
+
+    if not settings.get('enabled', False):
+        return NULL_METRICS
+    sinks = []
+    if settings.get('prometheus_file'):
+        sinks.append(PrometheusFileSink(settings['prometheus_file']))
+    if settings.get('prometheus_port') is not None:
+        sinks.append(PrometheusHTTPSink(settings['prometheus_port'], settings.get('prometheus_host', '127.0.0.1')))
+    if settings.get('json_lines_file'):
+        sinks.append(JsonLinesSink(settings['json_lines_file']))
+    return Metrics(sinks)
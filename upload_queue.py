@@ -0,0 +1,187 @@
+import os
+import socket
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+
+# States of a job: waiting for a worker, claimed by a worker until its lease expires, uploaded, or failed for good
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+# One file to upload to one cloud service, as claimed by a worker
+Job = namedtuple('Job', ['id', 'service', 'bucket', 'key', 'path', 'size', 'mtime_ns', 'attempts'])
+
+
+def default_worker_id():
+    '''Return an ID naming the calling process, unique across the hosts sharing a queue'''
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class UploadQueue:
+    '''Define a class called UploadQueue which keeps the upload jobs of a backfill in a SQLite database on disk.
+
+    The scanner enqueues one job per file and cloud service. Workers in any number of processes open the
+    same file, claim pending jobs with a lease of lease_seconds and record the outcome of each one. A job
+    whose lease expired, because its worker crashed or hangs, is pending again for the next claim, and a
+    job failing max_attempts times is marked failed. Every change is committed at once, so a crash never
+    loses track of the jobs done: at worst the jobs leased by a crashed worker are uploaded again.
+
+    The database uses WAL journaling, which lets processes of one host read while another writes. WAL does
+    not work on network filesystems: processes on several hosts sharing a directory must use
+    journal_mode='DELETE' and a filesystem with working POSIX locks.
+    '''
+
+    def __init__(self, queue_file, lease_seconds=300, max_attempts=3, journal_mode='WAL'):
+        self.queue_file = queue_file
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+
+        try:
+            # Transactions are started explicitly, and writers wait up to 30 seconds for the lock of another process
+            self.db = sqlite3.connect(queue_file, timeout=30, isolation_level=None, check_same_thread=False)
+            self.db.execute(f'PRAGMA journal_mode={journal_mode}')
+            self.db.execute('PRAGMA synchronous=NORMAL' if journal_mode.upper() == 'WAL' else 'PRAGMA synchronous=FULL')
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                'id INTEGER PRIMARY KEY, service TEXT NOT NULL, bucket TEXT NOT NULL, key TEXT NOT NULL, path TEXT NOT NULL, '
+                'size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, state TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, '
+                'worker TEXT, lease_expires REAL, error TEXT, '
+                'UNIQUE (service, bucket, path))'
+            )
+            self.db.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id)')
+        except sqlite3.Error as e:
+            raise Exception(f"Failed to open upload queue '{queue_file}': {e}")
+
+
+    def _transaction(self, func, *args):
+        # Run func in a write transaction, taking the database lock at once so claims of several processes never interleave
+        with self._lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                result = func(*args)
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+            self.db.execute('COMMIT')
+            return result
+
+
+    def enqueue(self, jobs):
+        '''Add (service, bucket, key, path, size, mtime_ns) jobs in one transaction and return the number added.
+        A file already queued for the same cloud service and bucket is queued again only when its size or mtime changed'''
+
+        def insert(rows):
+            before = self.db.total_changes
+            self.db.executemany(
+                'INSERT INTO jobs (service, bucket, key, path, size, mtime_ns, state) VALUES (?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT (service, bucket, path) DO UPDATE SET key = excluded.key, size = excluded.size, '
+                'mtime_ns = excluded.mtime_ns, state = excluded.state, attempts = 0, worker = NULL, lease_expires = NULL, error = NULL '
+                'WHERE size != excluded.size OR mtime_ns != excluded.mtime_ns',
+                [(*job, PENDING) for job in rows]
+            )
+            return self.db.total_changes - before
+
+        return self._transaction(insert, list(jobs))
+
+
+    def _expire_leases(self, now):
+        # Make the jobs whose lease expired pending again, or failed when they used up their attempts
+        self.db.execute(
+            'UPDATE jobs SET state = CASE WHEN attempts >= ? THEN ? ELSE ? END, worker = NULL, lease_expires = NULL, '
+            "error = 'lease expired' WHERE state = ? AND lease_expires < ?",
+            (self.max_attempts, FAILED, PENDING, LEASED, now)
+        )
+
+
+    def claim(self, worker, count=1):
+        '''Lease up to count pending jobs to the worker for lease_seconds and return them, oldest first'''
+
+        def lease():
+            now = time.time()
+            self._expire_leases(now)
+            rows = self.db.execute(
+                'SELECT id, service, bucket, key, path, size, mtime_ns, attempts FROM jobs WHERE state = ? ORDER BY id LIMIT ?',
+                (PENDING, count)
+            ).fetchall()
+            self.db.executemany(
+                'UPDATE jobs SET state = ?, worker = ?, lease_expires = ?, attempts = attempts + 1 WHERE id = ?',
+                [(LEASED, worker, now + self.lease_seconds, row[0]) for row in rows]
+            )
+            return [Job(*row[:-1], row[-1] + 1) for row in rows]
+
+        return self._transaction(lease)
+
+
+    def renew(self, worker, job_ids):
+        '''Extend the leases the worker still holds on the jobs by lease_seconds. Return the number of leases renewed'''
+
+        def extend(ids):
+            cursor = self.db.executemany(
+                'UPDATE jobs SET lease_expires = ? WHERE id = ? AND worker = ? AND state = ?',
+                [(time.time() + self.lease_seconds, job_id, worker, LEASED) for job_id in ids]
+            )
+            return cursor.rowcount
+
+        return self._transaction(extend, list(job_ids))
+
+
+    def complete(self, worker, job, success, error=None):
+        '''Record the outcome of a job: done when success is not False, otherwise pending again until it failed
+        max_attempts times. Return False when the worker no longer held the lease, the outcome is then ignored'''
+
+        def record():
+            if success is not False:
+                state = DONE
+            else:
+                state = FAILED if job.attempts >= self.max_attempts else PENDING
+            cursor = self.db.execute(
+                'UPDATE jobs SET state = ?, worker = NULL, lease_expires = NULL, error = ? WHERE id = ? AND worker = ? AND state = ?',
+                (state, error, job.id, worker, LEASED)
+            )
+            return cursor.rowcount == 1
+
+        return self._transaction(record)
+
+
+    def retry_failed(self):
+        '''Make the failed jobs pending again with all of their attempts. Return their number'''
+
+        def reset():
+            cursor = self.db.execute(
+                'UPDATE jobs SET state = ?, attempts = 0, error = NULL WHERE state = ?', (PENDING, FAILED)
+            )
+            return cursor.rowcount
+
+        return self._transaction(reset)
+
+
+    def counts(self):
+        '''Return the number of jobs in each state, leases that expired counting as pending'''
+
+        with self._lock:
+            rows = self.db.execute(
+                'SELECT CASE WHEN state = ? AND lease_expires < ? THEN ? ELSE state END, COUNT(*) FROM jobs GROUP BY 1',
+                (LEASED, time.time(), PENDING)
+            ).fetchall()
+        counts = {PENDING: 0, LEASED: 0, DONE: 0, FAILED: 0}
+        counts.update(rows)
+        return counts
+
+
+    def failures(self):
+        '''Return (path, service, error) for every job that failed for good'''
+
+        with self._lock:
+            return self.db.execute(
+                'SELECT path, service, error FROM jobs WHERE state = ? ORDER BY id', (FAILED,)
+            ).fetchall()
+
+
+    def close(self):
+        with self._lock:
+            self.db.close()
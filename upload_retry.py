@@ -0,0 +1,202 @@
+import logging
+import random
+import re
+import sys
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+# Outcomes of classify_s3_error and classify_gcs_error
+FATAL = 'fatal'
+RETRYABLE = 'retryable'
+THROTTLED = 'throttled'
+
+# S3 error codes telling the client to slow down, and transient S3 error codes worth retrying
+S3_THROTTLING_CODES = {'SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded',
+                       'TooManyRequestsException', 'RequestThrottled', 'ServiceUnavailable', '503'}
+S3_RETRYABLE_CODES = {'RequestTimeout', 'RequestTimeoutException', 'InternalError', 'PriorRequestNotComplete',
+                      'BadDigest', 'IncompleteBody', '500', '502', '504'}
+
+# Errors of the network layer, retryable whatever the cloud service, with those of botocore once it is imported
+NETWORK_ERRORS = (ConnectionError, TimeoutError)
+
+
+def _sdk_exceptions(module_name):
+    '''Return the exceptions module of a cloud SDK, or None when the SDK was not imported. The SDKs are imported
+    by the first uploader needing them and an exception can only come from an imported SDK, so classifying an
+    error never imports one'''
+
+    return sys.modules.get(module_name)
+
+
+def _network_errors():
+    botocore_exceptions = _sdk_exceptions('botocore.exceptions')
+    if botocore_exceptions is None:
+        return NETWORK_ERRORS
+    return NETWORK_ERRORS + (botocore_exceptions.EndpointConnectionError, botocore_exceptions.ConnectionClosedError,
+                             botocore_exceptions.ReadTimeoutError, botocore_exceptions.ConnectTimeoutError)
+
+
+class HTTPStatusError(Exception):
+    '''Raised for an unexpected HTTP response, classified by its status code'''
+
+    def __init__(self, status_code, message):
+        super().__init__(f"HTTP {status_code}: {message}")
+        self.status_code = status_code
+
+
+def classify_status_code(status_code):
+    # 429 and 503 ask the client to slow down, other 5xx are transient server errors
+    if status_code in (429, 503):
+        return THROTTLED
+    if status_code is not None and 500 <= status_code < 600:
+        return RETRYABLE
+    return FATAL
+
+
+def classify_s3_error(error):
+    '''Return THROTTLED, RETRYABLE or FATAL for an exception raised by boto3'''
+
+    if isinstance(error, _network_errors()):
+        return RETRYABLE
+    if isinstance(error, HTTPStatusError):
+        return classify_status_code(error.status_code)
+
+    botocore_exceptions = _sdk_exceptions('botocore.exceptions')
+    if botocore_exceptions is not None and isinstance(error, botocore_exceptions.ClientError):
+        code = error.response.get('Error', {}).get('Code', '')
+        status_code = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+    else:
+        # boto3's S3UploadFailedError is raised while handling the error that failed the upload, a ClientError
+        # or a network error such as a connection reset or a read timeout, classify that one first
+        cause = error.__cause__ or error.__context__
+        if cause is not None:
+            outcome = classify_s3_error(cause)
+            if outcome != FATAL:
+                return outcome
+        # Otherwise only the message of the ClientError is left, which reads "An error occurred (SlowDown) when calling ..."
+        match = re.search(r'An error occurred \((\w+)\)', str(error))
+        if match is None:
+            return FATAL
+        code, status_code = match.group(1), None
+
+    if code in S3_THROTTLING_CODES:
+        return THROTTLED
+    if code in S3_RETRYABLE_CODES:
+        return RETRYABLE
+    return classify_status_code(status_code)
+
+
+def classify_gcs_error(error):
+    '''Return THROTTLED, RETRYABLE or FATAL for an exception raised by google-cloud-storage'''
+
+    api_exceptions = _sdk_exceptions('google.api_core.exceptions')
+    if api_exceptions is not None:
+        if isinstance(error, (api_exceptions.TooManyRequests, api_exceptions.ServiceUnavailable)):
+            return THROTTLED
+        if isinstance(error, (api_exceptions.InternalServerError, api_exceptions.BadGateway,
+                              api_exceptions.GatewayTimeout, api_exceptions.RequestRangeNotSatisfiable)):
+            return RETRYABLE
+    if isinstance(error, HTTPStatusError):
+        return classify_status_code(error.status_code)
+    if isinstance(error, _network_errors()):
+        return RETRYABLE
+
+    # google-resumable-media raises InvalidResponse carrying the HTTP response, requests raises its own errors
+    response = getattr(error, 'response', None)
+    if response is not None and hasattr(response, 'status_code'):
+        return classify_status_code(response.status_code)
+    if type(error).__module__.startswith(('requests.', 'urllib3.')) and 'Error' in type(error).__name__:
+        return RETRYABLE
+    return FATAL
+
+
+class AdaptiveRateLimiter:
+    '''Define a class called AdaptiveRateLimiter which limits the number of requests in flight for a cloud service.
+
+    The limit grows by one request per limit successful requests (additive increase) and is halved
+    when the cloud service throttles (multiplicative decrease), at most once per cooldown seconds
+    so a burst of throttled requests only counts once. It settles just below the rate the cloud
+    service accepts.
+    '''
+
+    def __init__(self, max_limit, min_limit=1, cooldown=1.0):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.cooldown = cooldown
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        # Wait until fewer requests than the current limit are in flight
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+
+    def on_success(self):
+        with self._condition:
+            if self.limit < self.max_limit:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+                self._condition.notify_all()
+
+    def on_throttle(self):
+        with self._condition:
+            now = time.monotonic()
+            if now - self._last_decrease >= self.cooldown:
+                self.limit = max(self.min_limit, self.limit / 2)
+                self._last_decrease = now
+
+
+class RetryPolicy:
+    '''Define a class called RetryPolicy which retries failed calls with exponential backoff and full jitter.
+
+    The n-th retry waits a random time between 0 and min(max_delay, base_delay * 2 ** n) seconds,
+    which spreads the retries of many workers instead of sending them back at the same moment.
+    Throttled calls also slow down the AdaptiveRateLimiter when one is given.
+    '''
+
+    def __init__(self, max_attempts=5, base_delay=0.5, max_delay=30.0):
+        if max_attempts < 1:
+            raise ValueError("max_attempts must be at least 1.")
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def backoff(self, retry):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** retry))
+
+    def call(self, func, classify, rate_limiter=None):
+        '''Call func until it succeeds, it raises a FATAL error or max_attempts is reached, and return its result'''
+
+        for attempt in range(self.max_attempts):
+            if rate_limiter is not None:
+                rate_limiter.acquire()
+            try:
+                result = func()
+            except Exception as e:
+                kind = classify(e)
+                if kind == THROTTLED and rate_limiter is not None:
+                    rate_limiter.on_throttle()
+                if kind == FATAL or attempt == self.max_attempts - 1:
+                    raise
+                delay = self.backoff(attempt)
+                logger.warning("Retrying in %.2fs after %s error: %s", delay, kind, e)
+            else:
+                if rate_limiter is not None:
+                    rate_limiter.on_success()
+                return result
+            finally:
+                if rate_limiter is not None:
+                    rate_limiter.release()
+            time.sleep(delay)
@@ -0,0 +1,127 @@
+import logging
+import os
+import queue
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+
+logger = logging.getLogger(__name__)
+
+
+# One file to upload: its path, size and mtime from the directory scan and the cloud services it goes to
+WorkItem = namedtuple('WorkItem', ['path', 'size', 'mtime_ns', 'targets'])
+
+
+class ExtensionRouter:
+    '''Define a class called ExtensionRouter which maps file extensions to the cloud services they are uploaded to.
+
+    The table is built once from {service: extensions}, so routing a file is one dict lookup
+    instead of a linear search of the extension lists of every cloud service.
+    '''
+
+    def __init__(self, routes):
+        table = {}
+        for service, extensions in routes.items():
+            for extension in extensions:
+                table.setdefault(extension.lower(), set()).add(service)
+        self.table = {extension: frozenset(services) for extension, services in table.items()}
+
+    def route(self, file_name):
+        '''Return the frozenset of cloud services the file goes to, empty when its extension is not configured'''
+
+        return self.table.get(file_name.rpartition('.')[2].lower(), frozenset())
+
+
+def scan_directory_entries(directory, router):
+    '''List one directory with os.scandir. Return the paths of its subdirectories and a WorkItem for
+    every file routed to at least one cloud service. Only routed files are stat'ed'''
+
+    subdirectories = []
+    items = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            # Do not follow symlinked directories, like os.walk
+            if entry.is_dir(follow_symlinks=False):
+                subdirectories.append(entry.path)
+                continue
+
+            targets = router.route(entry.name)
+            if not targets or not entry.is_file():
+                continue
+
+            stat = entry.stat()
+            items.append(WorkItem(entry.path, stat.st_size, stat.st_mtime_ns, targets))
+    return subdirectories, items
+
+
+class DirectoryScanner:
+    '''Define a class called DirectoryScanner which walks a directory tree with several threads.
+
+    Every directory is listed by a worker thread, which queues its subdirectories as new tasks.
+    The WorkItems are handed to the consumer through a bounded queue, so scan() is a generator
+    and a huge tree is never held in memory: the workers wait while the consumer is busy.
+    '''
+
+    # Marker put on the queue when the last directory has been listed
+    _DONE = object()
+
+    def __init__(self, root, router, max_workers=4, queue_size=1024):
+        self.root = root
+        self.router = router
+        self.max_workers = max_workers
+        self.queue_size = queue_size
+
+
+    def scan(self):
+        '''Yield a WorkItem for every routed file under the root directory, in no particular order'''
+
+        results = queue.Queue(maxsize=self.queue_size)
+        stopped = threading.Event()
+        lock = threading.Lock()
+        pending = [1]
+
+        def put(item):
+            # Wait for room in the queue, giving up when the consumer stopped iterating
+            while not stopped.is_set():
+                try:
+                    results.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def list_directory(directory):
+            try:
+                try:
+                    subdirectories, items = scan_directory_entries(directory, self.router)
+                except OSError as e:
+                    # Skip directories that disappeared or cannot be read
+                    logger.warning("Skipping %s: %s", directory, e)
+                    subdirectories, items = [], []
+
+                with lock:
+                    pending[0] += len(subdirectories)
+                for subdirectory in subdirectories:
+                    if not stopped.is_set():
+                        executor.submit(list_directory, subdirectory)
+                for item in items:
+                    put(item)
+            finally:
+                with lock:
+                    pending[0] -= 1
+                    done = pending[0] == 0
+                if done:
+                    put(self._DONE)
+
+        executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='scanner')
+        try:
+            executor.submit(list_directory, self.root)
+            while True:
+                item = results.get()
+                if item is self._DONE:
+                    return
+                yield item
+        finally:
+            # Stop the workers when the scan ends or the consumer stops early
+            stopped.set()
+            executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,315 @@
+import contextlib
+import io
+import json
+import logging
+import os
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+# Size of the blocks read from a throttled request body, so a big body is paced instead of sent in one burst
+BLOCK_SIZE = 64 * 1024
+
+
+class TokenBucket:
+    '''Define a class called TokenBucket which caps a rate, e.g. the bytes per second sent to a cloud service.
+
+    Tokens accumulate at rate per second up to burst. consume() takes tokens as soon as the bucket is not
+    empty, possibly leaving it in debt, so an amount larger than burst never waits forever; the debt is paid
+    back before the next consumer goes. While consumers of a better (lower) priority are waiting, consumers of
+    worse priorities wait behind them. A rate of None means unlimited, and set_rate() changes the rate while
+    consumers are waiting.
+    '''
+
+    def __init__(self, rate=None, burst=None):
+        self.rate = None
+        self.burst = None
+        self._tokens = 0.0
+        self._updated = time.monotonic()
+        self._waiting = {}
+        self._condition = threading.Condition()
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        # By default up to one second of tokens accumulates while nothing is sent
+        with self._condition:
+            self._refill()
+            self.rate = rate or None
+            self.burst = burst or rate or None
+            self._tokens = min(self._tokens, self.burst) if self.rate else 0.0
+            self._condition.notify_all()
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate is not None:
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def consume(self, amount, priority=0):
+        with self._condition:
+            if self.rate is None:
+                return
+            self._waiting[priority] = self._waiting.get(priority, 0) + 1
+            try:
+                while True:
+                    if self.rate is None:
+                        return
+                    self._refill()
+                    ahead = any(count for waiting, count in self._waiting.items() if waiting < priority)
+                    if self._tokens > 0 and not ahead:
+                        self._tokens -= amount
+                        return
+                    # Sleep until the debt is paid back, or a little while when better priorities are ahead
+                    delay = -self._tokens / self.rate if self._tokens <= 0 else 0.01
+                    self._condition.wait(timeout=max(delay, 0.001))
+            finally:
+                self._waiting[priority] -= 1
+                if not self._waiting[priority]:
+                    del self._waiting[priority]
+                self._condition.notify_all()
+
+
+class ConcurrencyBudget:
+    '''Define a class called ConcurrencyBudget which limits the number of uploads running at the same time.
+
+    Waiting uploads start in priority order, the lowest priority value first. A limit of None means
+    unlimited, and set_limit() changes the limit at runtime: a lower limit lets the running uploads finish
+    and only holds back the next ones.
+    '''
+
+    def __init__(self, limit=None):
+        self.limit = limit or None
+        self.running = 0
+        self._waiting = {}
+        self._condition = threading.Condition()
+
+    def set_limit(self, limit):
+        with self._condition:
+            self.limit = limit or None
+            self._condition.notify_all()
+
+    def acquire(self, priority=0):
+        with self._condition:
+            self._waiting[priority] = self._waiting.get(priority, 0) + 1
+            try:
+                while ((self.limit is not None and self.running >= self.limit)
+                       or any(count for waiting, count in self._waiting.items() if waiting < priority)):
+                    self._condition.wait()
+                self.running += 1
+            finally:
+                self._waiting[priority] -= 1
+                if not self._waiting[priority]:
+                    del self._waiting[priority]
+                self._condition.notify_all()
+
+    def release(self):
+        with self._condition:
+            self.running -= 1
+            self._condition.notify_all()
+
+
+class ThrottledBody(io.RawIOBase):
+    '''A readable request body whose blocks consume tokens of every bucket before they are sent.
+    bytes bodies are wrapped too, so the HTTP library reads them block by block instead of sending them at once'''
+
+    def __init__(self, body, buckets, priority=0):
+        super().__init__()
+        self.body = io.BytesIO(body) if isinstance(body, (bytes, bytearray, memoryview)) else body
+        self.buckets = buckets
+        self.priority = priority
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return hasattr(self.body, 'seek')
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return b''.join(iter(lambda: self.read(BLOCK_SIZE), b''))
+        data = self.body.read(min(size, BLOCK_SIZE))
+        if data:
+            for bucket in self.buckets:
+                bucket.consume(len(data), self.priority)
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self.body.seek(offset, whence)
+
+    def tell(self):
+        return self.body.tell()
+
+
+class UploadScheduler:
+    '''Define a class called UploadScheduler which paces the uploads of every cloud service.
+
+    It holds a global bandwidth cap and one per cloud service (token buckets in bytes per second), a global
+    concurrency budget and one per cloud service, and priority classes: files get the class of their file
+    type from priorities (lower goes first), and files below small_file_size get class 0 whatever their
+    type, so a batch of documents is not stuck behind a 20 GB video. The uploaders send every request
+    body through throttle(), and the worker pools run every upload inside slot(). All limits can be
+    changed while uploads are running with set_bandwidth() and set_concurrency(), or by editing the
+    control file given to watch().
+    '''
+
+    def __init__(self, bandwidth=None, concurrency=None, services=None, priorities=None, file_types=None,
+                 small_file_size=None, default_priority=None):
+        '''services maps a cloud service to its {'bandwidth', 'concurrency'} settings and file_types
+        maps a file type to its extensions, like the 'file_types' section of the config file'''
+
+        services = services or {}
+        self.bandwidth = TokenBucket(bandwidth)
+        self.concurrency = ConcurrencyBudget(concurrency)
+        self.service_bandwidth = {}
+        self.service_concurrency = {}
+        for service, settings in services.items():
+            self.service_bandwidth[service] = TokenBucket(settings.get('bandwidth'))
+            self.service_concurrency[service] = ConcurrencyBudget(settings.get('concurrency'))
+
+        priorities = priorities or {}
+        self.small_file_size = small_file_size
+        self.default_priority = default_priority if default_priority is not None else max(priorities.values(), default=0)
+        self.extension_priorities = {extension.lower(): priorities[file_type]
+                                     for file_type, extensions in (file_types or {}).items() if file_type in priorities
+                                     for extension in extensions}
+        self._local = threading.local()
+        self._stopped = threading.Event()
+        self._watcher = None
+
+    def _buckets(self, service):
+        if service not in self.service_bandwidth:
+            self.service_bandwidth[service] = TokenBucket()
+            self.service_concurrency[service] = ConcurrencyBudget()
+        return self.bandwidth, self.service_bandwidth[service]
+
+    def priority(self, file_path, size=None):
+        # Return the priority class of a file, small files first and then by file type
+        if self.small_file_size is not None and size is not None and size < self.small_file_size:
+            return 0
+        return self.extension_priorities.get(file_path.rpartition('.')[2].lower(), self.default_priority)
+
+    def acquire(self, service, priority=None):
+        # Wait for the budget of the cloud service and then for the global concurrency budget. The uploads waiting
+        # for a saturated cloud service hold no global slot, so the other cloud services keep their share of it
+        self._buckets(service)
+        priority = self.default_priority if priority is None else priority
+        self.service_concurrency[service].acquire(priority)
+        try:
+            self.concurrency.acquire(priority)
+        except BaseException:
+            self.service_concurrency[service].release()
+            raise
+
+    def release(self, service):
+        self.concurrency.release()
+        self.service_concurrency[service].release()
+
+    @contextlib.contextmanager
+    def slot(self, service, priority=None):
+        '''Run the block as one upload to the cloud service: wait for the concurrency budgets, and let the
+        requests sent from the calling thread use the priority for bandwidth'''
+
+        priority = self.default_priority if priority is None else priority
+        self.acquire(service, priority)
+        previous = getattr(self._local, 'priority', None)
+        self._local.priority = priority
+        try:
+            yield
+        finally:
+            self._local.priority = previous
+            self.release(service)
+
+    def throttle(self, service, body):
+        '''Return the request body paced by the bandwidth caps of the cloud service, or the body itself when
+        nothing caps it. Requests sent from threads without a slot, like the parts of a large upload, get the
+        default priority'''
+
+        if body is None or isinstance(body, ThrottledBody):
+            return body
+        buckets = [bucket for bucket in self._buckets(service) if bucket.rate is not None]
+        if not buckets:
+            return body
+        priority = getattr(self._local, 'priority', None)
+        return ThrottledBody(body, buckets, self.default_priority if priority is None else priority)
+
+    def set_bandwidth(self, rate, service=None):
+        # Change the bandwidth cap in bytes per second, of a cloud service or the global one. None removes it
+        bucket = self.bandwidth if service is None else self._buckets(service)[1]
+        bucket.set_rate(rate)
+        logger.info("Bandwidth of %s set to %s bytes/s.", service or 'all cloud services', rate or 'unlimited')
+
+    def set_concurrency(self, limit, service=None):
+        # Change the number of uploads running at the same time, of a cloud service or in total. None removes it
+        if service is None:
+            budget = self.concurrency
+        else:
+            self._buckets(service)
+            budget = self.service_concurrency[service]
+        budget.set_limit(limit)
+        logger.info("Concurrency of %s set to %s.", service or 'all cloud services', limit or 'unlimited')
+
+    def apply(self, settings):
+        '''Apply the limits of a dict shaped like the 'scheduler' section of the config file: 'bandwidth',
+        'concurrency' and a {'bandwidth', 'concurrency'} dict per cloud service. Missing keys keep their limit'''
+
+        if 'bandwidth' in settings:
+            self.set_bandwidth(settings['bandwidth'])
+        if 'concurrency' in settings:
+            self.set_concurrency(settings['concurrency'])
+        for service, limits in _service_settings(settings).items():
+            if 'bandwidth' in limits:
+                self.set_bandwidth(limits['bandwidth'], service)
+            if 'concurrency' in limits:
+                self.set_concurrency(limits['concurrency'], service)
+
+    def watch(self, control_file, interval=1.0):
+        '''Apply the JSON control file every time it changes, checking its mtime every interval seconds
+        on a background thread until stop() is called. Invalid contents are logged and ignored'''
+
+        def run():
+            mtime = None
+            while not self._stopped.wait(interval):
+                try:
+                    current = os.stat(control_file).st_mtime_ns
+                    if current == mtime:
+                        continue
+                    mtime = current
+                    with open(control_file) as f:
+                        self.apply(json.load(f))
+                except FileNotFoundError:
+                    continue
+                except (OSError, ValueError) as e:
+                    logger.warning("Ignoring scheduler control file '%s': %s", control_file, e)
+
+        self._stopped.clear()
+        self._watcher = threading.Thread(target=run, name='scheduler-control', daemon=True)
+        self._watcher.start()
+
+    def stop(self):
+        # Stop watching the control file
+        self._stopped.set()
+        if self._watcher is not None:
+            self._watcher.join()
+            self._watcher = None
+
+
+def _service_settings(settings):
+    # The limits of each cloud service are the dict values of the section, except the priority classes
+    return {service: limits for service, limits in settings.items() if isinstance(limits, dict) and service != 'priorities'}
+
+
+def scheduler_from_config(settings, file_types):
+    '''Return the UploadScheduler described by the 'scheduler' section of the config file, or None when it is disabled'''
+
+    if not settings.get('enabled', False):
+        return None
+    return UploadScheduler(settings.get('bandwidth'), settings.get('concurrency'), _service_settings(settings),
+                           settings.get('priorities'), file_types, settings.get('small_file_size'), settings.get('default_priority'))
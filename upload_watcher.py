@@ -0,0 +1,342 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import time
+
+from upload_scanner import WorkItem
+
+
+logger = logging.getLogger(__name__)
+
+
+# inotify flags and event masks from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+# Events watched on every directory: files written and closed or moved in, and new subdirectories
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+# Header of an inotify event: watch descriptor, mask, cookie and length of the name that follows
+_EVENT = struct.Struct('iIII')
+
+
+def _walk_directories(root):
+    # Yield the root and every directory under it, without following symlinks and skipping unreadable ones
+    pending = [root]
+    while pending:
+        directory = pending.pop()
+        yield directory
+        try:
+            with os.scandir(directory) as entries:
+                pending.extend(entry.path for entry in entries if entry.is_dir(follow_symlinks=False))
+        except OSError as e:
+            logger.warning("Skipping %s: %s", directory, e)
+
+
+def _list_directory(directory):
+    # Return the paths of the regular files and of the subdirectories of one directory
+    files = []
+    subdirectories = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirectories.append(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                files.append(entry.path)
+    return files, subdirectories
+
+
+def _list_files(directory):
+    # Return the paths of the regular files of one directory, none when it cannot be read
+    try:
+        return _list_directory(directory)[0]
+    except OSError:
+        return []
+
+
+class InotifyWatcher:
+    '''Define a class called InotifyWatcher which reports the files written under a directory tree with Linux inotify.
+
+    libc is called through ctypes, so no extension module is needed. Every directory gets a watch, and new
+    subdirectories get one as soon as they are created; the files they already hold by then are reported too.
+    A file is reported when it is closed after being written or moved into the tree. When the kernel queue
+    overflows, events were lost and every file of the tree is reported once. Raises OSError when inotify
+    is not available, e.g. on another operating system or when the watch limit is reached.
+    '''
+
+    def __init__(self, root):
+        self.root = root
+        self._directories = {}
+        library = ctypes.util.find_library('c')
+        try:
+            self._libc = ctypes.CDLL(library, use_errno=True)
+            self._libc.inotify_init1.argtypes = [ctypes.c_int]
+            self._libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        except (OSError, AttributeError) as e:
+            raise OSError(f"inotify is not available: {e}")
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, f"inotify_init1 failed: {os.strerror(error)}")
+        try:
+            for directory in _walk_directories(root):
+                self._add_watch(directory)
+        except OSError:
+            self.close()
+            raise
+
+    def _add_watch(self, directory):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            # A directory removed in the meantime is not an error, running out of watches is
+            if error in (errno.ENOENT, errno.ENOTDIR):
+                return False
+            raise OSError(error, f"inotify_add_watch failed for '{directory}': {os.strerror(error)}")
+        self._directories[wd] = directory
+        return True
+
+    def _add_tree(self, directory):
+        # Watch a new directory and its subdirectories, and return the files they already hold
+        paths = []
+        for subdirectory in _walk_directories(directory):
+            if self._add_watch(subdirectory):
+                paths.extend(_list_files(subdirectory))
+        return paths
+
+    def read(self, timeout):
+        '''Wait up to timeout seconds for events and return the paths of the files written since the last call'''
+
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        paths = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                logger.warning("inotify queue overflowed under %s, checking every file once.", self.root)
+                paths.extend(path for directory in list(self._directories.values()) for path in _list_files(directory))
+                continue
+            if mask & IN_IGNORED:
+                # The watch was removed, e.g. because its directory was deleted
+                self._directories.pop(wd, None)
+                continue
+            directory = self._directories.get(wd)
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    paths.extend(self._add_tree(path))
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                paths.append(path)
+        return paths
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+class PollingWatcher:
+    '''Define a class called PollingWatcher which reports the new files under a directory tree by polling.
+
+    It is the fallback when inotify is not available. The mtime, file names and subdirectories of every
+    directory are kept, and a poll stats every directory but lists only those whose mtime changed, so new
+    files are found without stat'ing any file. A file rewritten in place does not change the mtime of its
+    directory and is not reported.
+    '''
+
+    def __init__(self, root, interval=5.0):
+        self.root = root
+        self.interval = interval
+        self._directories = {}
+        self._next_poll = 0.0
+        self._poll(report=False)
+
+    def _poll(self, report=True):
+        paths = []
+        directories = {}
+        pending = [self.root]
+        while pending:
+            directory = pending.pop()
+            try:
+                mtime_ns = os.stat(directory).st_mtime_ns
+            except OSError:
+                continue
+
+            # List the directory again only when an entry was added, removed or renamed in it
+            state = self._directories.get(directory)
+            if state is None or state[0] != mtime_ns:
+                try:
+                    files, subdirectories = _list_directory(directory)
+                except OSError as e:
+                    logger.warning("Skipping %s: %s", directory, e)
+                    continue
+                seen = state[1] if state is not None else frozenset()
+                state = (mtime_ns, frozenset(os.path.basename(path) for path in files), tuple(subdirectories))
+                if report:
+                    paths.extend(path for path in files if os.path.basename(path) not in seen)
+            directories[directory] = state
+            pending.extend(state[2])
+        self._directories = directories
+        self._next_poll = time.monotonic() + self.interval
+        return paths
+
+    def read(self, timeout):
+        '''Wait up to timeout seconds for the next poll and return the paths of the files that appeared since the last one'''
+
+        delay = self._next_poll - time.monotonic()
+        if delay > timeout:
+            time.sleep(max(timeout, 0))
+            return []
+        time.sleep(max(delay, 0))
+        return self._poll()
+
+    def close(self):
+        pass
+
+
+class Debouncer:
+    '''Define a class called Debouncer which holds back changed files until they are stable.
+
+    A file is ready once its size and mtime did not change for settle seconds after its last event,
+    so a file still being copied or appended to is not uploaded half written. Files that disappeared
+    before they settled are dropped.
+    '''
+
+    def __init__(self, settle=2.0):
+        self.settle = settle
+        self._pending = {}
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, path, now=None):
+        # Record an event for the file, pushing back the moment it is checked again
+        now = time.monotonic() if now is None else now
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self._pending.pop(path, None)
+            return
+        self._pending[path] = (now + self.settle, stat.st_size, stat.st_mtime_ns)
+
+    def next_deadline(self):
+        # Return the moment the next pending file is checked, None when there is none
+        return min((deadline for deadline, _, _ in self._pending.values()), default=None)
+
+    def ready(self, now=None):
+        '''Return (path, size, mtime_ns) for every pending file that stayed unchanged for settle seconds'''
+
+        now = time.monotonic() if now is None else now
+        ready = []
+        for path, (deadline, size, mtime_ns) in list(self._pending.items()):
+            if deadline > now:
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                del self._pending[path]
+                continue
+            if (stat.st_size, stat.st_mtime_ns) == (size, mtime_ns):
+                del self._pending[path]
+                ready.append((path, size, mtime_ns))
+            else:
+                self._pending[path] = (now + self.settle, stat.st_size, stat.st_mtime_ns)
+        return ready
+
+
+class DirectoryWatcher:
+    '''Define a class called DirectoryWatcher which turns the files written under a directory into batches of WorkItems.
+
+    Files are detected with an InotifyWatcher, or a PollingWatcher when inotify is not available or
+    backend is 'polling', debounced until they are stable and routed with the ExtensionRouter. A batch
+    is yielded once it holds batch_size files or batch_interval seconds after its first file, so a burst
+    of new files is handed to the uploaders together and a single new file still goes within seconds.
+    The state kept in memory is the pending files and the watched directories, the tree is never rescanned.
+    '''
+
+    def __init__(self, root, router, settle=2.0, batch_size=256, batch_interval=1.0, poll_interval=5.0, backend='auto'):
+        self.root = root
+        self.router = router
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.poll_interval = poll_interval
+        self.backend = backend
+        self.debouncer = Debouncer(settle)
+        self.watcher = None
+
+    def start(self):
+        # Start watching, before the startup scan so no file written during the scan is missed
+        if self.backend != 'polling':
+            try:
+                self.watcher = InotifyWatcher(self.root)
+            except OSError as e:
+                if self.backend == 'inotify':
+                    raise
+                logger.warning("Watching %s by polling every %s seconds: %s", self.root, self.poll_interval, e)
+        if self.watcher is None:
+            self.watcher = PollingWatcher(self.root, self.poll_interval)
+        logger.info("Watching %s with %s.", self.root, type(self.watcher).__name__)
+
+    def batches(self, stop_event=None):
+        '''Yield lists of WorkItems of the stable new files until stop_event is set, the last batch included'''
+
+        batch = []
+        batch_deadline = None
+        while stop_event is None or not stop_event.is_set():
+            # Wake up for the next debounced file, the end of the batch or at least twice a second to check stop_event
+            now = time.monotonic()
+            wake = [now + 0.5]
+            if self.debouncer.next_deadline() is not None:
+                wake.append(self.debouncer.next_deadline())
+            if batch_deadline is not None:
+                wake.append(batch_deadline)
+            for path in self.watcher.read(max(min(wake) - now, 0)):
+                if self.router.route(path):
+                    self.debouncer.add(path)
+
+            now = time.monotonic()
+            for path, size, mtime_ns in self.debouncer.ready(now):
+                batch.append(WorkItem(path, size, mtime_ns, self.router.route(path)))
+                if batch_deadline is None:
+                    batch_deadline = now + self.batch_interval
+                if len(batch) >= self.batch_size:
+                    yield batch
+                    batch = []
+                    batch_deadline = None
+            if batch and now >= batch_deadline:
+                yield batch
+                batch = []
+                batch_deadline = None
+        if batch:
+            yield batch
+
+    def close(self):
+        if self.watcher is not None:
+            self.watcher.close()
+            self.watcher = None